@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+'''
+Copyright (c) 2012 Lolapps, Inc. All rights reserved.
+
+Redistribution and use in source and binary forms, with or without modification, are
+permitted provided that the following conditions are met:
+
+   1. Redistributions of source code must retain the above copyright notice, this list of
+      conditions and the following disclaimer.
+
+   2. Redistributions in binary form must reproduce the above copyright notice, this list
+      of conditions and the following disclaimer in the documentation and/or other materials
+      provided with the distribution.
+
+THIS SOFTWARE IS PROVIDED BY LOLAPPS, INC. ''AS IS'' AND ANY EXPRESS OR IMPLIED
+WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND
+FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL LOLAPPS, INC. OR
+CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON
+ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+The views and conclusions contained in the software and documentation are those of the
+authors and should not be interpreted as representing official policies, either expressed
+or implied, of Lolapps, Inc..
+
+--------------------------------------------------------------------------------------------
+
+bench/bench_parse.py
+
+Times util.parse_error_string over a corpus of tracebacks shaped like
+the ones differ pulls out of our logs, and checks it gets the same
+answers as the original split-every-line implementation, which is kept
+here as reference_parse_error_string.
+
+python bench/bench_parse.py [--count N] [--seed N] [--repeat N]
+
+Exits non-zero if the two disagree on any message.
+
+'''
+
+import optparse
+import os
+import random
+import re
+import sys
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+import gen_corpus
+import util
+
+from settings import *
+
+file_line = re.compile(FILE_LINE)
+lol_file_line = re.compile(LOL_FILE_LINE)
+shared_file_line = re.compile(SHARED_FILE_LINE)
+indented_line = re.compile(INDENTED_LINE)
+
+def reference_parse_error_string(message):
+    """ parse_error_string as it was before it was made single pass.
+    """
+    lines = message.split('\n')
+
+    exception = None
+    product_location = None
+    shared_location = None
+    other_location = None
+
+    for line in lines:
+        if file_line.match(line):
+            if lol_file_line.match(line):
+                if shared_file_line.match(line):
+                    shared_location = line
+                else:
+                    product_location = line
+            else:
+                other_location = line
+        elif (product_location or shared_location or other_location) \
+             and not indented_line.match(line):
+            exception = line
+            break
+
+    if product_location:
+        location = product_location
+    elif shared_location:
+        location = shared_location
+    else:
+        location = other_location
+
+    filename = None
+    line_number = None
+    method = None
+    if location:
+        words = location.split()
+        filename = words[1].strip('\'",')
+        line_number = words[3].strip(',')
+        try:
+            method = words[5]
+        except:
+            method = "NO_METHOD_LISTED"
+
+    if exception:
+        exception = exception.split(':')[0]
+
+    return filename, line_number, method, exception
+
+# odd shapes seen in the wild, on top of the generated ones
+EDGE_CASES = [
+    '',
+    '\n',
+    '13:21:05,115 ERROR [kitsap.controllers.api.persist] Client Error: at null\n',
+    'Traceback (most recent call last):\n  File "/usr/lib/python2.7/x.py", line 1, in f\n',
+    'Traceback (most recent call last):\n  File "/var/www/kitsap/a.py", line 2, in g\n\nTypeError: x\n',
+    '\n\n  File "/var/www/example/b.py", line 3, in h\n    h()\nKeyError: 1\n',
+    '\tFile "/var/www/farm/c.py", line 4, in i\n\tcode()\nValueError\n',
+    'File "/var/www/quiz/d.py", line 5\nIOError: [Errno 2]\n',
+    '  File "/var/www/ads/e.py", line 6, in j\r\n    j()\r\nOSError: 13\r\n',
+    '  File "/usr/x.py", line 7, in k\n  File "/var/www/example/y.py", line 8, in l\n'
+    '  File "/var/www/image/z.py", line 9, in m\n  File "/usr/w.py", line 10, in n\nE: 1\n'
+    'Traceback (most recent call last):\n  File "/var/www/kitsap/later.py", line 11, in o\nF: 2\n',
+]
+
+def make_corpus(count, seed):
+    """ Error records as scan_file would hand them over: the line that
+    started the error, a traceback of varying depth and a trailing line.
+    """
+    rand = random.Random(seed)
+    writers = [gen_corpus.PasteWriter(rand), gen_corpus.PylonsWriter(rand),
+               gen_corpus.SyslogWriter(rand)]
+    corpus = list(EDGE_CASES)
+    while len(corpus) < count:
+        writer = rand.choice(writers)
+        writer.tick()
+        corpus.append(writer.error(rand.choice((0, 1, 2, 4, 8, 16, 32))) + writer.line())
+    return corpus
+
+def time_parser(parser, corpus, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        for message in corpus:
+            parser(message)
+        duration = time.time() - start
+        if best is None or duration < best:
+            best = duration
+    return best
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('--count', type='int', default=20000,
+                      help='messages in the corpus [default: %default]')
+    parser.add_option('--seed', type='int', default=1,
+                      help='random seed [default: %default]')
+    parser.add_option('--repeat', type='int', default=5,
+                      help='runs over the corpus, the fastest counts [default: %default]')
+    options, args = parser.parse_args()
+
+    corpus = make_corpus(options.count, options.seed)
+
+    mismatches = 0
+    for message in corpus:
+        expected = reference_parse_error_string(message)
+        got = util.parse_error_string(message)
+        if got != expected:
+            mismatches += 1
+            if mismatches <= 5:
+                print 'MISMATCH %r\n  expected %r\n  got      %r' % (message[:200], expected, got)
+
+    reference = time_parser(reference_parse_error_string, corpus, options.repeat)
+    current = time_parser(util.parse_error_string, corpus, options.repeat)
+    for name, duration in (('reference', reference), ('parse_error_string', current)):
+        print '%-20s %8.3fs %10.0f messages/s' % (name, duration, len(corpus) / duration)
+    print 'speedup %.2fx, %s mismatches in %s messages' % (reference / current, mismatches,
+                                                           len(corpus))
+    return 1 if mismatches else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,269 @@
+#!/usr/bin/env python
+'''
+Copyright (c) 2012 Lolapps, Inc. All rights reserved.
+
+Redistribution and use in source and binary forms, with or without modification, are
+permitted provided that the following conditions are met:
+
+   1. Redistributions of source code must retain the above copyright notice, this list of
+      conditions and the following disclaimer.
+
+   2. Redistributions in binary form must reproduce the above copyright notice, this list
+      of conditions and the following disclaimer in the documentation and/or other materials
+      provided with the distribution.
+
+THIS SOFTWARE IS PROVIDED BY LOLAPPS, INC. ''AS IS'' AND ANY EXPRESS OR IMPLIED
+WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND
+FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL LOLAPPS, INC. OR
+CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON
+ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+The views and conclusions contained in the software and documentation are those of the
+authors and should not be interpreted as representing official policies, either expressed
+or implied, of Lolapps, Inc..
+
+--------------------------------------------------------------------------------------------
+
+bench/bench_scan.py
+
+Measures differ.scan_file throughput on synthetic logs from
+gen_corpus.py, with database injection turned off so only reading,
+matching and parsing are timed. For each log format it reports MB/s,
+lines/s, how many errors were found, and how much memory the scan
+grew the process by (peak RSS over what it was before scanning; Python
+2 has no allocation tracing of its own).
+
+python bench/bench_scan.py [options] [format ...]
+
+Each format is also read through scanner.read_lines alone, and the
+scan's speed is kept as a share of that plain read. That share, rather
+than MB/s, is what's compared with bench/baseline.json, so a baseline
+taken on one machine still says something on another. Formats whose
+share dropped by more than --tolerance percent, or that found a
+different number of errors, are marked; with --check the run also
+exits non-zero for them. --save writes this run out as the new
+baseline.
+
+The json corpus holds the same entries as the pylons one, so when both
+are run the JSON-lines path is also compared with the text path.
+
+'''
+
+import json
+import multiprocessing
+import optparse
+import os
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+import gen_corpus
+
+DEFAULT_BASELINE = os.path.join(BENCH_DIR, 'baseline.json')
+
+def corpus_path(directory, fmt, options):
+    """ Generated logs are kept around between runs, named for what went
+    into them.
+    """
+    name = '%s-%sM-d%s-t%s-s%s.log' % (fmt, options.size, options.density,
+                                       options.depth, options.seed)
+    path = os.path.join(directory, name)
+    if not os.path.exists(path):
+        output = open(path + '.tmp', 'w')
+        try:
+            gen_corpus.generate(fmt, output, int(options.size * 1024 * 1024),
+                                options.density, options.depth, options.seed)
+        finally:
+            output.close()
+        os.rename(path + '.tmp', path)
+    return path
+
+def read_once(path):
+    """ One plain read_lines pass over path, what a scan can't be faster
+    than.
+    """
+    import scanner
+
+    logfile = open(path)
+    try:
+        start = time.time()
+        for line in scanner.read_lines(logfile, 0):
+            pass
+        return time.time() - start
+    finally:
+        logfile.close()
+
+def scan_once(path, repeat):
+    """ Runs in a fresh process, so peak RSS belongs to this scan alone.
+    Returns the best of repeat runs, and of as many plain reads taken in
+    between them so both see the same machine.
+    """
+    # imported here so it happens in the child
+    import differ
+    import util
+
+    devnull = open(os.devnull, 'w')
+    stdout = sys.stdout
+    sys.stdout = devnull # scan_file logs every match
+    try:
+        rss_before = util.get_peak_rss()
+        best = best_read = None
+        for _ in range(repeat):
+            read_duration = read_once(path)
+            if best_read is None or read_duration < best_read:
+                best_read = read_duration
+            start = time.time()
+            log_pos, digest = differ.scan_file(path, None, 0, False, False)
+            duration = time.time() - start
+            if best is None or duration < best:
+                best = duration
+        rss_growth = util.get_peak_rss() - rss_before
+    finally:
+        sys.stdout = stdout
+        devnull.close()
+
+    return best, best_read, log_pos, digest.count, rss_growth
+
+def run_format(fmt, options, directory):
+    path = corpus_path(directory, fmt, options)
+
+    lines = 0
+    corpus = open(path)
+    try:
+        for block in iter(lambda: corpus.read(1024 * 1024), ''):
+            lines += block.count('\n')
+    finally:
+        corpus.close()
+
+    pool = multiprocessing.Pool(1)
+    try:
+        duration, read_duration, size, errors, rss_growth = \
+            pool.apply(scan_once, (path, options.repeat))
+    finally:
+        pool.terminate()
+
+    return {'params': {'size': options.size, 'density': options.density,
+                       'depth': options.depth, 'seed': options.seed},
+            'seconds': duration,
+            'mb_per_sec': size / duration / (1024 * 1024),
+            'vs_read': read_duration / duration,
+            'lines_per_sec': lines / duration,
+            'errors': errors,
+            'rss_growth_kb': rss_growth}
+
+def count_entries(path, fmt):
+    """ How many log entries path holds, going by the lines the parser
+    for fmt takes to start one.
+    """
+    import parsers
+    log_format = parsers.get_format(fmt)
+    entries = 0
+    corpus = open(path)
+    try:
+        for line in corpus:
+            entries += log_format.detect([line])
+    finally:
+        corpus.close()
+    return entries
+
+def compare(fmt, result, baseline, tolerance):
+    """ Returns a description of how result compares to baseline, and
+    whether it's a regression.
+    """
+    if baseline is None:
+        return 'no baseline', False
+    if baseline['params'] != result['params']:
+        return 'baseline is for %s' % baseline['params'], False
+    if 'vs_read' not in baseline:
+        return 'baseline has no read speed to compare with, save it again', False
+
+    change = (result['vs_read'] - baseline['vs_read']) / baseline['vs_read'] * 100
+    notes = ['%+.1f%% vs %.3f of read' % (change, baseline['vs_read'])]
+    failed = change < -tolerance
+    if result['errors'] != baseline['errors']:
+        notes.append('found %s errors, baseline found %s' % (result['errors'], baseline['errors']))
+        failed = True
+    return ', '.join(notes), failed
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [options] [format ...]')
+    parser.add_option('--size', type='float', default=32,
+                      help='megabytes of log per format [default: %default]')
+    parser.add_option('--density', type='float', default=0.01,
+                      help='share of entries that are errors [default: %default]')
+    parser.add_option('--depth', type='int', default=8,
+                      help='frames in each traceback [default: %default]')
+    parser.add_option('--seed', type='int', default=1,
+                      help='random seed [default: %default]')
+    parser.add_option('--repeat', type='int', default=3,
+                      help='scans per format, the fastest counts [default: %default]')
+    parser.add_option('--corpus-dir', default=None,
+                      help='where to keep generated logs [default: a temp directory]')
+    parser.add_option('--baseline', default=DEFAULT_BASELINE,
+                      help='baseline results file [default: %default]')
+    parser.add_option('--tolerance', type='float', default=10,
+                      help='percent slower than baseline, relative to a plain read, '
+                           'that still passes [default: %default]')
+    parser.add_option('--check', action='store_true', default=False,
+                      help='exit non-zero on a regression')
+    parser.add_option('--save', action='store_true', default=False,
+                      help='save these results as the baseline')
+    options, formats = parser.parse_args()
+    formats = formats or list(gen_corpus.FORMATS)
+    for fmt in formats:
+        if fmt not in gen_corpus.FORMATS:
+            parser.error('unknown format %s' % fmt)
+
+    directory = options.corpus_dir or tempfile.mkdtemp(prefix='differ-bench-')
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    baselines = {}
+    if os.path.exists(options.baseline):
+        baselines = json.load(open(options.baseline))
+
+    results = {}
+    failed = False
+    print '%-8s %10s %8s %12s %8s %10s  %s' % ('format', 'MB/s', 'of read', 'lines/s',
+                                               'errors', 'rss+ KB', 'baseline')
+    for fmt in formats:
+        result = results[fmt] = run_format(fmt, options, directory)
+        note, regressed = compare(fmt, result, baselines.get(fmt), options.tolerance)
+        failed = failed or regressed
+        print '%-8s %10.2f %8.3f %12.0f %8s %10s  %s%s' % \
+              (fmt, result['mb_per_sec'], result['vs_read'], result['lines_per_sec'],
+               result['errors'], result['rss_growth_kb'], note,
+               ' REGRESSION' if regressed else '')
+
+    if 'json' in results and 'pylons' in results:
+        # a JSON entry is one longer line and a text one can be many, so
+        # it's log entries per second that compare
+        rates = {}
+        for fmt in ('json', 'pylons'):
+            entries = count_entries(corpus_path(directory, fmt, options), fmt)
+            rates[fmt] = entries / results[fmt]['seconds']
+        print 'json vs pylons text path: %.0f vs %.0f entries/s (%.2fx)' % \
+              (rates['json'], rates['pylons'], rates['json'] / rates['pylons'])
+
+    if options.save:
+        baselines.update(results)
+        output = open(options.baseline, 'w')
+        try:
+            json.dump(baselines, output, indent=1, sort_keys=True)
+            output.write('\n')
+        finally:
+            output.close()
+        print 'saved to %s' % options.baseline
+        return 0
+
+    return 1 if failed and options.check else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
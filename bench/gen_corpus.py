@@ -0,0 +1,252 @@
+#!/usr/bin/env python
+'''
+Copyright (c) 2012 Lolapps, Inc. All rights reserved.
+
+Redistribution and use in source and binary forms, with or without modification, are
+permitted provided that the following conditions are met:
+
+   1. Redistributions of source code must retain the above copyright notice, this list of
+      conditions and the following disclaimer.
+
+   2. Redistributions in binary form must reproduce the above copyright notice, this list
+      of conditions and the following disclaimer in the documentation and/or other materials
+      provided with the distribution.
+
+THIS SOFTWARE IS PROVIDED BY LOLAPPS, INC. ''AS IS'' AND ANY EXPRESS OR IMPLIED
+WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND
+FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL LOLAPPS, INC. OR
+CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON
+ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+The views and conclusions contained in the software and documentation are those of the
+authors and should not be interpreted as representing official policies, either expressed
+or implied, of Lolapps, Inc..
+
+--------------------------------------------------------------------------------------------
+
+bench/gen_corpus.py
+
+Writes synthetic logs for benchmarking differ. The same seed always
+gives the same file, so runs can be compared with each other.
+
+python bench/gen_corpus.py [options] <format> <output file>
+
+where format is one of paste, pylons, syslog, innodb or json. json
+holds the same entries as pylons, one JSON object per line the way our
+newer services log, so the two can be compared. See --help for
+the size, error density and traceback depth options.
+
+'''
+
+import collections
+import json
+import optparse
+import random
+import time
+
+FORMATS = ('paste', 'pylons', 'syslog', 'innodb', 'json')
+
+PRODUCTS = ('kitsap', 'farm', 'quiz', 'ads', 'image')
+EXCEPTIONS = (('TypeError', "unsupported operand type(s) for +: 'int' and 'NoneType'"),
+              ('KeyError', "'user_id'"),
+              ('AttributeError', "'NoneType' object has no attribute 'get'"),
+              ('OperationalError', '(2006, \'MySQL server has gone away\')'),
+              ('ValueError', 'invalid literal for int() with base 10: \'\''))
+METHODS = ('persist', 'index', '_connect', 'load_user', 'render', '__call__', 'dispatch')
+PATHS = ('/var/www/%s/controllers/api.py', '/var/www/%s/model/user.py',
+         '/var/www/example/fileserver/client.py', '/usr/lib/python2.7/site-packages/paste/httpserver.py',
+         '/usr/lib/python2.7/site-packages/sqlalchemy/engine/base.py')
+URLS = ('/api/persist', '/user/12345/profile', '/static/js/app.js?v=20120501',
+        '/gifts/send?to=54321&gift=7', '/quiz/results/998877')
+
+class LogWriter(object):
+    """ Writes one format's ordinary lines and error records. Every
+    format has a clock that moves forward a little with each line.
+    """
+
+    def __init__(self, rand):
+        self.rand = rand
+        self.now = time.mktime((2012, 5, 1, 13, 0, 0, 0, 0, -1))
+
+    def tick(self):
+        self.now += self.rand.random() / 10
+
+    def frames(self, depth):
+        """ Returns ([(path, line, method, code), ...], exception, message)
+        for a made up traceback.
+        """
+        product = self.rand.choice(PRODUCTS)
+        frames = []
+        for _ in range(depth):
+            path = self.rand.choice(PATHS)
+            if '%s' in path:
+                path = path % product
+            frames.append((path, self.rand.randint(1, 2000), self.rand.choice(METHODS),
+                           'result = self.%s(*args, **kw)' % self.rand.choice(METHODS)))
+        exception, message = self.rand.choice(EXCEPTIONS)
+        return frames, exception, message
+
+    def traceback(self, depth):
+        frames, exception, message = self.frames(depth)
+        lines = ['Traceback (most recent call last):\n']
+        for path, line, method, code in frames:
+            lines.append('  File "%s", line %s, in %s\n' % (path, line, method))
+            lines.append('    %s\n' % code)
+        lines.append('%s: %s\n' % (exception, message))
+        return ''.join(lines)
+
+class PasteWriter(LogWriter):
+
+    def stamp(self):
+        return '%s,%03d' % (time.strftime('%H:%M:%S', time.localtime(self.now)),
+                            int(self.now * 1000) % 1000)
+
+    def line(self):
+        return '%s INFO [%s.controllers] %s %s 200 OK user=%s took %.4fs\n' % \
+               (self.stamp(), self.rand.choice(PRODUCTS), self.rand.choice(('GET', 'POST')),
+                self.rand.choice(URLS), self.rand.randint(1, 10 ** 6), self.rand.random())
+
+    def error(self, depth):
+        product = self.rand.choice(PRODUCTS)
+        return '%s ERROR [%s.controllers.api.%s] Error - <type \'exceptions.Exception\'>\n%s' % \
+               (self.stamp(), product, self.rand.choice(METHODS), self.traceback(depth))
+
+class PylonsWriter(PasteWriter):
+
+    def stamp(self):
+        return '%s,%03d' % (time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(self.now)),
+                            int(self.now * 1000) % 1000)
+
+    def error(self, depth):
+        if self.rand.random() < 0.2:
+            return '%s WARNING [%s.lib.cache] cache miss storm on %s\n' % \
+                   (self.stamp(), self.rand.choice(PRODUCTS), self.rand.choice(URLS))
+        return PasteWriter.error(self, depth)
+
+class JsonWriter(PylonsWriter):
+    """ The pylons entries, written as JSON. The same random numbers are
+    drawn in the same order, so a seed gives the same entries as pylons.
+    """
+
+    def entry(self, level, logger, message, *fields):
+        # in the order the usual JSON formatters write them, time first
+        entry = collections.OrderedDict([('time', self.stamp()), ('level', level),
+                                         ('logger', logger), ('message', message)])
+        entry.update(fields)
+        return json.dumps(entry) + '\n'
+
+    def line(self):
+        product = self.rand.choice(PRODUCTS)
+        message = '%s %s 200 OK user=%s took %.4fs' % \
+                  (self.rand.choice(('GET', 'POST')), self.rand.choice(URLS),
+                   self.rand.randint(1, 10 ** 6), self.rand.random())
+        return self.entry('INFO', '%s.controllers' % product, message)
+
+    def error(self, depth):
+        if self.rand.random() < 0.2:
+            product = self.rand.choice(PRODUCTS)
+            return self.entry('WARNING', '%s.lib.cache' % product,
+                              'cache miss storm on %s' % self.rand.choice(URLS))
+        product = self.rand.choice(PRODUCTS)
+        logger = '%s.controllers.api.%s' % (product, self.rand.choice(METHODS))
+        frames, exception, message = self.frames(depth)
+        return self.entry('ERROR', logger, "Error - <type 'exceptions.Exception'>",
+                          ('product', product), ('exc_type', exception),
+                          ('exc_message', message),
+                          ('frames', [{'file': path, 'line': line, 'function': method,
+                                       'code': code} for path, line, method, code in frames]))
+
+class SyslogWriter(LogWriter):
+
+    def stamp(self):
+        return time.strftime('%b %d %H:%M:%S', time.localtime(self.now))
+
+    def line(self):
+        return '%s web%02d %s[%s]: %s\n' % \
+               (self.stamp(), self.rand.randint(1, 40),
+                self.rand.choice(('CRON', 'sshd', 'postfix/smtpd', 'ntpd')),
+                self.rand.randint(100, 32000),
+                self.rand.choice(('session opened for user root by (uid=0)',
+                                  'connect from unknown[10.0.0.1]',
+                                  'synchronized to 10.0.0.2, stratum 2',
+                                  '(root) CMD (/usr/local/bin/rotate.sh)')))
+
+    def error(self, depth):
+        if self.rand.random() < 0.5:
+            # shows up in syslog a lot, and IGNORE_ERRORS throws it out
+            return '%s web01 kernel: [drm:drm_edid_block_valid] *ERROR* EDID checksum is invalid\n' % \
+                   self.stamp()
+        return '%s web01 app[%s]: ERROR [%s] request failed\n%s' % \
+               (self.stamp(), self.rand.randint(100, 32000), self.rand.choice(PRODUCTS),
+                self.traceback(depth))
+
+class InnodbWriter(LogWriter):
+
+    def stamp(self):
+        return time.strftime('%y%m%d %H:%M:%S', time.localtime(self.now))
+
+    def line(self):
+        return '%s [Note] %s\n' % (self.stamp(), self.rand.choice((
+            'Slave SQL thread initialized, starting replication',
+            'Event Scheduler: Loaded 0 events',
+            'Aborted connection 1234 to db: \'differ\' user: \'differ_inject\'')))
+
+    def error(self, depth):
+        lines = ['%s  InnoDB: Error: page %s log sequence number %s\n' %
+                 (self.stamp(), self.rand.randint(1, 10 ** 6), self.rand.randint(1, 10 ** 12))]
+        for _ in range(depth):
+            lines.append('InnoDB: is in the future! Current system log sequence number %s.\n' %
+                         self.rand.randint(1, 10 ** 12))
+        return ''.join(lines)
+
+WRITERS = {'paste': PasteWriter, 'pylons': PylonsWriter,
+           'syslog': SyslogWriter, 'innodb': InnodbWriter, 'json': JsonWriter}
+
+def generate(fmt, output, size, density=0.01, depth=8, seed=1):
+    """ Write about size bytes of fmt log to the file output. density is
+    the share of entries that are errors, and depth the number of frames
+    in each traceback. Returns the number of errors written.
+    """
+    rand = random.Random(seed)
+    writer = WRITERS[fmt](rand)
+    written = 0
+    errors = 0
+    while written < size:
+        writer.tick()
+        if rand.random() < density:
+            text = writer.error(depth)
+            errors += 1
+        else:
+            text = writer.line()
+        output.write(text)
+        written += len(text)
+    return errors
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [options] <format> <output file>')
+    parser.add_option('--size', type='float', default=64,
+                      help='megabytes to write [default: %default]')
+    parser.add_option('--density', type='float', default=0.01,
+                      help='share of entries that are errors [default: %default]')
+    parser.add_option('--depth', type='int', default=8,
+                      help='frames in each traceback [default: %default]')
+    parser.add_option('--seed', type='int', default=1,
+                      help='random seed [default: %default]')
+    options, args = parser.parse_args()
+    if len(args) != 2 or args[0] not in FORMATS:
+        parser.error('expected a format (%s) and an output file' % ', '.join(FORMATS))
+
+    output = open(args[1], 'w')
+    try:
+        errors = generate(args[0], output, int(options.size * 1024 * 1024),
+                          options.density, options.depth, options.seed)
+    finally:
+        output.close()
+    print '%s errors written to %s' % (errors, args[1])
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,379 @@
+#!/usr/bin/env python
+'''
+Copyright (c) 2012 Lolapps, Inc. All rights reserved.
+
+Redistribution and use in source and binary forms, with or without modification, are
+permitted provided that the following conditions are met:
+
+   1. Redistributions of source code must retain the above copyright notice, this list of
+      conditions and the following disclaimer.
+
+   2. Redistributions in binary form must reproduce the above copyright notice, this list
+      of conditions and the following disclaimer in the documentation and/or other materials
+      provided with the distribution.
+
+THIS SOFTWARE IS PROVIDED BY LOLAPPS, INC. ''AS IS'' AND ANY EXPRESS OR IMPLIED
+WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND
+FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL LOLAPPS, INC. OR
+CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON
+ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+The views and conclusions contained in the software and documentation are those of the
+authors and should not be interpreted as representing official policies, either expressed
+or implied, of Lolapps, Inc..
+
+--------------------------------------------------------------------------------------------
+
+collector.py
+
+Takes in errors from differ hosts and writes them to the database, so
+that a few hundred differs don't each hold a MySQL connection and fight
+over the same InnoDB tables. Run it on a central server and set
+DIFFER_SINK = 'collector' on the differ hosts.
+
+Usage is as follows:
+collector.py [--port PORT] [--bind ADDRESS]
+
+Differ still spools everything locally first. Its drainer thread sends
+each batch of spooled records here with a CollectorClient and only moves
+past them once the collector says they're committed, so nothing is lost
+if the collector or the database is down for a while.
+
+On the wire, in both directions, a frame is a 4 byte big-endian length
+followed by that many bytes of zlib compressed JSON. A client sends a
+list of add_differ_error argument dicts and gets back {"ok": true} once
+they're in the database, or {"ok": false, "error": "..."}. Batches from
+every connection are merged and written COLLECTOR_TXN_ROWS rows at a
+time, in one transaction.
+
+'''
+
+import json
+import optparse
+import Queue
+import socket
+import SocketServer
+import struct
+import sys
+import threading
+import time
+import zlib
+
+import differdb
+import util
+
+from settings import *
+
+FRAME_HEADER = struct.Struct('>I')
+
+# what a record has to look like, everything else is turned away
+RECORD_FIELDS = frozenset(['logfile', 'product', 'code_location', 'code_method',
+                           'error_message', 'exception', 'timestamp', 'host',
+                           'occurrences', 'first_seen', 'last_seen'])
+REQUIRED_FIELDS = frozenset(['logfile', 'error_message', 'timestamp', 'host'])
+STRING_FIELDS = frozenset(['logfile', 'product', 'code_location', 'code_method',
+                           'error_message', 'exception', 'host'])
+
+
+class CollectorError(Exception):
+    pass
+
+
+def to_unicode(value):
+    # log files aren't always valid UTF-8, and json won't take bytes
+    # that aren't
+    if isinstance(value, str):
+        return value.decode('utf-8', 'replace')
+    return value
+
+def encode_frame(payload):
+    if isinstance(payload, list):
+        payload = [dict((key, to_unicode(value)) for key, value in record.items())
+                   for record in payload]
+    body = zlib.compress(json.dumps(payload, separators=(',', ':')))
+    return FRAME_HEADER.pack(len(body)) + body
+
+def recv_exactly(sock, length):
+    chunks = []
+    while length:
+        chunk = sock.recv(min(length, 1024 * 1024))
+        if not chunk:
+            break
+        chunks.append(chunk)
+        length -= len(chunk)
+    return ''.join(chunks)
+
+def read_frame(sock, max_bytes=COLLECTOR_MAX_FRAME_BYTES,
+               max_payload=COLLECTOR_MAX_PAYLOAD_BYTES):
+    """ Returns the decoded payload of the next frame on sock, or None if
+    the other end closed the connection between frames. A frame that
+    inflates to more than max_payload bytes is refused.
+    """
+    header = recv_exactly(sock, FRAME_HEADER.size)
+    if not header:
+        return None
+    if len(header) < FRAME_HEADER.size:
+        raise CollectorError('connection closed mid frame')
+
+    length, = FRAME_HEADER.unpack(header)
+    if length > max_bytes:
+        raise CollectorError('frame of %s bytes is over %s' % (length, max_bytes))
+    body = recv_exactly(sock, length)
+    if len(body) < length:
+        raise CollectorError('connection closed mid frame')
+
+    try:
+        inflater = zlib.decompressobj()
+        payload = inflater.decompress(body, max_payload)
+        if inflater.unconsumed_tail:
+            raise CollectorError('frame inflates to over %s bytes' % max_payload)
+        return json.loads(payload)
+    except (zlib.error, ValueError), e:
+        raise CollectorError('bad frame: %s' % e)
+
+def check_records(records):
+    """ Turn the records from a client into add_differ_error keyword
+    arguments, or raise CollectorError if they aren't records.
+    """
+    if not isinstance(records, list):
+        raise CollectorError('expected a list of records')
+    checked = []
+    for record in records:
+        if not isinstance(record, dict):
+            raise CollectorError('expected a list of records')
+        keys = set(record)
+        if not keys <= RECORD_FIELDS or not REQUIRED_FIELDS <= keys:
+            raise CollectorError('bad record fields: %s' % ', '.join(sorted(keys)))
+        for key, value in record.items():
+            if value is None:
+                ok = key not in REQUIRED_FIELDS
+            elif key in STRING_FIELDS:
+                ok = isinstance(value, basestring)
+            else:
+                # timestamp, occurrences, first_seen and last_seen
+                ok = isinstance(value, (int, long)) and not isinstance(value, bool)
+            if not ok:
+                raise CollectorError('bad record field %s: %r' % (key, value))
+        checked.append(dict((str(key), value) for key, value in record.items()))
+    return checked
+
+
+class CollectorClient(object):
+    """ The differ end of a collector connection. insert_records has the
+    same meaning as DifferDB's, so a SpoolDrainer can forward through a
+    collector instead of the database. It also has add_differ_error and
+    flush, buffering up to max_rows or max_age seconds of errors, to be
+    used as a sink on its own.
+
+    Anything that goes wrong raises CollectorError, and the connection
+    is dropped and made again on the next call.
+    """
+
+    def __init__(self, address=None, timeout=COLLECTOR_TIMEOUT,
+                 max_rows=DIFFER_BATCH_SIZE, max_age=DIFFER_BATCH_SECONDS):
+        self.address = address or (COLLECTOR_HOST, COLLECTOR_PORT)
+        self.timeout = timeout
+        self.max_rows = max_rows
+        self.max_age = max_age
+        self.socket = None
+        self.pending = []
+        self.oldest = None
+
+    def connect(self):
+        self.socket = socket.create_connection(self.address, self.timeout)
+        self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def close(self):
+        if self.socket is not None:
+            self.socket.close()
+            self.socket = None
+
+    def insert_records(self, records):
+        """ Send records and wait until the collector has committed them.
+        """
+        if not records:
+            return
+        try:
+            if self.socket is None:
+                self.connect()
+            self.socket.sendall(encode_frame(records))
+            reply = read_frame(self.socket)
+        except (socket.error, CollectorError), e:
+            self.close()
+            raise CollectorError('%s:%s: %s' % (self.address[0], self.address[1], e))
+
+        if reply is None:
+            self.close()
+            raise CollectorError('%s:%s closed the connection' % self.address)
+        if not reply.get('ok'):
+            raise CollectorError('%s:%s: %s' % (self.address[0], self.address[1],
+                                                reply.get('error')))
+
+    def add_differ_error(self, logfile, product, code_location, code_method, error_message,
+                         exception, timestamp, host, occurrences=1, first_seen=None,
+                         last_seen=None):
+        self.pending.append({'logfile': logfile, 'product': product,
+                             'code_location': code_location, 'code_method': code_method,
+                             'error_message': error_message, 'exception': exception,
+                             'timestamp': timestamp, 'host': host,
+                             'occurrences': occurrences, 'first_seen': first_seen,
+                             'last_seen': last_seen})
+        if self.oldest is None:
+            self.oldest = time.time()
+
+        if len(self.pending) >= self.max_rows or time.time() - self.oldest >= self.max_age:
+            self.flush()
+
+    def flush(self):
+        records, self.pending = self.pending, []
+        self.oldest = None
+        self.insert_records(records)
+
+
+class BatchCommitter(threading.Thread):
+    """ The one thread that writes to the database. Connections hand it
+    their records with submit() and wait; it gathers up to max_rows from
+    however many connections have sent something in the last max_wait
+    seconds and writes them all in one transaction.
+    """
+
+    def __init__(self, differ_db=None, max_rows=COLLECTOR_TXN_ROWS,
+                 max_wait=COLLECTOR_TXN_SECONDS):
+        threading.Thread.__init__(self, name='batch-committer')
+        self.daemon = True
+        self.differ_db = differ_db
+        self.max_rows = max_rows
+        self.max_wait = max_wait
+        self.queue = Queue.Queue()
+        self.rows_written = 0
+        self.transactions = 0
+        self.failures = 0
+
+    def submit(self, records):
+        """ Queue records for the next transaction. Returns None once
+        they're committed, or the error that stopped them.
+        """
+        entry = {'records': records, 'done': threading.Event(), 'error': None}
+        self.queue.put(entry)
+        entry['done'].wait()
+        return entry['error']
+
+    def run(self):
+        while True:
+            batch = [self.queue.get()]
+            rows = len(batch[0]['records'])
+            deadline = time.time() + self.max_wait
+            while rows < self.max_rows:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                try:
+                    entry = self.queue.get(timeout=remaining)
+                except Queue.Empty:
+                    break
+                batch.append(entry)
+                rows += len(entry['records'])
+            self.commit(batch, rows)
+
+    def commit(self, batch, rows):
+        records = []
+        for entry in batch:
+            records.extend(entry['records'])
+
+        error = None
+        start = time.time()
+        try:
+            if self.differ_db is None:
+                self.differ_db = differdb.DifferDB()
+            self.differ_db.insert_records(records)
+            self.rows_written += rows
+            self.transactions += 1
+        except Exception, e:
+            if len(batch) > 1:
+                # don't let one client's bad rows hold up everyone else's
+                for entry in batch:
+                    self.commit([entry], len(entry['records']))
+                return
+            # the client still has these spooled and will send them again
+            # once it's backed off
+            util.write_log('collector commit of %s rows failed: %s' % (rows, e))
+            self.failures += 1
+            error = str(e) or e.__class__.__name__
+
+        if error is None and time.time() - start > self.max_wait:
+            util.write_log('collector commit of %s rows from %s batches took %.2f seconds' %
+                           (rows, len(batch), time.time() - start))
+
+        for entry in batch:
+            entry['error'] = error
+            entry['done'].set()
+
+
+class CollectorHandler(SocketServer.BaseRequestHandler):
+    """ One differ connection: read a batch, wait for it to be committed,
+    answer, repeat until the differ hangs up.
+    """
+
+    def handle(self):
+        self.request.settimeout(COLLECTOR_IDLE_TIMEOUT)
+        peer = '%s:%s' % self.client_address
+        while True:
+            try:
+                records = read_frame(self.request)
+            except socket.timeout:
+                return
+            except (socket.error, CollectorError), e:
+                util.write_log('collector dropping %s: %s' % (peer, e))
+                return
+            if records is None:
+                return
+
+            try:
+                records = check_records(records)
+            except CollectorError, e:
+                util.write_log('collector refusing a batch from %s: %s' % (peer, e))
+                error = str(e)
+            else:
+                error = self.server.committer.submit(records)
+
+            if error is None:
+                reply = {'ok': True, 'rows': len(records)}
+            else:
+                reply = {'ok': False, 'error': error}
+            try:
+                self.request.sendall(encode_frame(reply))
+            except socket.error, e:
+                util.write_log('collector lost %s: %s' % (peer, e))
+                return
+
+
+class CollectorServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 128
+
+    def __init__(self, address, committer):
+        self.committer = committer
+        SocketServer.TCPServer.__init__(self, address, CollectorHandler)
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('-p', '--port', type='int', default=COLLECTOR_PORT,
+                      help='port to listen on (default %default)')
+    parser.add_option('-b', '--bind', default=COLLECTOR_BIND,
+                      help="address to listen on, '' for all of them (default %default)")
+    options, args = parser.parse_args()
+
+    util.write_log('starting %s on %s:%s' % (sys.argv[0], options.bind, options.port))
+    committer = BatchCommitter()
+    committer.start()
+    server = CollectorServer((options.bind, options.port), committer)
+    server.serve_forever()
+
+if __name__ == '__main__':
+    main()
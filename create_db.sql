@@ -28,6 +28,9 @@ CREATE DATABASE IF NOT EXISTS differ;
 
 USE differ;
 
+# the tables as they are after every migration in migrations/, see
+# migrate.py. Databases made with an older copy of this file are brought
+# up to date by running migrate.py instead
 CREATE TABLE `differ_errors` (
   `id` int(10) unsigned NOT NULL auto_increment,
   `timestamp` int(10) unsigned NOT NULL,
@@ -37,10 +40,17 @@ CREATE TABLE `differ_errors` (
   `code_location` varchar(100) default NULL,
   `code_method` varchar(100) default NULL,
   `error_message` text NOT NULL,
-  `exception` text,
+  `exception` varchar(64) default NULL,
+  `fingerprint` char(32) CHARACTER SET ascii NOT NULL,
+  `occurrences` int(10) unsigned NOT NULL default 1,
+  `first_seen` int(10) unsigned default NULL,
+  `last_seen` int(10) unsigned default NULL,
   `lolflied` varchar(5) default 'no',
   `fbz_case` int(10) default NULL,
-  PRIMARY KEY  (`id`)
+  PRIMARY KEY  (`id`),
+  KEY `ix_timestamp` (`timestamp`, `fbz_case`, `product`, `occurrences`),
+  KEY `ix_unfiled` (`fbz_case`, `exception`, `fingerprint`),
+  KEY `ix_fingerprint` (`fingerprint`, `fbz_case`)
 ) ENGINE=InnoDB AUTO_INCREMENT=1 DEFAULT CHARSET=utf8;
 
 # essentially clone of above, but for warnings
@@ -53,6 +63,54 @@ CREATE TABLE `differ_warnings` (
   `code_location` varchar(100) default NULL,
   `code_method` varchar(100) default NULL,
   `error_message` text NOT NULL,
-  `exception` text,
-  PRIMARY KEY  (`id`)
+  `exception` varchar(64) default NULL,
+  `fingerprint` char(32) CHARACTER SET ascii NOT NULL,
+  `occurrences` int(10) unsigned NOT NULL default 1,
+  `first_seen` int(10) unsigned default NULL,
+  `last_seen` int(10) unsigned default NULL,
+  PRIMARY KEY  (`id`),
+  KEY `ix_timestamp` (`timestamp`, `product`, `fingerprint`)
 ) ENGINE=InnoDB AUTO_INCREMENT=1 DEFAULT CHARSET=utf8;
+
+CREATE TABLE `differ_groups` (
+  `level` tinyint unsigned NOT NULL,
+  `fingerprint` char(32) CHARACTER SET ascii NOT NULL,
+  `product` varchar(20) default NULL,
+  `code_location` varchar(100) default NULL,
+  `code_method` varchar(100) default NULL,
+  `exception` varchar(64) default NULL,
+  `error_message` text NOT NULL,
+  `logfile` varchar(100) NOT NULL,
+  `host` varchar(100) NOT NULL,
+  `fbz_case` int(10) default NULL,
+  `first_seen` int(10) unsigned NOT NULL,
+  `last_seen` int(10) unsigned NOT NULL,
+  PRIMARY KEY  (`level`, `fingerprint`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8;
+
+CREATE TABLE `differ_rollups` (
+  `level` tinyint unsigned NOT NULL,
+  `tier` int(10) unsigned NOT NULL,
+  `bucket` int(10) unsigned NOT NULL,
+  `fingerprint` char(32) CHARACTER SET ascii NOT NULL,
+  `occurrences` int(10) unsigned NOT NULL,
+  PRIMARY KEY  (`level`, `tier`, `bucket`, `fingerprint`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8;
+
+CREATE TABLE `differ_drain_positions` (
+  `spool_id` char(32) CHARACTER SET ascii NOT NULL,
+  `segment` bigint unsigned NOT NULL,
+  `segment_offset` bigint unsigned NOT NULL,
+  PRIMARY KEY  (`spool_id`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8;
+
+# the migrations this file already has in it. Bump the version along with
+# the tables above whenever a migration is added
+CREATE TABLE `schema_migrations` (
+  `version` int(10) unsigned NOT NULL,
+  `name` varchar(100) NOT NULL,
+  `applied` int(10) unsigned NOT NULL,
+  PRIMARY KEY  (`version`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8;
+
+INSERT INTO `schema_migrations` VALUES (6, 'create_db', UNIX_TIMESTAMP());
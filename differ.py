@@ -40,108 +40,122 @@ TODO: fix logging output. It doesn't seem to play nicely with shell
 redirection.
 '''
 
+import gzip
+import hashlib
+import multiprocessing
 import os
-import pickle
-import re
+import socket
 import stat
 import sys
 import time
 
+import collector
 import differdb
+import discovery
+import metrics
+import parsers
+import scanner
+import spool
+import statestore
 import util
 import syslog_client
+import watcher
 
 from settings import *
 
-ERROR_PATTERN = re.compile(ERROR_RE)
-END_PATTERN = re.compile(ERROR_END_RE)
-
 
 def file_scan():
     """ Looks at the globally defined TARGETS value
-    and builds up the eligible file listing.
-    Relies upon the get_file_listing helper function
+    and builds up the eligible file listing, along with
+    the stat of every file on it. The walking is left
+    to get_discovery()
     """
     filelist = []
     largefilelist = []
-    for i in TARGETS:
-        loglist, largeloglist = get_file_listing(i)
-        filelist.extend(loglist)
-        largefilelist.extend(largeloglist)
-
-    return filelist, largefilelist
-
-def get_file_listing(target):
-    """ Helper function - provide a list of files based on
-    a target directory or file and file age.
-    1 argument:
-     target - the directory or file to scan
-    """
-
-    # First, establish if the target is a file.
-    # If it is, then set it as the whole list
-    # If it is a directory, then scan it and return the values
-    # If neither, return an empty set
-
-    loglist = []
-    largeloglist = []
+    file_stats, explicit = get_discovery().scan(TARGETS)
+    for filename, stats in file_stats.iteritems():
+        check_and_classify_file(filename, filelist, largefilelist, stats,
+                                filename in explicit)
 
-    if os.path.isfile(target):
-        check_and_classify_file(target, loglist, largeloglist)
-    elif os.path.isdir(target):
-        for i in os.listdir(target):
-            check_and_classify_file(os.path.join(target, i), loglist, largeloglist)
+    return filelist, largefilelist, file_stats
 
-    return loglist, largeloglist
+def is_log_file(filename):
+    """ Whether a file found in one of our target directories is worth
+    looking at, going by its name alone.
+    """
+    if filename in BLACKLIST:
+        return False
+    filetype = filename.split('.')[-1]
+    return filetype in VALID_FILETYPES and filetype not in IGNORE_FILETYPES
 
-def check_and_classify_file(filename, loglist, largeloglist):
+def check_and_classify_file(filename, loglist, largeloglist, stats, explicit=False):
     if filename in BLACKLIST:
         # There are some files, we just don't want to ever touch
         return
 
-    try:
-        stats = os.stat(filename)
-    except OSError:
-        # Sometimes files disappear during rotation
-        # if that's the case, then we can't stat it
-        # so, if it fails, just move along
-        return
-
     filetype = filename.split('.')[-1]
     if filetype in IGNORE_FILETYPES:
         return
-    elif filetype in VALID_FILETYPES or filename in TARGETS:
+    elif filetype in VALID_FILETYPES or explicit:
         file_size = stats[stat.ST_SIZE]
         if file_size > MAX_FILE_SIZE:
             largeloglist.append(filename)
         else:
             loglist.append(filename)
 
-def get_log_dict(filename):
-    """ Unpickle a previous state file
-    """
-
-    # On a new host, a state file may not be around.
-    try:
-        # It's here, let's use it
-        picklefile = open(filename, 'r')
-        logdict = pickle.load(picklefile)
-        picklefile.close()
-    except Exception:
-        # Not here, so create a new dictionary
-        logdict = {}
-
-    return logdict
-
-def write_log_dict(filename, logdict):
-    """ Use object serialization to write out
-    our state data.
+class ErrorDigest(object):
+    """ The per-cycle report of what we found. Rather than every error
+    from every file, it keeps a count per file and the first
+    DIGEST_SAMPLES errors from each, up to DIGEST_MAX_BYTES in all, so an
+    error storm can't balloon the report (or our memory).
     """
-    picklefile = open(filename, 'w')
-    pickle.dump(logdict, picklefile)
-    picklefile.close()
 
-def submit_errors(error_msg):
+    def __init__(self, max_samples=DIGEST_SAMPLES, max_bytes=DIGEST_MAX_BYTES):
+        self.max_samples = max_samples
+        self.max_bytes = max_bytes
+        self.files = [] # filenames, in the order we first saw errors in them
+        self.counts = {}
+        self.samples = {}
+        self.size = 0
+        self.count = 0
+
+    def add(self, filename, error_msg, count=1):
+        if filename not in self.counts:
+            self.files.append(filename)
+            self.counts[filename] = 0
+            self.samples[filename] = []
+        self.counts[filename] += count
+        self.count += count
+
+        samples = self.samples[filename]
+        if error_msg and len(samples) < self.max_samples and \
+           self.size + len(error_msg) <= self.max_bytes:
+            samples.append(error_msg)
+            self.size += len(error_msg)
+
+    def merge(self, other):
+        """ Fold in the digest from another scan, e.g. a worker's.
+        """
+        for filename in other.files:
+            samples = other.samples[filename]
+            for error_msg in samples:
+                self.add(filename, error_msg)
+            # whatever didn't come with a sample still has to be counted
+            self.add(filename, None, other.counts[filename] - len(samples))
+
+    def render(self):
+        report = []
+        for filename in self.files:
+            count = self.counts[filename]
+            samples = self.samples[filename]
+            report.append('==> Start errors from : %s (%s error(s))\n' % (filename, count))
+            report.extend(samples)
+            if count > len(samples):
+                report.append('==> %s more error(s) not shown\n' % (count - len(samples)))
+            report.append('==> End errors from %s\n' % filename)
+        return ''.join(report)
+
+def submit_errors(digest):
     """ submit_errors is used for sending out notifications 
     of errors.
     We can put in a variety of things here. For now, we have
@@ -150,7 +164,7 @@ def submit_errors(error_msg):
     """
 
     # If there's no error messages, just get out of here
-    if not error_msg:
+    if not digest.count:
         util.write_log('nothing to submit')
         return True
 
@@ -159,7 +173,7 @@ def submit_errors(error_msg):
     # email out the message
     if DIFFER_EMAIL_ERRORS:
         subject = 'Differ ERRORS: %s' % myhost
-        util.mail_it(RCPT_TO, MAIL_FROM, subject, error_msg, 'dev@example.com')
+        util.mail_it(RCPT_TO, MAIL_FROM, subject, digest.render(), 'dev@example.com')
 
     # send to the syslog on DIFFERLOGHOST the fact that we sent out an error
     # helpful for perhaps getting a quick look at how many servers
@@ -167,185 +181,544 @@ def submit_errors(error_msg):
     human_time = time.strftime('%Y%m%d %H:%M', time.localtime())
     try:
         syslog_msg = '%s errors submitted at %s' % (myhost, human_time)
-        c = syslog_client.syslog_client((DIFFERLOGHOST, 514))
-        c.log(syslog_msg, facility='local4', priority='info')
+        get_syslog().log(syslog_msg, facility='local4', priority='info')
     except:
         pass
 
-def process_completed_error(local_err_msg, lolfly_error, debug, db_inject):
-    # parse out the error some more and gather data
-    location, line_number, method, exception = util.parse_error_string(local_err_msg)
-
-    # set the info inside our lolfly dictionary
-    lolfly_error.error_msg = util.smart_truncate(local_err_msg, 
-                                                 length=MAX_MSG_LENGTH,
-                                                 suffix=MAX_MSG_SUFFIX)
-    lolfly_error.exception = util.smart_truncate(exception, length=MAX_EXC_LENGTH,
-                                                 suffix=MAX_EXC_SUFFIX)
-    lolfly_error.line_number = line_number
-    lolfly_error.location = util.smart_truncate(location,
-                                                length=MAX_LOCATION_LENGTH,
-                                                suffix=MAX_LOCATION_SUFFIX)
-    lolfly_error.method = method
-
-    if debug: lolfly_error.print_pretty()
-    if db_inject: lolfly_error.differ_db_inject()
-
-    return location, line_number, method, exception
-
-def scan_file(filename, differ_db, log_pos=0, debug=False, db_inject=False):
-    error_msg = ''
-    local_err_msg = ''
+def scan_file(filename, differ_db, log_pos=0, debug=False, db_inject=False, records=None,
+              max_bytes=None, digest=None, stats=None, log_format=None):
+    """ Scan filename from log_pos for errors. Returns the offset to pick
+    up from next time along with an ErrorDigest of the errors found (the
+    one passed in, if any). If
+    max_bytes is given, give up after reading roughly that much; an error
+    we were in the middle of is left to be read again whole next time.
+    If stats is given, the metrics.ScanStats counters are added to.
+    log_format names the parsers.LogFormat to read the file as; if it's
+    None the format is worked out from the file.
+
+    The work is done by a scanner pipeline; debug, db_inject and records
+    pick which of its sinks the errors go to.
+    """
+    if digest is None:
+        digest = ErrorDigest()
+    if stats is None:
+        stats = metrics.ScanStats()
 
     # Check if we have permissions to even read the file
     # in question
     if not os.access(filename, os.R_OK):
         util.write_log('%s unable to read due to permissions' % filename)
-        return log_pos, error_msg
-
-    logfile = open(filename, 'r')
-    logfile.seek(log_pos)
-
-    tail = None
-    gotmatch = False
-    lolfly_error = differdb.LolflyError(filename, differ_db)
-
-    for line in logfile:
-        if ERROR_PATTERN.search(line) and util.check_valid_error(line):
-            # We match, start outputting. 
-            if tail is None:
-                util.write_log('got match in file : %s' % filename)
-                tail = MAX_LINES
-            local_err_msg += util.smart_truncate(line, length=MAX_LINE_LENGTH, 
-                                                 suffix=MAX_LINE_SUFFIX)
-            log_pos = logfile.tell()
-            tail -= 1
-            gotmatch = True
-
-        elif gotmatch and (re.match(PASTE_DATE_FORMAT, line) or 
-                           END_PATTERN.search(line) or
-                           re.match(PYLONS_DATE_FORMAT, line)):
-            # add on to the local_err_msg
-            # and then update the bigger message
-            local_err_msg += util.smart_truncate(line, length=MAX_LINE_LENGTH,
-                                                        suffix=MAX_LINE_SUFFIX)
-            error_msg += local_err_msg
-
-            process_completed_error(local_err_msg, lolfly_error, debug, db_inject)
-
-            # reset variables
-            lolfly_error.initialize()
-            local_err_msg = ''
-            tail = None
-            gotmatch = False
-
-        elif tail > 0:
-            local_err_msg += util.smart_truncate(line, length=MAX_LINE_LENGTH,
-                                                 suffix=MAX_LINE_SUFFIX)
-            log_pos = logfile.tell()
-            tail -= 1
-
-        elif tail == 0:
-            # add on to the local_err_msg
-            # and then update the bigger message
-            error_msg += local_err_msg
-
-            process_completed_error(local_err_msg, lolfly_error, debug, db_inject)
-
-            # reset variables
-            lolfly_error.initialize()
-            local_err_msg = ''
-            tail = None
-            gotmatch = False
-
-        else:
-            log_pos = logfile.tell()
-
-    error_msg += local_err_msg
-
-    if local_err_msg:
-        process_completed_error(local_err_msg, lolfly_error, debug, db_inject)
-
-    return log_pos, error_msg
+        return log_pos, digest
+
+    if log_format is None:
+        log_format = parsers.configured_format(filename) or \
+                     parsers.detect_format(filename)[0]
+    log_format = parsers.get_format(log_format)
+
+    sinks = [scanner.DigestSink(digest)]
+    if debug:
+        sinks.append(scanner.PrintSink())
+    if db_inject:
+        sinks.append(scanner.ErrorSink(differ_db))
+    if records is not None:
+        sinks.append(scanner.ListSink(records))
+
+    if filename.endswith('.gz'):
+        # a rotated log we're catching up on; offsets are into the
+        # uncompressed data and gzip streams it a chunk at a time
+        logfile = gzip.open(filename, 'rb')
+    else:
+        logfile = open(filename, 'r')
+    try:
+        log_pos = scanner.scan(logfile, filename, sinks, log_pos, max_bytes, stats,
+                               log_format)
+    finally:
+        logfile.close()
 
-def alert_large_log(filename, differ_db, debug=False, db_inject=False):
-    err_mess = "Log file %s ignored by differv2 because it is too large" % filename
+    return log_pos, digest
 
-    lolfly_error = differdb.LolflyError(filename, differ_db)
-    lolfly_error.error_msg = err_mess
-    lolfly_error.file_name = filename
-    lolfly_error.exception = None
+def file_fingerprint(path, length):
+    """ md5 of the first length bytes of path, uncompressing if need be.
+    Returns None if the file can't be read or is shorter than that.
+    """
+    try:
+        if path.endswith('.gz'):
+            headfile = gzip.open(path, 'rb')
+        else:
+            headfile = open(path, 'r')
+        try:
+            head = headfile.read(length)
+        finally:
+            headfile.close()
+    except (IOError, OSError):
+        return None
+
+    if len(head) < length:
+        return None
+    return hashlib.md5(head).hexdigest()
+
+def get_file_identity(log, stats, fingerprint_len=None):
+    """ Everything we use to tell whether log is still the file we
+    scanned last time: device and inode, size and mtime to notice
+    change cheaply, and an md5 of the head of the file to notice it
+    being truncated, replaced, or copied elsewhere.
+    """
+    file_size = stats[stat.ST_SIZE]
+    if fingerprint_len is None:
+        fingerprint_len = min(file_size, FINGERPRINT_BYTES)
+    return {'dev': stats[stat.ST_DEV],
+            'inode': stats[stat.ST_INO],
+            'size': file_size,
+            'mtime': stats.st_mtime,
+            'fingerprint': file_fingerprint(log, fingerprint_len),
+            'fingerprint_len': fingerprint_len}
+
+def find_rotated_file(log, old):
+    """ Work out where log went after logrotate moved it. An uncompressed
+    sibling (log.1, log-20120101, ...) with the old inode is a sure
+    thing, and one with the old head fingerprint is a copy
+    (copytruncate). Failing that, look for a log*.gz whose uncompressed
+    head matches. Entries from before we kept fingerprints fall back to
+    the newest log*.gz.
+    """
+    directory, name = os.path.split(log)
+    try:
+        siblings = os.listdir(directory)
+    except OSError:
+        return None
+
+    fingerprint = old.get('fingerprint')
+    fingerprint_len = old.get('fingerprint_len')
+    compressed = []
+    copies = []
+    for sibling in siblings:
+        if sibling == name or not sibling.startswith(name):
+            continue
+        path = os.path.join(directory, sibling)
+        try:
+            stats = os.stat(path)
+        except OSError:
+            continue
+        if sibling.endswith('.gz'):
+            compressed.append((stats[stat.ST_MTIME], path))
+        elif stats[stat.ST_INO] == old['inode'] and \
+             stats[stat.ST_DEV] == old.get('dev', stats[stat.ST_DEV]):
+            return path
+        else:
+            copies.append((stats[stat.ST_MTIME], path))
 
-    if debug: lolfly_error.print_pretty()
-    if db_inject: lolfly_error.differ_db_inject()
+    if fingerprint is None:
+        if compressed:
+            return max(compressed)[1]
+        return None
 
-    return err_mess
+    # newest first, the file we want is almost always the latest rotation
+    for mtime, path in sorted(copies + compressed, reverse=True):
+        if file_fingerprint(path, fingerprint_len) == fingerprint:
+            return path
+    return None
 
-def update_logdict(loglist, oldlogdict):
+def update_logdict(loglist, oldlogdict, file_stats):
     # Each time we run, we want to re-build our log dictionary. This
-    # helps to ensure we don't carry over stale data.
+    # helps to ensure we don't carry over stale data. file_stats has the
+    # stat of each log, taken when the listing was built
     newlogdict = {}
 
     for log in loglist:
-        stats = os.stat(log)
-        inode = stats[stat.ST_INO]
+        stats = file_stats[log]
         file_mtime = stats[stat.ST_MTIME]
-        min_mtime = int(time.time() - MAX_MTIME)
-
-        if file_mtime < min_mtime:
+        file_size = stats[stat.ST_SIZE]
+        stale = file_mtime < int(time.time() - MAX_MTIME)
+        old = oldlogdict.get(log)
+
+        same_inode = old is not None and stats[stat.ST_INO] == old['inode'] and \
+                     stats[stat.ST_DEV] == old.get('dev', stats[stat.ST_DEV])
+        if same_inode and file_size == old.get('size') and stats.st_mtime == old.get('mtime'):
+            # untouched since last time, nothing to check
+            newlogdict[log] = old
+            if stale:
+                old['log_pos'] = file_size
+            continue
+
+        if stale:
             # we've got an older file, so update the values in the newlogdict
-            # to the file size
-            file_size = stats[stat.ST_SIZE]
-            newlogdict[log] = {'log_pos': file_size, 'inode': inode}
-        elif oldlogdict.has_key(log):
-            # Check to see if a file we saw before has a new inode
-            # which indicates a new file
-            if inode != oldlogdict[log]['inode']:
-                newlogdict[log] = {'log_pos': 0, 'inode': inode}
-                util.write_log('inode on %s has changed, will scan' % log)
+            # to the file size. Its head only needs reading again if it's
+            # a different file or a different size
+            if same_inode and file_size == old.get('size'):
+                newlogdict[log] = dict(old, mtime=stats.st_mtime)
             else:
-                newlogdict[log] = oldlogdict[log]
-        else:
+                newlogdict[log] = get_file_identity(log, stats)
+            newlogdict[log]['log_pos'] = file_size
+            if old is not None and old.get('rotated'):
+                # the rotated file still has to be finished off
+                newlogdict[log]['rotated'] = old['rotated']
+            continue
+        elif old is None:
             # normal new file
-            newlogdict[log] = {'log_pos': 0, 'inode': inode}
+            newlogdict[log] = get_file_identity(log, stats)
+            newlogdict[log]['log_pos'] = 0
+            continue
+
+        log_format = old.get('format')
+        format_sure = old.get('format_sure')
+
+        fingerprint_len = old.get('fingerprint_len')
+        if old.get('fingerprint') is None or not fingerprint_len:
+            # nothing to go on but the inode; the md5 of an empty head
+            # (the file was empty when we looked) matches any file
+            same_file = same_inode and file_size >= old['log_pos']
+        else:
+            same_file = file_size >= old['log_pos'] and \
+                        file_fingerprint(log, fingerprint_len) == old['fingerprint']
+
+        if same_file:
+            # pick up where we left off, even if the file has been
+            # replaced by a copy of itself. Keep growing the fingerprint
+            # until it covers FINGERPRINT_BYTES
+            if fingerprint_len is not None and fingerprint_len >= FINGERPRINT_BYTES:
+                newlogdict[log] = get_file_identity(log, stats, fingerprint_len)
+            else:
+                newlogdict[log] = get_file_identity(log, stats)
+            newlogdict[log]['log_pos'] = old['log_pos']
+            if log_format is not None:
+                newlogdict[log]['format'] = log_format
+                newlogdict[log]['format_sure'] = format_sure
+            if not same_inode:
+                util.write_log('%s was replaced by a copy of itself, continuing' % log)
+            if old.get('rotated'):
+                newlogdict[log]['rotated'] = old['rotated']
+            continue
+
+        # start the file from the top, but first see if the data we haven't
+        # read yet went somewhere we can get to it
+        newlogdict[log] = get_file_identity(log, stats)
+        newlogdict[log]['log_pos'] = 0
+        if same_inode and file_size < old['log_pos']:
+            change = 'was truncated'
+        elif same_inode:
+            change = 'was overwritten'
+        else:
+            change = 'has a new inode'
+
+        rotated = find_rotated_file(log, old)
+        if rotated:
+            # remember where we got to in the old file so we can
+            # finish it off before starting on the new one
+            newlogdict[log]['rotated'] = {'path': rotated, 'log_pos': old['log_pos'],
+                                          'format': log_format}
+            util.write_log('%s %s, will finish %s first' % (log, change, rotated))
+        else:
+            util.write_log('%s %s, will scan' % (log, change))
 
     return newlogdict
 
-def run_scan():
-    # only create this once for the scan run
-    differ_db = differdb.DifferDB()
+def detect_formats(loglist, logdict):
+    """ Work out the parsers.LogFormat of logs we don't know it for yet.
+    It's kept in logdict, and so the state file, once we've seen enough
+    of a file to be sure; until then it's worked out again each time.
+    """
+    for log in loglist:
+        entry = logdict[log]
+        log_format = parsers.configured_format(log)
+        # not remembered, so it's looked at again if LOG_FORMATS changes
+        sure = False
+        if log_format is None:
+            if entry.get('format_sure') and entry.get('format') in parsers.FORMATS_BY_NAME:
+                continue
+            log_format, sure = parsers.detect_format(log)
+        if entry.get('format') != log_format:
+            util.write_log('%s looks like a %s log' % (log, log_format))
+        entry['format'] = log_format
+        entry['format_sure'] = sure
+
+def catch_up_rotated_logs(loglist, logdict, differ_db, store, digest, cycle):
+    """ Scan whatever was written to rotated logs after our last offset
+    and before logrotate moved them out of the way. These files aren't
+    growing any more, so they're read to the end in one go.
+    """
+    for log in loglist:
+        rotated = logdict[log].pop('rotated', None)
+        if not rotated:
+            continue
+
+        path = rotated['path']
+        if not os.path.exists(path) and os.path.exists(path + '.gz'):
+            # compressed since we last looked
+            path += '.gz'
+        if not os.path.exists(path):
+            util.write_log('rotated log %s has gone away, skipping it' % path)
+            continue
+
+        stats = cycle.file(path)
+        scan_file(path, differ_db, log_pos=rotated['log_pos'], db_inject=True,
+                  digest=digest, stats=stats,
+                  log_format=rotated.get('format') or parsers.GENERIC.name)
+
+        start = time.time()
+        differ_db.flush()
+        stats.sink_time += time.time() - start
+
+        start = time.time()
+        store.checkpoint(log, logdict[log])
+        stats.state_time += time.time() - start
+
+def update_log_position(logdict, log, log_pos, sink, store, stats):
+    # the rest of the file's identity was taken in update_logdict, before
+    # scanning, so it still describes the file log_pos is an offset into
+    logdict[log]['log_pos'] = log_pos
+    if log_pos and not logdict[log].get('fingerprint_len'):
+        # the file was empty when we took its fingerprint, so that tells
+        # us nothing; fingerprint what we've just read instead
+        fingerprint_len = min(log_pos, FINGERPRINT_BYTES)
+        logdict[log]['fingerprint'] = file_fingerprint(log, fingerprint_len)
+        logdict[log]['fingerprint_len'] = fingerprint_len
+
+    # the errors we found have to be safe before we record that we're
+    # past them
+    start = time.time()
+    sink.flush()
+    stats.sink_time += time.time() - start
+
+    start = time.time()
+    store.checkpoint(log, logdict[log])
+    stats.state_time += time.time() - start
+
+def scan_logs(loglist, logdict, differ_db, store, digest, cycle):
+    """ Scan each log in turn in this process.
+    """
+    for log in loglist:
+        stats = cycle.file(log)
+        log_pos = logdict[log]['log_pos']
+        log_pos, digest = scan_file(log, differ_db, log_pos=log_pos, db_inject=True,
+                                    max_bytes=MAX_SCAN_BYTES, digest=digest, stats=stats,
+                                    log_format=logdict[log]['format'])
+        update_log_position(logdict, log, log_pos, differ_db, store, stats)
+
+def scan_file_worker(task):
+    """ Runs inside a pool process. Nothing is written to the database
+    from here, the parsed errors are shipped back to the parent instead.
+    """
+    log, log_pos, log_format = task
+    records = []
+    stats = metrics.ScanStats()
+    new_pos, digest = scan_file(log, None, log_pos=log_pos, records=records,
+                                max_bytes=MAX_SCAN_BYTES, stats=stats, log_format=log_format)
+    return log, new_pos, digest, records, stats, os.getpid()
+
+_worker_pool = None
+
+def get_worker_pool():
+    global _worker_pool
+    if _worker_pool is None:
+        _worker_pool = multiprocessing.Pool(DIFFER_WORKERS)
+    return _worker_pool
+
+def scan_logs_parallel(loglist, logdict, differ_db, store, digest, cycle):
+    """ Shard the logs across DIFFER_WORKERS processes. Workers only do
+    the reading and regex work; injecting errors and updating logdict
+    stay in this process so there's one writer for both.
+    """
+    # hand out the biggest backlogs first so one straggler doesn't
+    # hold up the whole cycle
+    tasks = [(log, logdict[log]['log_pos'], logdict[log]['format']) for log in loglist]
+    tasks.sort(key=lambda task: logdict[task[0]].get('size', 0) - task[1], reverse=True)
+
+    throughput = {}
+    for result in get_worker_pool().imap_unordered(scan_file_worker, tasks):
+        log, log_pos, file_digest, records, stats, pid = result
+
+        start = time.time()
+        for record in records:
+            lolfly_error = differdb.LolflyError(log, differ_db)
+            lolfly_error.from_dict(record)
+            lolfly_error.differ_db_inject()
+        stats.sink_time += time.time() - start
+
+        digest.merge(file_digest)
+        update_log_position(logdict, log, log_pos, differ_db, store, stats)
+        cycle.file(log).merge(stats)
+
+        files, total_bytes, total_time = throughput.get(pid, (0, 0, 0.0))
+        throughput[pid] = (files + 1, total_bytes + stats.bytes, total_time + stats.scan_time)
+
+    for pid, (files, total_bytes, total_time) in sorted(throughput.items()):
+        rate = total_bytes / total_time / (1024 * 1024) if total_time else 0.0
+        util.write_log('worker %s scanned %s file(s), %s bytes in %.2f seconds (%.2f MB/s)' %
+                       (pid, files, total_bytes, total_time, rate))
+
+def get_changed_listing(changed):
+    """ Classify just the files that a watcher told us about, rather
+    than walking every target again.
+    """
+    loglist = []
+    largeloglist = []
+    file_stats = {}
+    discovery = get_discovery()
+    for filename in changed:
+        try:
+            stats = os.stat(filename)
+        except OSError:
+            continue
+        if stat.S_ISREG(stats.st_mode):
+            file_stats[filename] = stats
+            check_and_classify_file(filename, loglist, largeloglist, stats,
+                                    discovery.is_explicit(filename))
+
+    return loglist, largeloglist, file_stats
+
+_discovery = None
+_syslog = None
+_sink = None
+_spool = None
+_drainer = None
+_state_store = None
+
+def get_discovery():
+    """ Directory listings are kept from one scan to the next, so this
+    hangs around for the life of the process.
+    """
+    global _discovery
+    if _discovery is None:
+        _discovery = discovery.Discovery(is_log_file)
+    return _discovery
+
+def get_syslog():
+    """ One syslog client for the life of the process, over TCP if
+    DIFFER_SYSLOG_TCP is set.
+    """
+    global _syslog
+    if _syslog is None:
+        address = (DIFFERLOGHOST, DIFFER_SYSLOG_PORT)
+        if DIFFER_SYSLOG_TCP:
+            _syslog = syslog_client.syslog_stream_client(address,
+                                                         max_queue=DIFFER_SYSLOG_MAX_QUEUE)
+        else:
+            _syslog = syslog_client.syslog_client(address)
+    return _syslog
+
+def get_state_store():
+    global _state_store
+    if _state_store is None:
+        _state_store = statestore.StateStore(STATEFILE)
+    return _state_store
+
+def get_spool():
+    """ The spool everything we find gets written to, with its drainer
+    thread forwarding to the database, or a collector, in the background.
+    """
+    global _spool, _drainer
+    if _spool is None:
+        if DIFFER_WORKERS > 0:
+            # fork the workers while we're still single threaded, a
+            # child forked with the drainer running can inherit its locks
+            # held
+            get_worker_pool()
+        _spool = spool.DifferSpool()
+        if DIFFER_SINK == 'collector':
+            _drainer = spool.SpoolDrainer(_spool, collector.CollectorClient())
+        else:
+            _drainer = spool.SpoolDrainer(_spool)
+        _drainer.start()
+    return _spool
+
+def get_sink():
+    """ Where run_scan sends errors by default: the spool, with repeats
+    folded together up to each flush. The SpoolDrainer folds them over
+    DIFFER_AGGREGATE_SECONDS and rate limits them on the way to the
+    database, so nothing is held here that the state file has gone past.
+    """
+    global _sink
+    if _sink is None:
+        _sink = differdb.ErrorAggregator(get_spool(), max_age=0)
+    return _sink
+
+def run_scan(sink=None, changed=None):
+    """ Scan our targets and record any errors found. If changed is
+    given, only those files are looked at and the rest of the state
+    file is carried over untouched. Errors go to sink, anything with
+    add_differ_error and flush, by default get_sink().
+    """
+    if sink is None:
+        sink = get_sink()
 
-    loglist, largeloglist = file_scan()
-    error_msg = ''
+    if changed is None:
+        loglist, largeloglist, file_stats = file_scan()
+    else:
+        loglist, largeloglist, file_stats = get_changed_listing(changed)
+    digest = ErrorDigest()
+    cycle = metrics.CycleStats()
 
-    # process log files that are too big
+    # log files that are too big get streamed like the rest, MAX_SCAN_BYTES
+    # at a time, so they may take a few cycles to catch up
     for log in largeloglist:
-        error_msg = error_msg + alert_large_log(log, differ_db, db_inject=True)
+        util.write_log('%s is over %s bytes, streaming it' % (log, MAX_FILE_SIZE))
+    loglist = loglist + largeloglist
 
     # Each time we run, we want to re-build our log dictionary. This
     # helps to ensure we don't carry over stale data.
-    logdict = get_log_dict(STATEFILE)
-    logdict = update_logdict(loglist, logdict)
+    store = get_state_store()
+    logdict = store.load()
+    if changed is None:
+        logdict = update_logdict(loglist, logdict, file_stats)
+    else:
+        logdict.update(update_logdict(loglist, logdict, file_stats))
 
-    for log in loglist:
-        log_pos = logdict[log]['log_pos']
-        log_pos, error_log = scan_file(log, differ_db, log_pos=log_pos, db_inject=True)
+    detect_formats(loglist, logdict)
+    catch_up_rotated_logs(loglist, logdict, sink, store, digest, cycle)
+
+    if DIFFER_WORKERS > 0:
+        scan_logs_parallel(loglist, logdict, sink, store, digest, cycle)
+    else:
+        scan_logs(loglist, logdict, sink, store, digest, cycle)
 
-        if error_log:
-            error_msg += '==> Start errors from : %s\n' % log
-            error_msg += error_log
-            error_msg += '==> End errors from %s\n' % log
+    util.write_log('%s error(s) in %s file(s), %s bytes of samples kept, peak rss %s KB' %
+                   (digest.count, len(digest.files), digest.size, util.get_peak_rss()))
+    submit_errors(digest)
 
-        stats = os.stat(log)
-        inode = stats[stat.ST_INO]
-        logdict[log]['log_pos'] = log_pos
-        logdict[log]['inode'] = inode
+    # each file's errors were flushed before its checkpoint; this is for
+    # anything a sink passed in by the caller is still holding
+    sink.flush()
 
-    submit_errors(error_msg)
-    write_log_dict(STATEFILE, logdict)
+    # each file was checkpointed as we went; a full scan also compacts
+    # the state file, dropping files that have gone away, and so does any
+    # scan once the journal has grown big enough
+    save_time = 0.0
+    if changed is None or store.journal_size() > STATE_JOURNAL_MAX_BYTES:
+        start = time.time()
+        store.save(logdict)
+        save_time = time.time() - start
 
+    cycle.finish()
+    report_stats(cycle, full_scan=changed is None, save_time=save_time,
+                 peak_rss=util.get_peak_rss())
 
-def main():
+def report_stats(cycle, **extra):
+    """ Write out the cycle's metrics.CycleStats, along with how the
+    spool is doing, and send them to syslog if we've been asked to.
+    """
+    if _spool is not None:
+        extra['spool_bytes'] = _spool.size()
+    if _drainer is not None:
+        extra['db_rows'] = _drainer.rows_sent
+        extra['db_failures'] = _drainer.failures
+        extra['db_time'] = _drainer.db_time
+
+    try:
+        cycle.write(**extra)
+    except (IOError, OSError), e:
+        util.write_log('unable to write %s: %s' % (DIFFER_STATS_FILE, e))
+
+    if DIFFER_STATS_SYSLOG:
+        try:
+            cycle.send(get_syslog())
+        except socket.error, e:
+            util.write_log('unable to send stats to %s: %s' % (DIFFERLOGHOST, e))
+
+    # whatever the socket won't take now waits for the next cycle
+    get_syslog().flush()
+
+
+def poll_main():
     """ Just your run of the mill basic loop. All the logic is elsewhere
     so that it can get pulled into another script and still make sense
     """
@@ -358,6 +731,50 @@ def main():
         util.write_log('scan finished in %s seconds, sleeping' % duration)
         time.sleep(DIFFER_LOOP_TIME)
 
+def watch_main():
+    """ Event driven loop. Sleeps on inotify and only scans the files
+    that changed. A full scan still happens on startup, whenever the
+    watcher thinks it may have missed events, and every
+    DIFFER_WATCH_RESCAN_TIME seconds as a safety net.
+    """
+    # glob and recursive targets aren't directories we can watch as
+    # they are, so find out what they stand for first
+    get_discovery().scan(TARGETS)
+    log_watcher = watcher.LogWatcher(get_discovery().watch_targets())
+    sink = get_sink()
+
+    last_full_scan = 0
+    while True:
+        now = time.time()
+        if log_watcher.rescan or now - last_full_scan >= DIFFER_WATCH_RESCAN_TIME:
+            util.write_log('starting full scan')
+            run_scan(sink)
+            last_full_scan = time.time()
+            # watch every directory the scan walked, which covers
+            # recursive and glob targets as well as plain ones
+            log_watcher.set_targets(get_discovery().watch_targets())
+            util.write_log('watching %s directories' % len(log_watcher.watches))
+            util.write_log('full scan finished in %s seconds' % (last_full_scan - now))
+
+        timeout = max(0, last_full_scan + DIFFER_WATCH_RESCAN_TIME - time.time())
+        changed = log_watcher.wait(timeout, DIFFER_WATCH_COALESCE_TIME)
+        if changed and not log_watcher.rescan:
+            start = time.time()
+            run_scan(sink, changed)
+            util.write_log('scanned %s changed file(s) in %s seconds' %
+                           (len(changed), time.time() - start))
+
+def main():
+    """ Prefer waiting on inotify for changes, and fall back to the
+    polling loop when that isn't possible.
+    """
+    if DIFFER_USE_INOTIFY:
+        try:
+            watch_main()
+        except watcher.InotifyUnavailable, e:
+            util.write_log('inotify unavailable (%s), falling back to polling' % e)
+    poll_main()
+
 if __name__ == '__main__':
     if len(sys.argv) > 1 and sys.argv[1]:
         differ_db = differdb.DifferDB()
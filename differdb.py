@@ -34,6 +34,8 @@ with the differ database and tables.
 
 '''
 
+import hashlib
+import re
 import sqlalchemy
 import time
 
@@ -42,6 +44,7 @@ import util
 from settings import *
 
 LEN_CODE_METHOD = 32
+LEN_EXCEPTION = 64
 LEN_PRODUCT = 8
 
 DEBUG, INFO, WARNING, ERROR, CRITICAL = range(10, 51, 10) # based on logging
@@ -51,8 +54,184 @@ def get_log_type(error_msg):
         return WARNING
     return ERROR
 
+INSERT_QUERIES = dict((table_name, sqlalchemy.sql.text("""
+     INSERT INTO %s (timestamp, host,
+         logfile, product, code_location, code_method, error_message, exception,
+         fingerprint, occurrences, first_seen, last_seen) 
+     VALUES (:timestamp, :host, :logfile, :product, :code_location, :code_method,
+         :error_message, :exception, :fingerprint, :occurrences, :first_seen, :last_seen)
+""" % table_name)) for table_name in ('differ_errors', 'differ_warnings'))
+
+def hash_parts(parts):
+    """ Hex md5 of parts joined by NUL bytes, None counting as ''.
+    """
+    parts = [part.encode('utf-8') if isinstance(part, unicode) else part or ''
+             for part in parts]
+    return hashlib.md5('\0'.join(parts)).hexdigest()
+
+# counts per fingerprint are kept in buckets of each of these many seconds,
+# see migrations/0005_rollups.sql. Each has to be a multiple of the last
+ROLLUP_TIERS = sorted(DIFFER_ROLLUP_KEEP)
+
+TABLE_LEVELS = {'differ_errors': ERROR, 'differ_warnings': WARNING}
+
+GROUP_QUERY = sqlalchemy.sql.text("""
+     INSERT INTO differ_groups (level, fingerprint, product, code_location, code_method,
+         exception, error_message, logfile, host, first_seen, last_seen)
+     VALUES (:level, :fingerprint, :product, :code_location, :code_method,
+         :exception, :error_message, :logfile, :host, :first_seen, :last_seen)
+     ON DUPLICATE KEY UPDATE first_seen = LEAST(first_seen, VALUES(first_seen)),
+         last_seen = GREATEST(last_seen, VALUES(last_seen))
+""")
+
+ROLLUP_QUERY = sqlalchemy.sql.text("""
+     INSERT INTO differ_rollups (level, tier, bucket, fingerprint, occurrences)
+     VALUES (:level, :tier, :bucket, :fingerprint, :occurrences)
+     ON DUPLICATE KEY UPDATE occurrences = occurrences + VALUES(occurrences)
+""")
+
+# how far a spool has been drained, see migrations/0006_drain_positions.sql
+DRAIN_POSITION_QUERY = sqlalchemy.sql.text("""
+     INSERT INTO differ_drain_positions (spool_id, segment, segment_offset)
+     VALUES (:spool_id, :segment, :segment_offset)
+     ON DUPLICATE KEY UPDATE segment = VALUES(segment),
+         segment_offset = VALUES(segment_offset)
+""")
+
+SIGNATURE_TIMES = re.compile('|'.join('(?:%s)' % fmt for fmt in SIGNATURE_TIME_FORMATS))
+
+def error_signature(exception, code_location, code_method, error_message=None):
+    """ What makes two errors "the same one". Errors with an exception are
+    keyed on where it was raised; for anything else we only have the
+    message to go on, less the timestamps in it.
+    """
+    if exception:
+        return hash_parts((exception, code_location, code_method))
+    if error_message:
+        error_message = SIGNATURE_TIMES.sub('', error_message)
+    return hash_parts((code_location, code_method, error_message))
+
+def error_fingerprint(product, code_location, code_method, exception):
+    """ The fingerprint column: which group lolfly files a row under. It's
+    worked out from the values as they're stored, after make_error_row
+    has cut them down, and migrations/0004_fingerprint.sql does the same
+    sum in SQL.
+    """
+    return hash_parts((product, code_location, code_method, exception))
+
+def make_error_row(logfile, product, code_location, code_method, error_message,
+                   exception, timestamp, host, occurrences=1, first_seen=None,
+                   last_seen=None):
+    """ Returns the table a differ error belongs in and the parameters
+    for inserting it there. A row can stand for several occurrences of
+    the same error, seen between first_seen and last_seen.
+    """
+    query_dict = {}
+    query_dict['logfile'] = logfile
+    if product:
+        product = product[:LEN_PRODUCT]
+    query_dict['product'] = product
+    query_dict['code_location'] = code_location
+    if code_method:
+        code_method = code_method[:LEN_CODE_METHOD]
+    query_dict['code_method'] = code_method
+    query_dict['error_message'] = error_message
+    if exception:
+        exception = exception[:LEN_EXCEPTION]
+    query_dict['exception'] = exception
+    query_dict['fingerprint'] = error_fingerprint(product, code_location, code_method,
+                                                  exception)
+    query_dict['timestamp'] = timestamp
+    query_dict['host'] = host
+    query_dict['occurrences'] = occurrences
+    query_dict['first_seen'] = first_seen or timestamp
+    query_dict['last_seen'] = last_seen or timestamp
+    table_name = ('differ_errors' if get_log_type(error_message) >= ERROR
+                    else 'differ_warnings')
+    return table_name, query_dict
+
+def rollup_rows(level, rows, tiers=ROLLUP_TIERS):
+    """ What rows from make_error_row add to differ_groups and
+    differ_rollups, as (group rows, rollup rows). Each is in key order,
+    so writers taking the same row locks take them in the same order.
+    """
+    groups = {}
+    counts = {}
+    for row in rows:
+        fingerprint = row['fingerprint']
+        group = groups.get(fingerprint)
+        if group is None:
+            groups[fingerprint] = {'level': level, 'fingerprint': fingerprint,
+                                   'product': row['product'],
+                                   'code_location': row['code_location'],
+                                   'code_method': row['code_method'],
+                                   'exception': row['exception'],
+                                   'error_message': row['error_message'],
+                                   'logfile': row['logfile'], 'host': row['host'],
+                                   'first_seen': row['first_seen'],
+                                   'last_seen': row['last_seen']}
+        else:
+            group['first_seen'] = min(group['first_seen'], row['first_seen'])
+            group['last_seen'] = max(group['last_seen'], row['last_seen'])
+
+        timestamp = row['timestamp']
+        for tier in tiers:
+            key = (tier, timestamp - timestamp % tier, fingerprint)
+            counts[key] = counts.get(key, 0) + row['occurrences']
+
+    rollups = [{'level': level, 'tier': tier, 'bucket': bucket,
+                'fingerprint': fingerprint, 'occurrences': counts[tier, bucket, fingerprint]}
+               for tier, bucket, fingerprint in sorted(counts)]
+    return [groups[fingerprint] for fingerprint in sorted(groups)], rollups
+
+def bucket_ranges(start, end, tiers=ROLLUP_TIERS):
+    """ The rollup buckets that add up to the counts from start to end,
+    as [(tier, first bucket, end)]: the biggest buckets that fit, and
+    smaller ones at the edges. start is taken back and end forward to the
+    smallest bucket, so the first and last can stick out of the window.
+    An empty window has no buckets.
+    """
+    if start >= end:
+        return []
+    smallest = tiers[0]
+    start -= start % smallest
+    if end % smallest:
+        end += smallest - end % smallest
+    return _cover(int(start), int(end), list(reversed(tiers)))
+
+def _cover(start, end, tiers):
+    if start >= end:
+        return []
+    tier = tiers[0]
+    if len(tiers) == 1:
+        return [(tier, start, end)]
+    first = start + (-start % tier)
+    last = end - end % tier
+    if first >= last:
+        return _cover(start, end, tiers[1:])
+    return _cover(start, first, tiers[1:]) + [(tier, first, last)] + \
+           _cover(last, end, tiers[1:])
+
+def bucket_clause(ranges):
+    """ SQL matching the differ_rollups rows (as r) in ranges from
+    bucket_ranges, and the parameters for it.
+    """
+    clauses = []
+    query_dict = {}
+    for number, (tier, first, last) in enumerate(ranges):
+        clauses.append('(r.tier = :tier%d AND r.bucket >= :first%d AND r.bucket < :last%d)' %
+                       (number, number, number))
+        query_dict['tier%d' % number] = tier
+        query_dict['first%d' % number] = first
+        query_dict['last%d' % number] = last
+    return ' OR '.join(clauses) or '1 = 0', query_dict
+
+
 class LolflyError(object):
 
+    fields = ('file_name', 'timestamp', 'product', 'revision', 'error_msg',
+              'line_number', 'location', 'method', 'exception')
+
     def __init__(self, filename, differ_db):
         self.differ_db = differ_db
         self.file_name = filename # name of the file where the error occurred
@@ -67,6 +246,16 @@ class LolflyError(object):
         self.location = None # the location of the error
         self.method = None # the method where the error occurred
 
+    def to_dict(self):
+        """ Plain dict of the parsed fields, handy for shipping an error
+        between processes.
+        """
+        return dict((field, getattr(self, field, None)) for field in self.fields)
+
+    def from_dict(self, values):
+        for field in self.fields:
+            setattr(self, field, values.get(field))
+
     def print_pretty(self):
         print ("%s,%s,%s,%s,%s,%s" % (self.file_name, 
                                       self.product, 
@@ -89,6 +278,10 @@ class DifferDB(object):
     """ Basic DB class for interacting with our database. 
     Provides an initial database object so that we can easily re-use
     the database connection.
+
+    The queries here have indexes made for them, see migrations/. A new
+    query (or a new WHERE on an old one) should come with a migration
+    for the index it needs.
     """
 
     def __init__(self, dbhost=DIFFERDBHOST, dbuser=DIFFERDBUSER, dbpasswd=DIFFERDBPASSWD, db=DIFFERDB):
@@ -99,54 +292,107 @@ class DifferDB(object):
 
 
     def add_differ_error(self, logfile, product, code_location, code_method, error_message, 
-                         exception, timestamp, host):
+                         exception, timestamp, host, occurrences=1, first_seen=None,
+                         last_seen=None):
         """ add_differ_error is intended to be used by the various differ
         clients. Once they encounter an error and do their parsing, this
         function is used for entering that data into the database.
         """
-        query_dict = {}
-        query_dict['logfile'] = logfile
-        if product:
-            product = product[:LEN_PRODUCT]
-        query_dict['product'] = product
-        query_dict['code_location'] = code_location
-        if code_method:
-            code_method = code_method[:LEN_CODE_METHOD]
-        query_dict['code_method'] = code_method
-        query_dict['error_message'] = error_message
-        query_dict['exception'] = exception
-        query_dict['timestamp'] = timestamp
-        query_dict['host'] = host
-        table_name = ('differ_errors' if get_log_type(error_message) >= ERROR
-                        else 'differ_warnings')
-        query = sqlalchemy.sql.text("""
-             INSERT INTO %s (timestamp, host,
-                 logfile, product, code_location, code_method, error_message, exception) 
-             VALUES (:timestamp, :host, :logfile, :product, :code_location, :code_method,
-                 :error_message, :exception)
-        """ % table_name)
+        table_name, query_dict = make_error_row(logfile, product, code_location, code_method,
+                                                error_message, exception, timestamp, host,
+                                                occurrences, first_seen, last_seen)
+        self.insert_rows(table_name, [query_dict])
+
+
+    def flush(self):
+        """ Rows go straight in as they're added, so there's nothing to
+        flush. Here so DifferDB can be used anywhere a spool can.
+        """
+        pass
+
+
+    def insert_rows(self, table_name, rows):
+        """ insert_rows writes a list of rows from make_error_row into
+        table_name. A list of parameters turns into an executemany, which
+        MySQLdb sends as a single multi-row INSERT. It goes through
+        insert_tables, so a retry never counts rows twice in the rollups.
+        """
         attempts = 0
         while attempts < 5:
              attempts += 1
              try:
-                 self.engine.execute(query, query_dict)
+                 self.insert_tables({table_name: rows})
                  break
              except sqlalchemy.exceptions.OperationalError, e:
                  util.write_log('%s' % e)
                  time.sleep(attempts*2) 
 
 
+    def insert_tables(self, tables, drain_position=None):
+        """ insert_tables writes {table_name: rows} in one transaction, so
+        either all of it makes it in or none of it does, along with what
+        they add to differ_groups and differ_rollups. Unlike insert_rows
+        it doesn't retry, errors are left to the caller.
+        drain_position is a dict of spool_id, segment and segment_offset
+        to record in the same transaction, see get_drain_position.
+        """
+        connection = self.engine.connect()
+        try:
+            transaction = connection.begin()
+            try:
+                for table_name, rows in sorted(tables.items()):
+                    if rows:
+                        connection.execute(INSERT_QUERIES[table_name], rows)
+                        groups, rollups = rollup_rows(TABLE_LEVELS[table_name], rows)
+                        connection.execute(GROUP_QUERY, groups)
+                        connection.execute(ROLLUP_QUERY, rollups)
+                if drain_position is not None:
+                    connection.execute(DRAIN_POSITION_QUERY, drain_position)
+                transaction.commit()
+            except:
+                transaction.rollback()
+                raise
+        finally:
+            connection.close()
+
+
+    def insert_records(self, records, drain_position=None):
+        """ insert_records writes a list of add_differ_error argument
+        dicts in one transaction, by way of insert_tables.
+        """
+        tables = {}
+        for record in records:
+            table_name, query_dict = make_error_row(**record)
+            tables.setdefault(table_name, []).append(query_dict)
+        self.insert_tables(tables, drain_position)
+
+
+    def get_drain_position(self, spool_id):
+        """ get_drain_position
+        Returns the (segment, offset) the spool spool_id was last drained
+        up to, or None if nothing from it has gone in yet.
+        """
+        query = sqlalchemy.sql.text("""
+             SELECT segment, segment_offset
+             FROM differ_drain_positions
+             WHERE spool_id = :spool_id""")
+        row = self.engine.execute(query, {'spool_id': spool_id}).fetchone()
+        if row is None:
+            return None
+        return int(row[0]), int(row[1])
+
+
     def get_grouped_unfiled_exceptions(self):
         """ get_grouped_unfiled_exceptions
         same as get_unfiled_exceptions, except we try to do some grouping here
         """
         query = """
-             SELECT count(*) as count,product,code_location,code_method,
+             SELECT SUM(occurrences) as count,fingerprint,product,code_location,code_method,
                  exception,error_message,logfile,host
              FROM differ_errors 
              WHERE fbz_case IS NULL 
              AND exception IS NOT NULL 
-             GROUP BY product,code_location,code_method,exception
+             GROUP BY fingerprint
         """
         results = self.engine.execute(query)
         return results
@@ -162,7 +408,7 @@ class DifferDB(object):
         """
         query = sqlalchemy.sql.text("""
              SELECT id, timestamp, host, logfile, product, 
-                 code_location, code_method, exception, error_message 
+                 code_location, code_method, exception, error_message, occurrences
              FROM differ_errors 
              WHERE fbz_case IS NULL AND exception IS NULL 
              LIMIT :limit""")
@@ -178,16 +424,23 @@ class DifferDB(object):
         Takes two args:
         start : epoch time of the start
         product : the product you want to summarize [optional]
+        The counts come from differ_rollups, so start is to the minute, and
+        they're every occurrence of a group that has a case, those seen
+        since it was filed too. Errors without an exception are grouped by
+        fingerprint under the case filed last, not per row.
         """
+        clause, query_dict = bucket_clause(bucket_ranges(start, time.time()))
         query = sqlalchemy.sql.text("""
-             SELECT count(*) as count, product, code_location, code_method,
-                 exception, fbz_case, error_message
-             FROM differ_errors
-             WHERE product LIKE :product AND fbz_case IS NOT NULL AND timestamp > :start
-             GROUP BY fbz_case
+             SELECT SUM(r.occurrences) as count, g.product, g.code_location, g.code_method,
+                 g.exception, g.fbz_case, g.error_message
+             FROM differ_rollups r
+             JOIN differ_groups g ON g.level = r.level AND g.fingerprint = r.fingerprint
+             WHERE r.level = :level AND (%s)
+                 AND g.product LIKE :product AND g.fbz_case IS NOT NULL
+             GROUP BY g.fbz_case
              ORDER BY count desc
-        """)
-        query_dict = {'start': start, 'product': product}
+        """ % clause)
+        query_dict.update({'level': ERROR, 'product': product})
         results = self.engine.execute(query, query_dict)
         return results
 
@@ -202,19 +455,22 @@ class DifferDB(object):
 
         Returns:
 
-            An SQL Alchemy result set
+            An SQL Alchemy result set, counted from differ_rollups so
+            ``start`` is to the minute
 
         '''
 
+        clause, query_dict = bucket_clause(bucket_ranges(start, time.time()))
         query = sqlalchemy.sql.text("""
-             SELECT count(*) as count,product,code_location,code_method,
-                 exception,error_message,logfile,host
-             FROM differ_warnings
-             WHERE product LIKE :product AND timestamp > :start
-             GROUP BY product,code_location,code_method,exception
+             SELECT SUM(r.occurrences) as count,g.fingerprint,g.product,g.code_location,
+                 g.code_method,g.exception,g.error_message,g.logfile,g.host
+             FROM differ_rollups r
+             JOIN differ_groups g ON g.level = r.level AND g.fingerprint = r.fingerprint
+             WHERE r.level = :level AND (%s) AND g.product LIKE :product
+             GROUP BY g.fingerprint
              ORDER BY count DESC
-        """)
-        query_dict = {'start': start, 'product': product}
+        """ % clause)
+        query_dict.update({'level': WARNING, 'product': product})
         results = self.engine.execute(query, query_dict)
         return results
 
@@ -234,53 +490,161 @@ class DifferDB(object):
         query_dict['fbz_case'] = fbz_case
         self.engine.execute(query, query_dict)
 
+        query = sqlalchemy.sql.text("""
+             UPDATE differ_groups
+             SET fbz_case=:fbz_case
+             WHERE level=:level AND fingerprint=
+                 (SELECT fingerprint FROM differ_errors WHERE id=:errorid)
+        """)
+        query_dict['level'] = ERROR
+        self.engine.execute(query, query_dict)
+
 
-    def update_group_case_id(self, fbz_case, code_location, code_method, exception):
+    def update_group_case_id(self, fbz_case, fingerprint):
+        """ update_group_case_id
+        Files every unfiled row with the fingerprint under fbz_case, and
+        the group in differ_groups along with them.
+        """
         query = sqlalchemy.sql.text("""
              UPDATE differ_errors 
              SET fbz_case=:fbz_case 
-             WHERE code_location=:code_location AND code_method=:code_method 
-               AND exception=:exception AND fbz_case IS NULL
+             WHERE fingerprint=:fingerprint AND fbz_case IS NULL
         """)
         query_dict = {}
         query_dict['fbz_case'] = fbz_case
-        query_dict['code_location'] = code_location
-        query_dict['code_method'] = code_method
-        query_dict['exception'] = exception
+        query_dict['fingerprint'] = fingerprint
+        self.engine.execute(query, query_dict)
+
+        query = sqlalchemy.sql.text("""
+             UPDATE differ_groups
+             SET fbz_case=:fbz_case
+             WHERE level=:level AND fingerprint=:fingerprint
+        """)
+        query_dict['level'] = ERROR
         self.engine.execute(query, query_dict)
 
 
-    def update_group_product(self, product, fbz_case, code_location, code_method, exception):
+    def update_group_product(self, product, fbz_case, fingerprint):
+        """ update_group_product
+        Sets the product of the rows with the fingerprint that were just
+        filed under fbz_case. fingerprint stays what it was at insert.
+        """
         query = sqlalchemy.sql.text("""
              UPDATE differ_errors
              SET product=:product
-             WHERE code_location=:code_location AND code_method=:code_method 
-               AND exception=:exception AND fbz_case=:fbz_case
+             WHERE fingerprint=:fingerprint AND fbz_case=:fbz_case
         """)
         query_dict = {}
         query_dict['fbz_case'] = fbz_case
-        query_dict['code_location'] = code_location
-        query_dict['code_method'] = code_method
-        query_dict['exception'] = exception
+        query_dict['fingerprint'] = fingerprint
         if product:
             product = product[:LEN_PRODUCT]
         query_dict['product'] = product
         self.engine.execute(query, query_dict)
 
+        query = sqlalchemy.sql.text("""
+             UPDATE differ_groups
+             SET product=:product
+             WHERE level=:level AND fingerprint=:fingerprint AND fbz_case=:fbz_case
+        """)
+        query_dict['level'] = ERROR
+        self.engine.execute(query, query_dict)
+
 
     def error_count(self, duration):
-        """ just return the number of errors over the past X seconds
+        """ just return the number of errors over the past X seconds, to
+        the minute
         """
         current = int(time.time())
         start = current - duration
+        clause, query_dict = bucket_clause(bucket_ranges(start, current))
         query = sqlalchemy.sql.text("""
-             SELECT count(*) FROM differ_errors WHERE timestamp > :start
-        """)
-        query_dict = {}
-        query_dict['start'] = start
+             SELECT COALESCE(SUM(r.occurrences), 0) FROM differ_rollups r
+             WHERE r.level = :level AND (%s)
+        """ % clause)
+        query_dict['level'] = ERROR
         results = self.engine.execute(query, query_dict).scalar()
         return results
 
 
+    def prune_rollups(self, keep=DIFFER_ROLLUP_KEEP):
+        """ prune_rollups
+        Deletes the differ_rollups buckets older than DIFFER_ROLLUP_KEEP
+        says to keep them. lolfly runs it every time through.
+        """
+        current = int(time.time())
+        query = sqlalchemy.sql.text("""
+             DELETE FROM differ_rollups
+             WHERE level=:level AND tier=:tier AND bucket < :before
+        """)
+        for tier, seconds in sorted(keep.items()):
+            if seconds is None:
+                continue
+            for level in sorted(TABLE_LEVELS.values()):
+                query_dict = {'level': level, 'tier': tier, 'before': current - seconds}
+                self.engine.execute(query, query_dict)
+
+
     def close_connection(self):
         self.engine.dispose()
+
+
+class ErrorAggregator(object):
+    """ Folds repeats of the same error together before they go on to
+    sink. Within each window of max_age seconds, every signature from a
+    log file goes out as a single row: the first message seen, how many
+    times it happened and when it was first and last seen. One exception
+    in a hot code path turns into a row a minute rather than a row a
+    request.
+
+    Rows still waiting on their window are only in memory, so whatever
+    they came from has to be kept until they've been sent on. differ
+    puts one with max_age of 0, which forwards every group on each
+    flush(), in front of the spool, where it folds the repeats in each
+    file it scans. The SpoolDrainer keeps the window itself and only
+    lets go of the spooled records once their rows are in.
+    """
+
+    def __init__(self, sink, max_age=DIFFER_AGGREGATE_SECONDS,
+                 max_groups=DIFFER_AGGREGATE_MAX_GROUPS):
+        self.sink = sink
+        self.max_age = max_age
+        self.max_groups = max_groups
+        self.groups = {}
+
+    def add_differ_error(self, logfile, product, code_location, code_method, error_message,
+                         exception, timestamp, host, occurrences=1, first_seen=None,
+                         last_seen=None):
+        first_seen = first_seen or timestamp
+        last_seen = last_seen or timestamp
+        key = (logfile, product, host, get_log_type(error_message),
+               error_signature(exception, code_location, code_method, error_message))
+
+        group = self.groups.get(key)
+        if group is None:
+            self.groups[key] = {'logfile': logfile, 'product': product,
+                                'code_location': code_location, 'code_method': code_method,
+                                'error_message': error_message, 'exception': exception,
+                                'timestamp': first_seen, 'host': host,
+                                'occurrences': occurrences, 'first_seen': first_seen,
+                                'last_seen': last_seen, 'opened': time.time()}
+        else:
+            group['occurrences'] += occurrences
+            group['first_seen'] = min(group['first_seen'], first_seen)
+            group['last_seen'] = max(group['last_seen'], last_seen)
+
+        if len(self.groups) >= self.max_groups:
+            self.flush(force=True)
+
+    def flush(self, force=False):
+        """ Forward every group whose window has closed, or all of them if
+        force is set, then flush the sink.
+        """
+        now = time.time()
+        for key, group in self.groups.items():
+            if force or now - group['opened'] >= self.max_age:
+                del self.groups[key]
+                del group['opened']
+                group['timestamp'] = group['first_seen']
+                self.sink.add_differ_error(**group)
+        self.sink.flush()
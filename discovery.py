@@ -0,0 +1,245 @@
+'''
+Copyright (c) 2012 Lolapps, Inc. All rights reserved.
+
+Redistribution and use in source and binary forms, with or without modification, are
+permitted provided that the following conditions are met:
+
+   1. Redistributions of source code must retain the above copyright notice, this list of
+      conditions and the following disclaimer.
+
+   2. Redistributions in binary form must reproduce the above copyright notice, this list
+      of conditions and the following disclaimer in the documentation and/or other materials
+      provided with the distribution.
+
+THIS SOFTWARE IS PROVIDED BY LOLAPPS, INC. ''AS IS'' AND ANY EXPRESS OR IMPLIED
+WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND
+FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL LOLAPPS, INC. OR
+CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON
+ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+The views and conclusions contained in the software and documentation are those of the
+authors and should not be interpreted as representing official policies, either expressed
+or implied, of Lolapps, Inc..
+
+--------------------------------------------------------------------------------------------
+
+discovery.py
+
+Works out which files differ should look at. Entries in TARGETS can be:
+
+  a file                 scanned whatever its name
+  a directory            the files in it are candidates
+  a directory + '/**'    the same, but every directory below it as well
+  a glob pattern         whatever files or directories it matches, as
+                         if each had been listed on its own
+
+Every file is stat'ed once a cycle, and the stat results are handed on
+so nothing else has to stat it again. Directory listings are kept
+between cycles and only read again when the directory's mtime changes,
+and names are filtered before anything is stat'ed, so the thousands of
+rotated .gz files in a log directory cost nothing. scandir is used when
+it's installed (or built in), which saves a stat per subdirectory.
+
+'''
+
+import fnmatch
+import glob
+import os
+import stat
+import time
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+RECURSIVE_SUFFIX = '/**'
+
+# a directory changed this recently may change again within the same
+# mtime tick, which we couldn't see, so its listing isn't trusted
+LISTING_SLACK = 2
+
+def split_target(target):
+    """ Returns the target without any RECURSIVE_SUFFIX, and whether it
+    had one.
+    """
+    if target.endswith(RECURSIVE_SUFFIX):
+        return target[:-len(RECURSIVE_SUFFIX)], True
+    return target, False
+
+class Discovery(object):
+    """ Finds the files under a set of targets, remembering directory
+    listings from one scan to the next.
+
+    wanted(path) decides, from its name alone, whether a file found in a
+    directory is worth a stat. Files named by a target are always taken.
+    """
+
+    def __init__(self, wanted):
+        self.wanted = wanted
+        self.listings = {} # directory -> (mtime, file names, subdirectory names)
+        self.directories = set() # every directory looked in by the last scan
+        self.explicit = set() # files named by a target in the last scan
+        self.globs = []
+
+    def scan(self, targets):
+        """ Returns {path: stat result} for every file under targets, and
+        the set of those that targets named directly.
+        """
+        files = {}
+        explicit = set()
+        directories = set()
+        globs = []
+
+        # recursive targets first, so a directory that's also a plain
+        # target is still walked into
+        for target in sorted(targets, key=lambda target: not split_target(target)[1]):
+            target, recursive = split_target(target)
+            if glob.has_magic(target):
+                globs.append(target)
+                paths = glob.glob(target)
+            else:
+                paths = [target]
+
+            for path in paths:
+                try:
+                    stats = os.stat(path)
+                except OSError:
+                    continue
+                if stat.S_ISDIR(stats.st_mode):
+                    self.walk(path, stats, recursive, files, directories)
+                elif stat.S_ISREG(stats.st_mode):
+                    files[path] = stats
+                    explicit.add(path)
+
+        # forget about directories that have gone away or stopped being
+        # targets
+        for directory in self.listings.keys():
+            if directory not in directories:
+                del self.listings[directory]
+
+        self.directories = directories
+        self.explicit = explicit
+        self.globs = globs
+        return files, explicit
+
+    def is_explicit(self, path):
+        """ Whether a file was named by a target, as of the last scan or
+        by matching one of its glob patterns.
+        """
+        if path in self.explicit:
+            return True
+        for pattern in self.globs:
+            if fnmatch.fnmatch(path, pattern):
+                return True
+        return False
+
+    def watch_targets(self):
+        """ What a watcher.LogWatcher needs to watch to hear about
+        everything the last scan found.
+        """
+        return self.directories | self.explicit
+
+    def walk(self, directory, stats, recursive, files, directories):
+        pending = [(directory, stats)]
+        while pending:
+            directory, stats = pending.pop()
+            if directory in directories:
+                # overlapping targets, or a symlink loop
+                continue
+            directories.add(directory)
+
+            pending.extend(self.list_directory(directory, stats, recursive, files))
+
+    def list_directory(self, directory, stats, recursive, files):
+        """ Add the wanted files in directory to files, with their stat
+        results. If recursive, returns the (path, stat result) of each
+        subdirectory.
+        """
+        cached = self.listings.get(directory)
+        if cached and cached[0] == stats.st_mtime and \
+           time.time() - stats.st_mtime > LISTING_SLACK:
+            mtime, names, subdirectory_names = cached
+            subdirectories = []
+            for name in names:
+                path = os.path.join(directory, name)
+                try:
+                    files[path] = os.stat(path)
+                except OSError:
+                    # removed without the directory's mtime changing
+                    # under us, it'll be picked up next time it does
+                    continue
+            for name in subdirectory_names if recursive else ():
+                path = os.path.join(directory, name)
+                try:
+                    subdirectories.append((path, os.stat(path)))
+                except OSError:
+                    continue
+            return subdirectories
+
+        names = []
+        subdirectory_names = []
+        subdirectories = []
+        for name, path, is_dir, entry_stats in self.read_directory(directory, recursive):
+            if is_dir:
+                subdirectory_names.append(name)
+                if recursive:
+                    subdirectories.append((path, entry_stats))
+            elif entry_stats is not None and stat.S_ISREG(entry_stats.st_mode):
+                names.append(name)
+                files[path] = entry_stats
+
+        self.listings[directory] = (stats.st_mtime, names, subdirectory_names)
+        return subdirectories
+
+    def read_directory(self, directory, recursive):
+        """ Yields (name, path, is a directory, stat result) for the
+        entries in directory that are directories or wanted files. Files
+        that aren't wanted don't get stat'ed, and with scandir neither do
+        directories unless we're going into them.
+        """
+        try:
+            if scandir is not None:
+                entries = scandir(directory)
+            else:
+                entries = os.listdir(directory)
+        except OSError:
+            return
+
+        for entry in entries:
+            if scandir is not None:
+                name = entry.name
+                path = entry.path
+                try:
+                    is_dir = entry.is_dir()
+                except OSError:
+                    continue
+            else:
+                name = entry
+                path = os.path.join(directory, name)
+                is_dir = None
+
+            if is_dir is False and not self.wanted(path):
+                continue
+            if is_dir and not recursive:
+                yield name, path, is_dir, None
+                continue
+
+            try:
+                entry_stats = os.stat(path) if scandir is None else entry.stat()
+            except OSError:
+                # sometimes files disappear during rotation
+                continue
+
+            if is_dir is None:
+                is_dir = stat.S_ISDIR(entry_stats.st_mode)
+                if not is_dir and not self.wanted(path):
+                    continue
+            yield name, path, is_dir, entry_stats
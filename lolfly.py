@@ -34,6 +34,8 @@ import sys
 import time
 import traceback
 
+import sqlalchemy
+
 import differdb
 import fbz_filer
 import summarize_bugs
@@ -67,6 +69,7 @@ def file_errors(limit=1):
 
     # First section, get the errors that have exceptions
     for i in differ.get_grouped_unfiled_exceptions():
+        fingerprint = i.fingerprint
         code_location = i.code_location
         code_method = i.code_method
         exception = i.exception
@@ -91,8 +94,8 @@ def file_errors(limit=1):
         # Sometimes there's an error that happens and you're going
         # to ignore it, so let's just keep on looping
         if product == 'IGNORE_THIS_ERROR':
-            differ.update_group_case_id(-1, code_location, code_method, exception)
-            differ.update_group_product(product, -1, code_location, code_method, exception)
+            differ.update_group_case_id(-1, fingerprint)
+            differ.update_group_product(product, -1, fingerprint)
             msg += util.write_log('IGNORED: %s %s on %s' % (code_method, exception, host))
             continue
 
@@ -111,8 +114,8 @@ def file_errors(limit=1):
         # automation still works
         try:
             case, priority = fbz.file_case(product, bug_title, bug_text)
-            differ.update_group_case_id(case, code_location, code_method, exception)
-            differ.update_group_product(product, case, code_location, code_method, exception)
+            differ.update_group_case_id(case, fingerprint)
+            differ.update_group_product(product, case, fingerprint)
             
             log_output = '%sx p%s %s %s %s:%s:%s' %  \
                          (bug_count, priority, product, exception, host, code_location, code_method)
@@ -131,8 +134,8 @@ def file_errors(limit=1):
             bug_text = bug_text.split('WSGI Variables')[0]
 
             case, priority = fbz.file_case(product, bug_title, bug_text)
-            differ.update_group_case_id(case, code_location, code_method, exception)
-            differ.update_group_product(product, case, code_location, code_method, exception)
+            differ.update_group_case_id(case, fingerprint)
+            differ.update_group_product(product, case, fingerprint)
 
             log_output = '%sx p%s %s %s %s:%s:%s' %  \
                          (bug_count, priority, product, exception, host, code_location, code_method)
@@ -158,6 +161,7 @@ def file_errors(limit=1):
         host = i.host
         logfile = i.logfile
         error_message = i.error_message
+        bug_count = i.occurrences
 
         log_location = '%s:%s' % (host, logfile)
         error_message = util.smart_truncate(error_message, length=MAX_BODY_LEN)
@@ -177,14 +181,14 @@ def file_errors(limit=1):
         for fmt in util.DATE_FMT:
             bug_title = re.sub(fmt, '', bug_title)
 
-        bug_text = '1 error(s)\n--%s--\n%s' % (log_location, error_message)
+        bug_text = '%s error(s)\n--%s--\n%s' % (bug_count, log_location, error_message)
 
         try:
             case, priority = fbz.file_case(product, bug_title, bug_text)
             util.write_log("update_case_id(%s, %s)" % (errorid, case))
             differ.update_case_id(errorid, case)
 
-            log_output = '1x p%s %s %s:"%s"' % (priority, product, host, bug_title)
+            log_output = '%sx p%s %s %s:"%s"' % (bug_count, priority, product, host, bug_title)
             util.write_log(log_output)
 
             if priority <= 5:
@@ -199,7 +203,7 @@ def file_errors(limit=1):
             case, priority = fbz.file_case(product, bug_title, bug_text)
             differ.update_case_id(errorid, case)
 
-            log_output = '1x p%s %s %s:"%s"' % (priority, product, host, bug_title)
+            log_output = '%sx p%s %s %s:"%s"' % (bug_count, priority, product, host, bug_title)
             util.write_log(log_output)
 
             if priority <= 5:
@@ -238,6 +242,13 @@ def main():
 
     case_count, case_list, product_list, output = file_errors(limit=400)
 
+    differ = differdb.DifferDB()
+    try:
+        differ.prune_rollups()
+    except sqlalchemy.exceptions.SQLAlchemyError, e:
+        util.write_log('LOLFLY ERROR: got %r when pruning rollups' % e)
+    differ.close_connection()
+
     if case_count > 0:
         lolfly_rcpt_to = RCPT_TO
         subject = 'Fogbugz Submissions'
@@ -0,0 +1,151 @@
+'''
+Copyright (c) 2012 Lolapps, Inc. All rights reserved.
+
+Redistribution and use in source and binary forms, with or without modification, are
+permitted provided that the following conditions are met:
+
+   1. Redistributions of source code must retain the above copyright notice, this list of
+      conditions and the following disclaimer.
+
+   2. Redistributions in binary form must reproduce the above copyright notice, this list
+      of conditions and the following disclaimer in the documentation and/or other materials
+      provided with the distribution.
+
+THIS SOFTWARE IS PROVIDED BY LOLAPPS, INC. ''AS IS'' AND ANY EXPRESS OR IMPLIED
+WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND
+FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL LOLAPPS, INC. OR
+CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON
+ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+The views and conclusions contained in the software and documentation are those of the
+authors and should not be interpreted as representing official policies, either expressed
+or implied, of Lolapps, Inc..
+
+--------------------------------------------------------------------------------------------
+
+metrics.py
+
+Counters for what differ spends its time on. scan_file fills in a
+ScanStats for each file, and run_scan gathers them into a CycleStats
+that's written out to DIFFER_STATS_FILE after every cycle, and
+optionally sent to syslog on DIFFERLOGHOST. That's enough to find the
+hot files on a host, and with the syslog lines, across the fleet.
+
+'''
+
+import json
+import os
+import time
+
+import util
+
+from settings import *
+
+class ScanStats(object):
+    """ What it took to scan one file, or a whole cycle's worth of files.
+
+    bytes      - bytes read
+    lines      - lines that went through the classifier, lines the
+                 literal prefilter skipped aren't counted
+    matches    - lines that started an error
+    records    - errors parsed and sent to the sink
+    ignored    - error lines dropped by IGNORE_ERRORS
+    regex_time - seconds reading lines and grouping them into records,
+                 the prefilter and classifier included
+    sink_time  - seconds handing errors to the sink and flushing it
+    state_time - seconds writing the state file
+    scan_time  - seconds in scan_file altogether
+    """
+
+    fields = ('bytes', 'lines', 'matches', 'records', 'ignored',
+              'regex_time', 'sink_time', 'state_time', 'scan_time')
+
+    def __init__(self):
+        for field in self.fields:
+            setattr(self, field, 0)
+
+    def merge(self, other):
+        for field in self.fields:
+            setattr(self, field, getattr(self, field) + getattr(other, field))
+
+    def to_dict(self):
+        return dict((field, getattr(self, field)) for field in self.fields)
+
+class CycleStats(object):
+    """ The ScanStats of every file looked at in one run_scan, along with
+    their totals.
+    """
+
+    def __init__(self):
+        self.start = time.time()
+        self.duration = None
+        self.files = {}
+        self.total = ScanStats()
+
+    def file(self, filename):
+        stats = self.files.get(filename)
+        if stats is None:
+            stats = self.files[filename] = ScanStats()
+        return stats
+
+    def finish(self):
+        self.duration = time.time() - self.start
+        self.total = ScanStats()
+        for stats in self.files.values():
+            self.total.merge(stats)
+
+    def hottest(self, count):
+        """ The count files we spent longest on, slowest first.
+        """
+        ranked = sorted(self.files.items(), key=lambda item: item[1].scan_time,
+                        reverse=True)
+        return ranked[:count]
+
+    def to_dict(self, **extra):
+        stats = {'host': util.get_differ_hostname().strip(),
+                 'start': self.start,
+                 'duration': self.duration,
+                 'total': self.total.to_dict(),
+                 'files': dict((filename, stats.to_dict())
+                               for filename, stats in self.files.items())}
+        stats.update(extra)
+        return stats
+
+    def write(self, filename=DIFFER_STATS_FILE, **extra):
+        """ Replace filename with these stats as JSON. It's written to a
+        temp file and renamed over, so readers never see half of it.
+        """
+        tmp_name = filename + '.tmp'
+        output = open(tmp_name, 'w')
+        try:
+            json.dump(self.to_dict(**extra), output, indent=1, sort_keys=True)
+        finally:
+            output.close()
+        os.rename(tmp_name, filename)
+
+    def send(self, client, top_files=DIFFER_STATS_TOP_FILES):
+        """ One syslog line with the cycle totals, then one for each of
+        the slowest top_files files, logged to a syslog_client.
+        """
+        host = util.get_differ_hostname().strip()
+        client.log('differ stats %s duration=%.3f files=%s %s' %
+                   (host, self.duration, len(self.files), format_stats(self.total)),
+                   facility='local4', priority='info')
+        for filename, stats in self.hottest(top_files):
+            client.log('differ file stats %s %s %s' %
+                       (host, filename, format_stats(stats)),
+                       facility='local4', priority='info')
+
+def format_stats(stats):
+    values = []
+    for field in stats.fields:
+        value = getattr(stats, field)
+        if isinstance(value, float):
+            values.append('%s=%.3f' % (field, value))
+        else:
+            values.append('%s=%s' % (field, value))
+    return ' '.join(values)
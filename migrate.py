@@ -0,0 +1,207 @@
+#!/usr/bin/env python
+'''
+Copyright (c) 2012 Lolapps, Inc. All rights reserved.
+
+Redistribution and use in source and binary forms, with or without modification, are
+permitted provided that the following conditions are met:
+
+   1. Redistributions of source code must retain the above copyright notice, this list of
+      conditions and the following disclaimer.
+
+   2. Redistributions in binary form must reproduce the above copyright notice, this list
+      of conditions and the following disclaimer in the documentation and/or other materials
+      provided with the distribution.
+
+THIS SOFTWARE IS PROVIDED BY LOLAPPS, INC. ''AS IS'' AND ANY EXPRESS OR IMPLIED
+WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND
+FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL LOLAPPS, INC. OR
+CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON
+ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+The views and conclusions contained in the software and documentation are those of the
+authors and should not be interpreted as representing official policies, either expressed
+or implied, of Lolapps, Inc..
+
+--------------------------------------------------------------------------------------------
+
+migrate.py
+
+Brings the differ database's tables up to date. Each change to them
+is a file in migrations/ named for the version it takes the schema to,
+like 0003_query_indexes.sql. The versions that have been applied are
+kept in the schema_migrations table. create_db.sql makes the tables as
+they are after the newest migration, and records that version, so a new
+database has nothing to apply.
+
+Usage is as follows:
+migrate.py [--to VERSION] [--dry-run] [--status]
+
+A database made by create_db.sql before there were migrations has no
+schema_migrations table; it's taken to be at version 1, the tables as
+they were then, and the table is made for it. The user needs ALTER, CREATE and INDEX on the database, so
+it usually isn't DIFFERDBUSER, see --user.
+
+MySQL can't roll back a schema change, so each migration is recorded
+as it finishes. If a statement fails the run stops there, and whatever
+that migration had already done has to be finished or undone by hand
+before it's run again.
+
+'''
+
+import optparse
+import os
+import re
+import sys
+import time
+
+import sqlalchemy
+
+import differdb
+import util
+
+from settings import *
+
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'migrations')
+MIGRATION_FILE = re.compile('^(\d+)_(\w+)\.sql$')
+BASELINE_VERSION = 1 # the tables from before there were migrations
+
+VERSION_TABLE = """
+     CREATE TABLE schema_migrations (
+       version int(10) unsigned NOT NULL,
+       name varchar(100) NOT NULL,
+       applied int(10) unsigned NOT NULL,
+       PRIMARY KEY (version)
+     ) ENGINE=InnoDB DEFAULT CHARSET=utf8
+"""
+
+
+class MigrationError(Exception):
+    pass
+
+
+def find_migrations(directory=MIGRATIONS_DIR):
+    """ Returns [(version, name, path)] for the migrations in directory,
+    oldest first.
+    """
+    migrations = []
+    for filename in os.listdir(directory):
+        match = MIGRATION_FILE.match(filename)
+        if match:
+            migrations.append((int(match.group(1)), match.group(2),
+                               os.path.join(directory, filename)))
+    migrations.sort()
+
+    versions = [version for version, name, path in migrations]
+    for version in set(versions):
+        if versions.count(version) > 1 or version <= BASELINE_VERSION:
+            raise MigrationError('bad migration version %s in %s' % (version, directory))
+    return migrations
+
+def read_statements(path):
+    """ The statements in a migration file. Statements end with a ; at
+    the end of a line, and lines starting with -- or # are comments.
+    """
+    migration_file = open(path, 'r')
+    try:
+        lines = [line for line in migration_file
+                 if not line.lstrip().startswith(('--', '#'))]
+    finally:
+        migration_file.close()
+    statements = re.split(';\s*(?:\n|$)', ''.join(lines))
+    return [statement.strip() for statement in statements if statement.strip()]
+
+def current_version(engine, setup=True):
+    """ The version the schema is at. For a database that's from before
+    there were migrations that's BASELINE_VERSION, and schema_migrations
+    is made for it if setup is set.
+    """
+    if not engine.has_table('schema_migrations'):
+        if not engine.has_table('differ_errors'):
+            raise MigrationError('no differ tables, run create_db.sql first')
+        if not setup:
+            return BASELINE_VERSION
+        util.write_log('no schema_migrations table, taking the schema to be version %s' %
+                       BASELINE_VERSION)
+        engine.execute(VERSION_TABLE)
+        record_version(engine, BASELINE_VERSION, 'create_db')
+    return engine.execute('SELECT MAX(version) FROM schema_migrations').scalar()
+
+def record_version(engine, version, name):
+    query = sqlalchemy.sql.text("""
+         INSERT INTO schema_migrations (version, name, applied)
+         VALUES (:version, :name, :applied)
+    """)
+    engine.execute(query, {'version': version, 'name': name, 'applied': int(time.time())})
+
+def migrate(engine, to_version=None, dry_run=False, directory=MIGRATIONS_DIR):
+    """ Apply the migrations after the current version, up to and
+    including to_version (all of them if it's None). Returns the version
+    the schema is at afterwards, or would be for a dry run.
+    """
+    version = current_version(engine, setup=not dry_run)
+    for migration_version, name, path in find_migrations(directory):
+        if migration_version <= version:
+            continue
+        if to_version is not None and migration_version > to_version:
+            break
+
+        util.write_log('%s migration %s %s' %
+                       ('would apply' if dry_run else 'applying', migration_version, name))
+        for statement in read_statements(path):
+            if dry_run:
+                print '%s;\n' % statement
+                continue
+            start = time.time()
+            try:
+                engine.execute(sqlalchemy.sql.text(statement))
+            except sqlalchemy.exceptions.SQLAlchemyError, e:
+                raise MigrationError('migration %s %s failed, it may be partly applied: %s' %
+                                     (migration_version, name, e))
+            util.write_log('  %.1fs: %s' % (time.time() - start, statement.split('\n')[0]))
+        if not dry_run:
+            record_version(engine, migration_version, name)
+        version = migration_version
+    return version
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('--to', type='int', default=None,
+                      help='version to stop at (default the latest)')
+    parser.add_option('-n', '--dry-run', action='store_true', default=False,
+                      help='print the statements that would run instead of running them')
+    parser.add_option('--status', action='store_true', default=False,
+                      help='show the current version and what is waiting to be applied')
+    parser.add_option('--host', default=DIFFERDBHOST,
+                      help='database host (default %default)')
+    parser.add_option('--db', default=DIFFERDB,
+                      help='database (default %default)')
+    parser.add_option('--user', default=DIFFERDBUSER,
+                      help='database user (default %default)')
+    parser.add_option('--password', default=DIFFERDBPASSWD,
+                      help='database password (default from settings)')
+    options, args = parser.parse_args()
+
+    engine = differdb.DifferDB(options.host, options.user, options.password,
+                               options.db).engine
+    try:
+        if options.status:
+            version = current_version(engine, setup=False)
+            print 'at version %s' % version
+            for migration_version, name, path in find_migrations():
+                if migration_version > version:
+                    print 'waiting: %s %s' % (migration_version, name)
+            return 0
+
+        version = migrate(engine, options.to, options.dry_run)
+        util.write_log('schema is at version %s' % version)
+    except MigrationError, e:
+        util.write_log('%s' % e)
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,15 @@
+-- Repeats of an error are folded into one row before they're written,
+-- see differdb.ErrorAggregator: occurrences is how many times it was
+-- seen, between first_seen and last_seen. Rows from before this were
+-- each seen once, at timestamp, which is what NULL first_seen and
+-- last_seen stand for.
+
+ALTER TABLE differ_errors
+  ADD COLUMN `occurrences` int(10) unsigned NOT NULL default 1 AFTER `exception`,
+  ADD COLUMN `first_seen` int(10) unsigned default NULL AFTER `occurrences`,
+  ADD COLUMN `last_seen` int(10) unsigned default NULL AFTER `first_seen`;
+
+ALTER TABLE differ_warnings
+  ADD COLUMN `occurrences` int(10) unsigned NOT NULL default 1 AFTER `exception`,
+  ADD COLUMN `first_seen` int(10) unsigned default NULL AFTER `occurrences`,
+  ADD COLUMN `last_seen` int(10) unsigned default NULL AFTER `first_seen`;
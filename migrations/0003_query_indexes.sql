@@ -0,0 +1,30 @@
+-- Indexes for the queries in differdb.DifferDB, which were all table
+-- scans before, and a bounded exception column so it can be indexed.
+--
+-- differ cuts exceptions down to MAX_EXC_LENGTH before they're stored and
+-- make_error_row to LEN_EXCEPTION, so nothing longer than 64 should be
+-- there, but trim anything that is rather than have the ALTER fail.
+
+UPDATE differ_errors SET exception = LEFT(exception, 64) WHERE CHAR_LENGTH(exception) > 64;
+UPDATE differ_warnings SET exception = LEFT(exception, 64) WHERE CHAR_LENGTH(exception) > 64;
+
+-- one ALTER per table, so each is rebuilt once
+--
+-- ix_unfiled:   get_unfiled_nonexceptions (fbz_case IS NULL AND exception
+--               IS NULL, both equalities) and get_grouped_unfiled_exceptions
+--               (the unfiled rows with an exception, grouped on the rest)
+-- ix_group:     update_group_case_id and update_group_product, which look
+--               up one group of unfiled or just filed rows
+-- ix_timestamp: get_grouped_filed_errors and error_count. Everything but
+--               timestamp is there so the filed and product filters, and
+--               error_count's sum, are done from the index
+ALTER TABLE differ_errors
+  MODIFY `exception` varchar(64) default NULL,
+  ADD INDEX `ix_unfiled` (`fbz_case`, `exception`, `product`, `code_location`, `code_method`),
+  ADD INDEX `ix_group` (`code_location`, `code_method`, `exception`, `fbz_case`),
+  ADD INDEX `ix_timestamp` (`timestamp`, `fbz_case`, `product`, `occurrences`);
+
+-- ix_timestamp: get_grouped_warnings
+ALTER TABLE differ_warnings
+  MODIFY `exception` varchar(64) default NULL,
+  ADD INDEX `ix_timestamp` (`timestamp`, `product`);
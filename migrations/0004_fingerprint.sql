@@ -0,0 +1,38 @@
+-- A fingerprint column: the md5 of product, code_location, code_method
+-- and exception, joined by NUL bytes, as hex. differdb.error_fingerprint
+-- works it out for each row as it's inserted, and lolfly groups and
+-- files errors by it instead of comparing the four columns.
+--
+-- The backfill below does the same sum in SQL for the rows already there.
+-- It rewrites every row, so on a big table expect it to take a while.
+
+ALTER TABLE differ_errors
+  ADD COLUMN `fingerprint` char(32) CHARACTER SET ascii default NULL AFTER `exception`;
+ALTER TABLE differ_warnings
+  ADD COLUMN `fingerprint` char(32) CHARACTER SET ascii default NULL AFTER `exception`;
+
+UPDATE differ_errors SET fingerprint = MD5(CONCAT(
+    IFNULL(product, ''), CHAR(0), IFNULL(code_location, ''), CHAR(0),
+    IFNULL(code_method, ''), CHAR(0), IFNULL(exception, '')));
+UPDATE differ_warnings SET fingerprint = MD5(CONCAT(
+    IFNULL(product, ''), CHAR(0), IFNULL(code_location, ''), CHAR(0),
+    IFNULL(code_method, ''), CHAR(0), IFNULL(exception, '')));
+
+-- the grouping moves from the four columns to fingerprint, so the
+-- indexes from 0003 that were for it are replaced
+--
+-- ix_unfiled:     get_unfiled_nonexceptions, and
+--                 get_grouped_unfiled_exceptions grouping by fingerprint
+-- ix_fingerprint: update_group_case_id and update_group_product
+ALTER TABLE differ_errors
+  MODIFY `fingerprint` char(32) CHARACTER SET ascii NOT NULL,
+  DROP INDEX `ix_unfiled`,
+  DROP INDEX `ix_group`,
+  ADD INDEX `ix_unfiled` (`fbz_case`, `exception`, `fingerprint`),
+  ADD INDEX `ix_fingerprint` (`fingerprint`, `fbz_case`);
+
+-- ix_timestamp: get_grouped_warnings, grouping by fingerprint
+ALTER TABLE differ_warnings
+  MODIFY `fingerprint` char(32) CHARACTER SET ascii NOT NULL,
+  DROP INDEX `ix_timestamp`,
+  ADD INDEX `ix_timestamp` (`timestamp`, `product`, `fingerprint`);
@@ -0,0 +1,75 @@
+-- Counts of errors and warnings per fingerprint per minute, hour and day,
+-- kept up to date as rows are inserted (see DifferDB.insert_tables), so
+-- the summaries and error_count read a row per group per bucket instead
+-- of adding up raw rows.
+--
+-- differ_groups:  what each fingerprint stands for, one row per level
+--                 (differdb.ERROR or WARNING) and fingerprint, with the
+--                 case lolfly last filed it under
+-- differ_rollups: the counts. tier is the bucket size in seconds, bucket
+--                 the time the bucket starts
+
+CREATE TABLE `differ_groups` (
+  `level` tinyint unsigned NOT NULL,
+  `fingerprint` char(32) CHARACTER SET ascii NOT NULL,
+  `product` varchar(20) default NULL,
+  `code_location` varchar(100) default NULL,
+  `code_method` varchar(100) default NULL,
+  `exception` varchar(64) default NULL,
+  `error_message` text NOT NULL,
+  `logfile` varchar(100) NOT NULL,
+  `host` varchar(100) NOT NULL,
+  `fbz_case` int(10) default NULL,
+  `first_seen` int(10) unsigned NOT NULL,
+  `last_seen` int(10) unsigned NOT NULL,
+  PRIMARY KEY  (`level`, `fingerprint`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8;
+
+CREATE TABLE `differ_rollups` (
+  `level` tinyint unsigned NOT NULL,
+  `tier` int(10) unsigned NOT NULL,
+  `bucket` int(10) unsigned NOT NULL,
+  `fingerprint` char(32) CHARACTER SET ascii NOT NULL,
+  `occurrences` int(10) unsigned NOT NULL,
+  PRIMARY KEY  (`level`, `tier`, `bucket`, `fingerprint`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8;
+
+-- fill them in from the rows already there, as far back as
+-- DIFFER_ROLLUP_KEEP would have kept them. Errors are level 40 and
+-- warnings 30. Stop lolfly and the writers while this runs, or counts
+-- inserted in the meantime can be missed or counted twice
+
+INSERT INTO differ_groups
+  SELECT 40, fingerprint, MIN(product), MIN(code_location), MIN(code_method), MIN(exception),
+         MIN(error_message), MIN(logfile), MIN(host), MAX(fbz_case),
+         MIN(IFNULL(first_seen, timestamp)), MAX(IFNULL(last_seen, timestamp))
+  FROM differ_errors GROUP BY fingerprint;
+INSERT INTO differ_groups
+  SELECT 30, fingerprint, MIN(product), MIN(code_location), MIN(code_method), MIN(exception),
+         MIN(error_message), MIN(logfile), MIN(host), NULL,
+         MIN(IFNULL(first_seen, timestamp)), MAX(IFNULL(last_seen, timestamp))
+  FROM differ_warnings GROUP BY fingerprint;
+
+INSERT INTO differ_rollups
+  SELECT 40, 60, timestamp - timestamp % 60 AS bucket, fingerprint, SUM(occurrences)
+  FROM differ_errors WHERE timestamp >= UNIX_TIMESTAMP() - 8 * 86400
+  GROUP BY bucket, fingerprint;
+INSERT INTO differ_rollups
+  SELECT 40, 3600, timestamp - timestamp % 3600 AS bucket, fingerprint, SUM(occurrences)
+  FROM differ_errors WHERE timestamp >= UNIX_TIMESTAMP() - 90 * 86400
+  GROUP BY bucket, fingerprint;
+INSERT INTO differ_rollups
+  SELECT 40, 86400, timestamp - timestamp % 86400 AS bucket, fingerprint, SUM(occurrences)
+  FROM differ_errors GROUP BY bucket, fingerprint;
+
+INSERT INTO differ_rollups
+  SELECT 30, 60, timestamp - timestamp % 60 AS bucket, fingerprint, SUM(occurrences)
+  FROM differ_warnings WHERE timestamp >= UNIX_TIMESTAMP() - 8 * 86400
+  GROUP BY bucket, fingerprint;
+INSERT INTO differ_rollups
+  SELECT 30, 3600, timestamp - timestamp % 3600 AS bucket, fingerprint, SUM(occurrences)
+  FROM differ_warnings WHERE timestamp >= UNIX_TIMESTAMP() - 90 * 86400
+  GROUP BY bucket, fingerprint;
+INSERT INTO differ_rollups
+  SELECT 30, 86400, timestamp - timestamp % 86400 AS bucket, fingerprint, SUM(occurrences)
+  FROM differ_warnings GROUP BY bucket, fingerprint;
@@ -0,0 +1,12 @@
+-- How far each differ's spool has been drained, written in the same
+-- transaction as the rows (see DifferDB.insert_tables), so a drainer that
+-- crashed after its rows went in but before it saved its own offset file
+-- doesn't send them twice. spool_id is made up when the spool directory
+-- is, see spool.DifferSpool.
+
+CREATE TABLE `differ_drain_positions` (
+  `spool_id` char(32) CHARACTER SET ascii NOT NULL,
+  `segment` bigint unsigned NOT NULL,
+  `segment_offset` bigint unsigned NOT NULL,
+  PRIMARY KEY  (`spool_id`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8;
@@ -0,0 +1,411 @@
+'''
+Copyright (c) 2012 Lolapps, Inc. All rights reserved.
+
+Redistribution and use in source and binary forms, with or without modification, are
+permitted provided that the following conditions are met:
+
+   1. Redistributions of source code must retain the above copyright notice, this list of
+      conditions and the following disclaimer.
+
+   2. Redistributions in binary form must reproduce the above copyright notice, this list
+      of conditions and the following disclaimer in the documentation and/or other materials
+      provided with the distribution.
+
+THIS SOFTWARE IS PROVIDED BY LOLAPPS, INC. ''AS IS'' AND ANY EXPRESS OR IMPLIED
+WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND
+FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL LOLAPPS, INC. OR
+CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON
+ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+The views and conclusions contained in the software and documentation are those of the
+authors and should not be interpreted as representing official policies, either expressed
+or implied, of Lolapps, Inc..
+
+--------------------------------------------------------------------------------------------
+
+parsers.py
+
+What differ knows about each kind of log it reads. A LogFormat says how
+an entry in the log begins, which entries are errors, where an error
+ends and how to pull the location, method and exception out of it. Each
+format gets its own util.LineClassifier built from just its own
+patterns, so a MySQL log isn't run through the traceback regexes and a
+paste log isn't checked for syslog dates.
+
+The format of a file is worked out from its first lines by
+detect_format, and differ keeps the answer in the state file with the
+rest of what it knows about the file. LOG_FORMATS can name the format
+of files by a glob on their path instead, see configured_format.
+
+Formats come in two kinds. The paste and pylons ones (and generic, for
+anything we can't place) work the way differ always has: an error
+starts at a START line and runs until an END line or MAX_LINES. The
+rest are by_entry: an error is one whole log entry, from its first line
+up to the line that starts the next entry.
+
+The json format is for our newer services, which log one JSON object
+per line with the level, exception and frames already broken out. It
+decodes: only the lines holding one of its literals are looked at, and
+those are decoded and go by their level field rather than through the
+classifier. The fields of the ones that are errors go straight into the
+record instead of through util.parse_error_string.
+
+'''
+
+import fnmatch
+import json
+import re
+
+import util
+
+from settings import *
+
+
+class LogFormat(object):
+    """ The generic format, and the base for the rest. A subclass sets:
+
+    name         - what the format is called in LOG_FORMATS and the state file
+    error_re     - what the first line of an error looks like
+    end_re       - a line that ends an error in progress
+    entry_re     - what a line that starts a new log entry starts with,
+                   used to tell formats apart and to end errors
+    by_entry     - whether an error is one log entry, see the module notes
+    decodes      - whether each line is an entry the format decodes and
+                   tells errors from by what's in it, see decode and
+                   is_error, rather than going through the classifier
+    max_lines    - the most lines an error can take in
+    line_length  - how much of each line is kept
+    literals     - one of which is in every error line, None to work
+                   them out from error_re
+    """
+
+    name = 'generic'
+    error_re = ERROR_RE
+    end_re = ERROR_END_RE
+    entry_re = (PASTE_DATE_FORMAT, PYLONS_DATE_FORMAT)
+    by_entry = False
+    decodes = False
+    max_lines = MAX_LINES
+    line_length = MAX_LINE_LENGTH
+    literals = None
+
+    def __init__(self):
+        self._classifier = None
+        self._entry = re.compile('|'.join('(?:%s)' % exp for exp in self.entry_re)).match
+
+    def classifier(self):
+        """ The util.LineClassifier for this format, made the first time
+        it's asked for and shared after that.
+        """
+        if self._classifier is None:
+            literals = self.literals
+            if literals is None and self.error_re == ERROR_RE:
+                literals = ERROR_LITERALS
+            self._classifier = util.LineClassifier(self.error_re, self.end_re, self.entry_re,
+                                                   literals=literals)
+        return self._classifier
+
+    def detect(self, lines):
+        """ How many of lines start an entry of this format.
+        """
+        entry = self._entry
+        return len([line for line in lines if entry(line)])
+
+    def decode(self, line):
+        """ For a format that decodes, what line holds, or None if it
+        doesn't decode and should be classified as text.
+        """
+        return None
+
+    def is_error(self, entry):
+        """ For a format that decodes, whether entry, as decode gave it,
+        is an error.
+        """
+        return False
+
+    def parse(self, record):
+        """ Fills in the error_msg, location, line_number, method and
+        exception of a scanner.Record from its text, uncut.
+        """
+        record.error_msg = record.text
+        record.location, record.line_number, record.method, record.exception = \
+            self.fields(record.text)
+
+    def fields(self, text):
+        """ Returns (location, line number, method, exception) for the
+        error in text, any of which can be None.
+        """
+        return util.parse_error_string(text)
+
+
+class PasteFormat(LogFormat):
+    # 13:21:05,115 ERROR [kitsap.controllers.api.persist] Client Error
+    name = 'paste'
+    entry_re = (PASTE_DATE_FORMAT,)
+
+
+class PylonsFormat(LogFormat):
+    # 2012-05-24 13:21:05,115 ERROR [kitsap.controllers.api.persist] ...
+    name = 'pylons'
+    entry_re = (PYLONS_DATE_FORMAT,)
+
+
+class SyslogFormat(LogFormat):
+    # May 24 13:21:05 web01 app[1234]: ERROR [kitsap] request failed
+    # with any traceback logged after it on lines of its own
+    name = 'syslog'
+    entry_re = (SYSLOG_DATE_FORMAT,)
+    by_entry = True
+
+    program_re = re.compile('%s \S+ ([^\s:\[]+)' % SYSLOG_DATE_FORMAT)
+
+    def fields(self, text):
+        if 'Traceback' in text or '  File ' in text:
+            return util.parse_error_string(text)
+        # the program that logged it is the closest thing to a location
+        match = self.program_re.match(text)
+        return None, None, match and match.group(1), None
+
+
+class MysqlFormat(LogFormat):
+    # 120524 13:21:05  InnoDB: Error: page 7 log sequence number 123
+    # InnoDB: is in the future! Current system log sequence number 45.
+    name = 'mysql'
+    error_re = MYSQL_ERROR_RE
+    entry_re = (MYSQL_DATE_FORMAT,)
+    by_entry = True
+
+    def fields(self, text):
+        if 'InnoDB:' in text:
+            return None, None, 'InnoDB', None
+        return None, None, 'mysqld', None
+
+
+class McelogFormat(LogFormat):
+    # Hardware event. This is not a software error.
+    # MCE 0
+    # CPU 1 BANK 8
+    # ... and a blank line after each event
+    name = 'mcelog'
+    error_re = MCELOG_ERROR_RE
+    end_re = '^\s*$'
+    entry_re = (MCELOG_ENTRY_FORMAT,)
+    by_entry = True
+
+    bank_re = re.compile('^CPU (\d+) BANK (\d+)', re.M)
+
+    def fields(self, text):
+        match = self.bank_re.search(text)
+        if match:
+            return None, None, 'CPU %s BANK %s' % match.groups(), None
+        return None, None, None, None
+
+
+class JsonFormat(LogFormat):
+    # {"time": "2012-05-24 13:21:05,115", "level": "ERROR", "product": "kitsap",
+    #  "message": "request failed", "exc_type": "KeyError", "exc_message": "'user_id'",
+    #  "frames": [{"file": "/var/www/kitsap/model/user.py", "line": 50,
+    #              "function": "load_user"}, ...]}
+    # with the frames oldest first, the way a traceback prints them
+    name = 'json'
+    error_re = JSON_ERROR_RE
+    entry_re = (JSON_ENTRY_FORMAT,)
+    by_entry = True
+    decodes = True
+    max_lines = 1
+    # a cut line won't decode
+    line_length = MAX_LINE_BYTES
+    literals = JSON_ERROR_LITERALS
+
+    time_keys = ('time', 'timestamp', 'asctime')
+    level_keys = ('level', 'levelname', 'severity')
+    logger_keys = ('logger', 'name')
+    product_keys = ('product', 'service', 'app')
+    message_keys = ('message', 'msg')
+    exception_keys = ('exc_type', 'exception_type', 'error_type')
+    exception_message_keys = ('exc_message', 'exception_message', 'error_message')
+    frames_keys = ('frames', 'stack')
+    traceback_keys = ('exc_info', 'traceback', 'stack_trace')
+    file_keys = ('file', 'filename', 'path')
+    line_keys = ('line', 'lineno')
+    method_keys = ('function', 'func', 'method')
+    code_keys = ('code', 'text')
+
+    def decode(self, line):
+        try:
+            entry = json.loads(line)
+        except ValueError:
+            return None
+        if not isinstance(entry, dict):
+            return None
+        return entry
+
+    def is_error(self, entry):
+        level = first(entry, self.level_keys)
+        return isinstance(level, basestring) and level.upper() in JSON_ERROR_LEVELS
+
+    def parse(self, record):
+        entry = record.entry
+        if entry is None:
+            entry = self.decode(record.text)
+        if entry is None:
+            # not JSON after all, take it as text
+            LogFormat.parse(self, record)
+            return
+
+        exception = first(entry, self.exception_keys)
+        traceback = first(entry, self.traceback_keys)
+        frames = first(entry, self.frames_keys)
+        if not isinstance(frames, list):
+            frames = None
+        else:
+            frames = [frame for frame in frames if isinstance(frame, dict)]
+
+        # written out the way the text logs would have it, which is what
+        # lolfly makes its titles from. Put together as unicode and
+        # encoded once at the end
+        logger = first(entry, self.logger_keys)
+        head = [first(entry, self.time_keys), first(entry, self.level_keys),
+                logger and u'[%s]' % logger, first(entry, self.message_keys)]
+        lines = [u' '.join([u'%s' % part for part in head if part])]
+        if frames:
+            file_key, line_key, method_key, code_key = self.frame_keys(frames[0])
+            lines.append(u'Traceback (most recent call last):')
+            for frame in frames:
+                lines.append(u'  File "%s", line %s, in %s' %
+                             (frame.get(file_key), frame.get(line_key), frame.get(method_key)))
+                code = frame.get(code_key)
+                if code:
+                    lines.append(u'    %s' % code)
+        elif traceback:
+            lines.append((u'%s' % traceback).rstrip(u'\n'))
+        if exception and (frames or not traceback):
+            lines.append(u'%s: %s' % (exception,
+                                      first(entry, self.exception_message_keys) or u''))
+        lines.append(u'')
+        record.error_msg = u'\n'.join(lines).encode('utf-8')
+
+        record.product = as_text(first(entry, self.product_keys))
+        record.exception = as_text(exception)
+        if frames:
+            frame = self.pick_frame(frames, file_key)
+            record.location = as_text(frame.get(file_key))
+            record.line_number = as_text(frame.get(line_key))
+            record.method = as_text(frame.get(method_key))
+        elif traceback:
+            # the service only gave us the traceback as text
+            location, line_number, method, parsed_exception = \
+                util.parse_error_string(as_text(traceback))
+            record.location, record.line_number, record.method = location, line_number, method
+            record.exception = record.exception or parsed_exception
+
+    def frame_keys(self, frame):
+        """ The keys a service uses for (file, line, method, code) in its
+        frames, going by one of them.
+        """
+        return [first_key(frame, keys)
+                for keys in (self.file_keys, self.line_keys, self.method_keys, self.code_keys)]
+
+    def pick_frame(self, frames, file_key):
+        """ The frame util.parse_error_string would have picked out of the
+        same traceback: the lowest one in product code, then in shared
+        code, then anywhere.
+        """
+        shared_frame = None
+        other_frame = None
+        for frame in reversed(frames):
+            line = u'  File "%s"' % frame.get(file_key)
+            if util.lol_file_line.match(line):
+                if not util.shared_file_line.match(line):
+                    return frame
+                shared_frame = shared_frame or frame
+            else:
+                other_frame = other_frame or frame
+        return shared_frame or other_frame
+
+
+def first(entry, keys):
+    """ The value of the first of keys that entry has.
+    """
+    for key in keys:
+        value = entry.get(key)
+        if value is not None:
+            return value
+    return None
+
+def first_key(entry, keys):
+    """ The first of keys that entry has, or the first of them if it
+    has none.
+    """
+    for key in keys:
+        if key in entry:
+            return key
+    return keys[0]
+
+def as_text(value):
+    """ A JSON value as the kind of string the text formats give.
+    """
+    if value is None or isinstance(value, str):
+        return value
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return str(value)
+
+
+GENERIC = LogFormat()
+
+# the order matters when two formats tie, the first one wins
+FORMATS = [PasteFormat(), PylonsFormat(), SyslogFormat(), MysqlFormat(), McelogFormat(),
+           JsonFormat()]
+FORMATS_BY_NAME = dict((log_format.name, log_format) for log_format in FORMATS + [GENERIC])
+
+
+def get_format(name):
+    """ The LogFormat called name, or GENERIC if there isn't one (or name
+    is None).
+    """
+    return FORMATS_BY_NAME.get(name, GENERIC)
+
+def configured_format(path, formats=LOG_FORMATS):
+    """ The name of the format LOG_FORMATS gives path, if any.
+    """
+    for pattern, name in formats.items():
+        if fnmatch.fnmatch(path, pattern):
+            return name
+    return None
+
+def detect_format(path, lines=FORMAT_DETECT_LINES):
+    """ Works out the format of path from its first lines. Returns the
+    format's name and whether we saw enough of the file to be sure of it;
+    a file that's just been started may not look like anything yet.
+    """
+    sample = []
+    try:
+        logfile = open(path, 'r')
+        try:
+            for line in logfile:
+                if line.strip():
+                    sample.append(line)
+                if len(sample) >= lines:
+                    break
+        finally:
+            logfile.close()
+    except IOError:
+        return GENERIC.name, False
+
+    best = GENERIC
+    best_score = 0
+    for log_format in FORMATS:
+        score = log_format.detect(sample)
+        if score > best_score:
+            best, best_score = log_format, score
+
+    # most lines of a real log start an entry; a traceback can take up a
+    # whole sample, so a format only needs to account for a few of them
+    if best_score * 4 < len(sample):
+        best = GENERIC
+    return best.name, len(sample) >= lines
@@ -0,0 +1,185 @@
+'''
+Copyright (c) 2012 Lolapps, Inc. All rights reserved.
+
+Redistribution and use in source and binary forms, with or without modification, are
+permitted provided that the following conditions are met:
+
+   1. Redistributions of source code must retain the above copyright notice, this list of
+      conditions and the following disclaimer.
+
+   2. Redistributions in binary form must reproduce the above copyright notice, this list
+      of conditions and the following disclaimer in the documentation and/or other materials
+      provided with the distribution.
+
+THIS SOFTWARE IS PROVIDED BY LOLAPPS, INC. ''AS IS'' AND ANY EXPRESS OR IMPLIED
+WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND
+FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL LOLAPPS, INC. OR
+CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON
+ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+The views and conclusions contained in the software and documentation are those of the
+authors and should not be interpreted as representing official policies, either expressed
+or implied, of Lolapps, Inc..
+
+--------------------------------------------------------------------------------------------
+
+ratelimit.py
+
+Token bucket rate limiting for differ errors, so one runaway error can't
+flood differ_errors. It works on the rows the SpoolDrainer has already
+folded repeats into, so what it limits is rows: each error signature
+gets a bucket, shared by every file it turns up in, and so does each log
+file. Once a signature has used up its budget, only one in
+DIFFER_RATE_SAMPLE of its rows is sent on, carrying the count of the
+ones that were held back. A file over its budget has its extra rows
+sampled together the same way, but counted per fingerprint, so each
+count still lands on its own group in differ_rollups. The counts in the
+database stay exact, it's only the messages that get sampled.
+
+'''
+
+import fnmatch
+import time
+
+import differdb
+import util
+
+from settings import *
+
+class TokenBucket(object):
+    """ Allows rate events a second on average, in bursts of up to burst.
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.time()
+
+    def refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self, now):
+        self.refill(now)
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+    def full(self, now):
+        self.refill(now)
+        return self.tokens >= self.burst
+
+def get_limit(logfile, product, limits=DIFFER_RATE_LIMITS, default=DIFFER_RATE_LIMIT):
+    """ The (rate, burst) for a signature from logfile, going by the
+    product name first, then by globs on the path.
+    """
+    if product and product in limits:
+        return limits[product]
+    for pattern, limit in limits.items():
+        if fnmatch.fnmatch(logfile, pattern):
+            return limit
+    return default
+
+class RateLimiter(object):
+    """ Sits in front of another sink and passes on errors while their
+    signature and file buckets have tokens. Past that, errors are held
+    per signature, or per file if it's the file that's over, and every
+    sample'th one lets the hold go: a row for each fingerprint in it,
+    with occurrences set to the number held back since the last. flush()
+    sends whatever counts are left, so nothing is held from one flush to
+    the next.
+    """
+
+    def __init__(self, sink, file_limit=DIFFER_FILE_RATE_LIMIT, sample=DIFFER_RATE_SAMPLE):
+        self.sink = sink
+        self.file_limit = file_limit
+        self.sample = sample
+        self.buckets = {}
+        self.suppressed = {}
+        self.suppressed_count = 0
+        self.limited = set()
+
+    def get_bucket(self, key, limit):
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = self.buckets[key] = TokenBucket(*limit)
+        return bucket
+
+    def add_differ_error(self, logfile, product, code_location, code_method, error_message,
+                         exception, timestamp, host, occurrences=1, first_seen=None,
+                         last_seen=None):
+        now = time.time()
+        level = differdb.get_log_type(error_message)
+        signature = differdb.error_signature(exception, code_location, code_method,
+                                             error_message)
+
+        key = None
+        limit = get_limit(logfile, product)
+        signature_key = ('signature', product, host, level, signature)
+        if limit and not self.get_bucket(signature_key, limit).take(now):
+            key = signature_key
+        elif self.file_limit and not self.get_bucket(logfile, self.file_limit).take(now):
+            # most likely a file throwing up lots of different errors,
+            # which only count for anything together
+            key = ('file', logfile, product, host, level)
+
+        if key is None:
+            self.sink.add_differ_error(logfile, product, code_location, code_method,
+                                       error_message, exception, timestamp, host,
+                                       occurrences, first_seen, last_seen)
+            return
+
+        first_seen = first_seen or timestamp
+        last_seen = last_seen or timestamp
+        hold = self.suppressed.get(key)
+        if hold is None:
+            hold = self.suppressed[key] = {'records': 0, 'rows': {}}
+        # what differdb fingerprints rows by, a file's hold can have many
+        fingerprint = (product, code_location, code_method, exception)
+        held = hold['rows'].get(fingerprint)
+        if held is None:
+            held = hold['rows'][fingerprint] = {
+                'logfile': logfile, 'product': product, 'code_location': code_location,
+                'code_method': code_method, 'error_message': error_message,
+                'exception': exception, 'timestamp': first_seen, 'host': host,
+                'occurrences': 0, 'first_seen': first_seen, 'last_seen': last_seen}
+        held['occurrences'] += occurrences
+        held['first_seen'] = min(held['first_seen'], first_seen)
+        held['last_seen'] = max(held['last_seen'], last_seen)
+        hold['records'] += 1
+        self.suppressed_count += occurrences
+        self.limited.add(key)
+
+        if hold['records'] >= self.sample:
+            self.send_held(key)
+
+    def send_held(self, key):
+        for held in self.suppressed.pop(key)['rows'].values():
+            held['timestamp'] = held['first_seen']
+            self.sink.add_differ_error(**held)
+
+    def flush(self):
+        """ Send the counts for everything held back, forget buckets that
+        have filled back up, and flush the sink.
+        """
+        for key in self.suppressed.keys():
+            self.send_held(key)
+
+        if self.suppressed_count:
+            util.write_log('rate limited %s error(s) in %s signature(s) and file(s)' %
+                           (self.suppressed_count, len(self.limited)))
+            self.suppressed_count = 0
+            self.limited.clear()
+
+        now = time.time()
+        for key, bucket in self.buckets.items():
+            if bucket.full(now):
+                del self.buckets[key]
+
+        self.sink.flush()
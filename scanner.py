@@ -0,0 +1,573 @@
+'''
+Copyright (c) 2012 Lolapps, Inc. All rights reserved.
+
+Redistribution and use in source and binary forms, with or without modification, are
+permitted provided that the following conditions are met:
+
+   1. Redistributions of source code must retain the above copyright notice, this list of
+      conditions and the following disclaimer.
+
+   2. Redistributions in binary form must reproduce the above copyright notice, this list
+      of conditions and the following disclaimer in the documentation and/or other materials
+      provided with the distribution.
+
+THIS SOFTWARE IS PROVIDED BY LOLAPPS, INC. ''AS IS'' AND ANY EXPRESS OR IMPLIED
+WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND
+FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL LOLAPPS, INC. OR
+CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON
+ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+The views and conclusions contained in the software and documentation are those of the
+authors and should not be interpreted as representing official policies, either expressed
+or implied, of Lolapps, Inc..
+
+--------------------------------------------------------------------------------------------
+
+scanner.py
+
+The pieces differ.scan_file is built from, as a pipeline of generators:
+
+    read_lines -> RecordAssembler.records -> parse_records -> sinks
+
+read_lines turns a file into (line, offset) pairs, a RecordAssembler
+groups lines into Records (one error each, possibly many lines),
+parse_records pulls the location, method and exception out of each
+(both going by the file's parsers.LogFormat),
+and deliver hands them to any number of sinks. Each stage only asks
+the one before it for more once it's done with what it has, so a slow
+sink holds up the reading instead of records piling up in memory.
+
+Any stage can be used on its own. RecordAssembler.records takes (line,
+offset) pairs from anywhere, not just a file, and a sink is anything
+with add(record) and flush().
+
+'''
+
+import sys
+import time
+
+import parsers
+import util
+
+from settings import *
+
+
+class Record(object):
+    """ One error, as the lines it was made of and where they were in
+    the file. parse_record fills in the rest.
+    """
+    __slots__ = ('filename', 'text', 'start', 'end', 'entry', 'error_msg', 'product',
+                 'location', 'line_number', 'method', 'exception')
+
+    def __init__(self, filename, text, start, end):
+        self.filename = filename
+        self.text = text
+        self.start = start # offset of the first line, if it's known
+        self.end = end # offset just past the last line
+        self.entry = None # what a format that decodes made of it
+        self.error_msg = None
+        self.product = None # only some formats say
+        self.location = None
+        self.line_number = None
+        self.method = None
+        self.exception = None
+
+
+def read_lines(logfile, log_pos, max_bytes=None, skip=None):
+    """ Read logfile from log_pos in SCAN_CHUNK_SIZE chunks, yielding
+    (line, offset just past the line). Lines are stitched back together
+    across chunk boundaries, and a runaway line with no newline is handed
+    over in MAX_LINE_BYTES pieces so memory stays flat however big the
+    file is. Once max_bytes have been read, stops after the last complete
+    line of that chunk.
+
+    Before each line, skip(chunk, start) can return a later line start
+    to carry on from. The lines in between aren't split out, a single
+    ('', offset) stands in for all of them.
+    """
+    logfile.seek(log_pos)
+    offset = log_pos
+    carry = ''
+    bytes_read = 0
+
+    while max_bytes is None or bytes_read < max_bytes:
+        chunk = logfile.read(SCAN_CHUNK_SIZE)
+        if not chunk:
+            # end of file, hand over whatever is left like file iteration would
+            if carry:
+                yield carry, offset + len(carry)
+            return
+        bytes_read += len(chunk)
+        if carry:
+            chunk = carry + chunk
+
+        start = 0
+        while True:
+            if skip is not None:
+                skip_to = skip(chunk, start)
+                if skip_to > start:
+                    offset += skip_to - start
+                    start = skip_to
+                    yield '', offset
+
+            newline = chunk.find('\n', start)
+            if newline < 0:
+                break
+            line = chunk[start:newline + 1]
+            offset += len(line)
+            yield line, offset
+            start = newline + 1
+
+        carry = chunk[start:]
+        if len(carry) >= MAX_LINE_BYTES:
+            offset += len(carry)
+            yield carry, offset
+            carry = ''
+
+
+class RecordAssembler(object):
+    """ Groups lines into Records. A START line begins a record, which
+    takes in up to max_lines lines and ends at an END line or the first
+    line past that. For a by_entry log_format, a record ends before the
+    line that starts the next entry instead, see parsers.py, and for one
+    that decodes a record is a line the format says is an error.
+
+    log_pos is kept at the offset to carry on from if reading stopped
+    now, text holds the record in progress and record_start where it
+    began, so a caller that stops part way through a record can either
+    finish() it or leave it to be read again.
+    """
+
+    def __init__(self, filename, log_pos=0, log_format=None):
+        if log_format is None:
+            log_format = parsers.GENERIC
+        classifier = log_format.classifier()
+        self.filename = filename
+        self.log_format = log_format
+        self.classifier = classifier
+        self.max_lines = log_format.max_lines
+        self.line_length = log_format.line_length
+        self.find_start = classifier.start_finder()
+        self.log_pos = log_pos
+        self.line_end = log_pos
+        self.text = ''
+        self.record_start = None
+        self.in_record = False
+        self.tail = None # lines the record in progress can still take
+        self.gotmatch = False
+        self.lines = 0
+        self.matches = 0
+        self.regex_time = 0.0
+
+    def skip(self, chunk, start):
+        """ For read_lines: outside of a record only a START line matters,
+        so jump to the line holding the next thing that could be one.
+        read_lines asks between lines, so in_record is up to date.
+        """
+        if self.in_record:
+            return start
+        found = self.find_start(chunk, start)
+        if found < 0:
+            return chunk.rfind('\n', start) + 1 or start
+        return chunk.rfind('\n', start, found) + 1 or start
+
+    def records(self, lines):
+        """ Yields a Record for each error in lines, an iterable of
+        (line, offset just past it) pairs like read_lines gives.
+        """
+        if self.log_format.decodes:
+            return self.decoded_records(lines)
+        if self.log_format.by_entry:
+            return self.entry_records(lines)
+        return self.line_records(lines)
+
+    def line_records(self, lines):
+        filename = self.filename
+        line_length = self.line_length
+        classify = self.classifier.classify
+        new_entry = self.classifier.new_entry
+        local_err_msg = self.text
+        log_pos = self.log_pos
+        line_end = self.line_end
+        lines_seen = matches = 0
+        regex_time = 0.0
+
+        tail = self.tail
+        gotmatch = self.gotmatch
+        record_start = self.record_start
+
+        # timed between records rather than per line, which would cost
+        # more than some of the lines themselves
+        resumed = time.time()
+        try:
+            for line, line_end in lines:
+                if not line:
+                    # lines skip() found nothing in
+                    log_pos = line_end
+                    continue
+
+                line_class = classify(line)
+                lines_seen += 1
+
+                if line_class == util.START and tail == 0 and \
+                   (new_entry(line) or line.lstrip().startswith('Traceback')):
+                    # a new error right as the last one ran out of lines.
+                    # The File lines of a long traceback are START lines
+                    # too, but they go on with the one we have
+                    record = Record(filename, local_err_msg, record_start, log_pos)
+
+                    local_err_msg = ''
+                    tail = None
+                    gotmatch = False
+                    record_start = None
+                    self.in_record = False
+                    self.log_pos, self.line_end = log_pos, line_end
+                    regex_time += time.time() - resumed
+                    yield record
+                    resumed = time.time()
+
+                if line_class == util.START:
+                    matches += 1
+                    # We match, start outputting.
+                    if tail is None:
+                        util.write_log('got match in file : %s' % filename)
+                        tail = self.max_lines
+                        record_start = line_end - len(line)
+                        self.in_record = True
+                    local_err_msg += util.smart_truncate(line, length=line_length,
+                                                         suffix=MAX_LINE_SUFFIX)
+                    log_pos = line_end
+                    tail -= 1
+                    gotmatch = True
+
+                elif gotmatch and line_class == util.END:
+                    # the END line is the last of the record
+                    local_err_msg += util.smart_truncate(line, length=line_length,
+                                                         suffix=MAX_LINE_SUFFIX)
+                    record = Record(filename, local_err_msg, record_start, line_end)
+
+                    local_err_msg = ''
+                    tail = None
+                    gotmatch = False
+                    record_start = None
+                    self.in_record = False
+                    self.log_pos, self.line_end = log_pos, line_end
+                    regex_time += time.time() - resumed
+                    yield record
+                    resumed = time.time()
+
+                elif tail > 0:
+                    local_err_msg += util.smart_truncate(line, length=line_length,
+                                                         suffix=MAX_LINE_SUFFIX)
+                    log_pos = line_end
+                    tail -= 1
+
+                elif tail == 0:
+                    # out of lines, the record ends before this one
+                    record = Record(filename, local_err_msg, record_start, log_pos)
+
+                    local_err_msg = ''
+                    tail = None
+                    gotmatch = False
+                    record_start = None
+                    self.in_record = False
+                    self.log_pos, self.line_end = log_pos, line_end
+                    regex_time += time.time() - resumed
+                    yield record
+                    resumed = time.time()
+
+                else:
+                    log_pos = line_end
+            regex_time += time.time() - resumed
+        finally:
+            self.text = local_err_msg
+            self.tail = tail
+            self.gotmatch = gotmatch
+            self.record_start = record_start
+            self.log_pos = log_pos
+            self.line_end = line_end
+            self.lines += lines_seen
+            self.matches += matches
+            self.regex_time += regex_time
+
+    def entry_records(self, lines):
+        filename = self.filename
+        line_length = self.line_length
+        classify = self.classifier.classify
+        new_entry = self.classifier.new_entry
+        local_err_msg = self.text
+        log_pos = self.log_pos
+        line_end = self.line_end
+        lines_seen = matches = 0
+        regex_time = 0.0
+
+        tail = self.tail
+        record_start = self.record_start
+
+        resumed = time.time()
+        try:
+            for line, line_end in lines:
+                if not line:
+                    # lines skip() found nothing in
+                    log_pos = line_end
+                    continue
+
+                line_class = classify(line)
+                starts_entry = line_class == util.END or \
+                               line_class == util.START and local_err_msg and new_entry(line)
+                lines_seen += 1
+
+                if local_err_msg and (starts_entry or tail == 0):
+                    # the error ends with the line before this one
+                    record = Record(filename, local_err_msg, record_start, log_pos)
+
+                    local_err_msg = ''
+                    tail = None
+                    record_start = None
+                    self.in_record = False
+                    self.log_pos, self.line_end = log_pos, line_end
+                    regex_time += time.time() - resumed
+                    yield record
+                    resumed = time.time()
+
+                if line_class == util.START:
+                    matches += 1
+                    if not local_err_msg:
+                        util.write_log('got match in file : %s' % filename)
+                        tail = self.max_lines
+                        record_start = line_end - len(line)
+                        self.in_record = True
+                    local_err_msg += util.smart_truncate(line, length=line_length,
+                                                         suffix=MAX_LINE_SUFFIX)
+                    tail -= 1
+
+                elif local_err_msg:
+                    local_err_msg += util.smart_truncate(line, length=line_length,
+                                                         suffix=MAX_LINE_SUFFIX)
+                    tail -= 1
+
+                log_pos = line_end
+            regex_time += time.time() - resumed
+        finally:
+            self.text = local_err_msg
+            self.tail = tail
+            self.record_start = record_start
+            self.log_pos = log_pos
+            self.line_end = line_end
+            self.lines += lines_seen
+            self.matches += matches
+            self.regex_time += regex_time
+
+    def decoded_records(self, lines):
+        filename = self.filename
+        line_length = self.line_length
+        decode = self.log_format.decode
+        is_error = self.log_format.is_error
+        classify = self.classifier.classify
+        ignore = self.classifier.ignore
+        log_pos = self.log_pos
+        line_end = self.line_end
+        lines_seen = matches = 0
+        regex_time = 0.0
+
+        # every record is a line of its own, so there's never one in
+        # progress
+        resumed = time.time()
+        try:
+            for line, line_end in lines:
+                log_pos = line_end
+                if not line:
+                    # lines skip() found nothing in
+                    continue
+                lines_seen += 1
+
+                entry = decode(line)
+                if entry is None:
+                    # not what the format expected, take it as text
+                    error = classify(line) == util.START
+                else:
+                    error = is_error(entry) and not ignore(line)
+                if not error:
+                    continue
+
+                matches += 1
+                util.write_log('got match in file : %s' % filename)
+                record = Record(filename, util.smart_truncate(line, length=line_length,
+                                                              suffix=MAX_LINE_SUFFIX),
+                                line_end - len(line), line_end)
+                record.entry = entry
+                self.log_pos, self.line_end = log_pos, line_end
+                regex_time += time.time() - resumed
+                yield record
+                resumed = time.time()
+            regex_time += time.time() - resumed
+        finally:
+            self.log_pos = log_pos
+            self.line_end = line_end
+            self.lines += lines_seen
+            self.matches += matches
+            self.regex_time += regex_time
+
+    def finish(self):
+        """ The record in progress, if there is one, as if it had ended
+        with the last line read.
+        """
+        if not self.text:
+            return None
+        record = Record(self.filename, self.text, self.record_start, self.line_end)
+        self.text = ''
+        self.record_start = None
+        self.in_record = False
+        self.tail = None
+        self.gotmatch = False
+        return record
+
+
+def parse_record(record, log_format=None):
+    """ Fill in the fields of record from its text, cut down to what
+    the database will hold.
+    """
+    if log_format is None:
+        log_format = parsers.GENERIC
+    log_format.parse(record)
+    record.error_msg = util.smart_truncate(record.error_msg, length=MAX_MSG_LENGTH,
+                                           suffix=MAX_MSG_SUFFIX)
+    record.exception = util.smart_truncate(record.exception, length=MAX_EXC_LENGTH,
+                                           suffix=MAX_EXC_SUFFIX)
+    record.location = util.smart_truncate(record.location, length=MAX_LOCATION_LENGTH,
+                                          suffix=MAX_LOCATION_SUFFIX)
+    return record
+
+def parse_records(records, log_format=None):
+    for record in records:
+        yield parse_record(record, log_format)
+
+
+def deliver(record, sinks, stats=None):
+    """ Hand record to each of sinks, adding the time it took to
+    stats.sink_time.
+    """
+    start = time.time()
+    for sink in sinks:
+        sink.add(record)
+    if stats is not None:
+        stats.sink_time += time.time() - start
+        stats.records += 1
+
+
+class ErrorSink(object):
+    """ Sends records on to anything with add_differ_error: a DifferDB,
+    spool, collector.CollectorClient, or one of the layers in front of
+    them.
+    """
+
+    def __init__(self, differ_db):
+        self.differ_db = differ_db
+        self.host = util.get_differ_hostname().strip()
+
+    def add(self, record):
+        self.differ_db.add_differ_error(record.filename, record.product, record.location,
+                                        record.method, record.error_msg, record.exception,
+                                        int(time.time()), self.host)
+
+    def flush(self):
+        self.differ_db.flush()
+
+
+class PrintSink(object):
+    """ Prints records the way LolflyError.print_pretty does, for
+    looking at a file by hand.
+    """
+
+    def __init__(self, out=None):
+        self.out = out
+
+    def add(self, record):
+        out = self.out or sys.stdout
+        out.write("%s,%s,%s,%s,%s,%s\n" % (record.filename, record.product, record.location,
+                                           record.method, record.error_msg,
+                                           record.exception))
+
+    def flush(self):
+        (self.out or sys.stdout).flush()
+
+
+class ListSink(object):
+    """ Collects records as LolflyError.to_dict style dicts, so they can
+    be shipped between processes.
+    """
+
+    def __init__(self, records=None):
+        self.records = [] if records is None else records
+
+    def add(self, record):
+        self.records.append({'file_name': record.filename,
+                             'timestamp': time.strftime('%Y%m%d %H:%M:%S', time.localtime()),
+                             'product': record.product, 'revision': None,
+                             'error_msg': record.error_msg,
+                             'line_number': record.line_number,
+                             'location': record.location, 'method': record.method,
+                             'exception': record.exception})
+
+    def flush(self):
+        pass
+
+
+class DigestSink(object):
+    """ Adds records to a differ.ErrorDigest, or anything else with
+    add(filename, error_msg).
+    """
+
+    def __init__(self, digest):
+        self.digest = digest
+
+    def add(self, record):
+        self.digest.add(record.filename, record.text)
+
+    def flush(self):
+        pass
+
+
+def scan(logfile, filename, sinks, log_pos=0, max_bytes=None, stats=None,
+         log_format=None):
+    """ Run the whole pipeline over an open logfile from log_pos, handing
+    every record to sinks. Returns the offset to pick up from next time.
+    log_format is the parsers.LogFormat to read it as, GENERIC if None.
+
+    With max_bytes, gives up after reading roughly that much. A record
+    that was cut short by that is left to be read again whole next time,
+    unless it started where we did, in which case there's no point.
+    """
+    if log_format is None:
+        log_format = parsers.GENERIC
+    classifier = log_format.classifier()
+    started = time.time()
+    ignored = classifier.ignored
+    assembler = RecordAssembler(filename, log_pos, log_format)
+    lines = read_lines(logfile, log_pos, max_bytes, assembler.skip)
+
+    try:
+        for record in parse_records(assembler.records(lines), log_format):
+            deliver(record, sinks, stats)
+
+        stopped_early = max_bytes is not None and logfile.read(1) != ''
+        if assembler.text and stopped_early and assembler.record_start > log_pos:
+            return assembler.record_start
+
+        record = assembler.finish()
+        if record is not None:
+            deliver(parse_record(record, log_format), sinks, stats)
+        return assembler.log_pos
+    finally:
+        if stats is not None:
+            stats.bytes += assembler.line_end - log_pos
+            stats.lines += assembler.lines
+            stats.matches += assembler.matches
+            stats.ignored += classifier.ignored - ignored
+            stats.regex_time += assembler.regex_time
+            stats.scan_time += time.time() - started
+
@@ -30,7 +30,9 @@ or implied, of Lolapps, Inc..
 # what to monitor
 ###########################################
 
-# files or directories (absolute paths)
+# files or directories (absolute paths). A directory ending in /** takes in
+# every directory below it too, and glob patterns stand for whatever files
+# or directories they match, e.g. '/var/log/app*/error.log'
 TARGETS = set(['/var/log/paste',
                '/var/log/syslog',
                '/var/log/mcelog',])
@@ -48,15 +50,41 @@ BLACKLIST = set(['/var/log/paste/dane_request_time.log',
                  '/var/log/example/lolfly.log',])
 
 VALID_FILETYPES = set(['log',])
-IGNORE_FILETYPES = set(['gz',]),
+IGNORE_FILETYPES = set(['gz',])
+
+# the format of each log (paste, pylons, syslog, mysql, mcelog, json) is worked
+# out from its first FORMAT_DETECT_LINES lines and remembered in the state
+# file. LOG_FORMATS sets it by a glob on the path instead
+FORMAT_DETECT_LINES = 20
+LOG_FORMATS = {
+    # '/var/log/mysql/*'  : 'mysql',
+}
+
+MAX_FILE_SIZE = 512 * 1024 * 1024 # files bigger than this are called out in the log
 
-MAX_FILE_SIZE = 512 * 1024 * 1024
+# logs are read in chunks and at most MAX_SCAN_BYTES per file per cycle,
+# so memory use stays flat and one huge log can't stall the rest
+SCAN_CHUNK_SIZE = 1024 * 1024
+MAX_SCAN_BYTES = 64 * 1024 * 1024
+MAX_LINE_BYTES = 64 * 1024 # longer lines are handed over in pieces
+
+# how much of the head of each log we hash to recognize it after it's
+# been truncated, replaced or rotated
+FINGERPRINT_BYTES = 1024
 
 ###########################################
 # configuration file
 ###########################################
 
 STATEFILE = '/tmp/differ.state'
+# a full scan rewrites STATEFILE and empties its journal; so does any scan
+# once the journal has grown past this
+STATE_JOURNAL_MAX_BYTES = 4 * 1024 * 1024
+
+# per file and per cycle counters from the last scan, as JSON
+DIFFER_STATS_FILE = '/tmp/differ.stats'
+DIFFER_STATS_SYSLOG = False # also send them to syslog on DIFFERLOGHOST
+DIFFER_STATS_TOP_FILES = 5 # how many of the slowest files to send
 
 ###########################################
 # database
@@ -67,6 +95,61 @@ DIFFERDB='differ'
 DIFFERDBUSER='differ_inject'
 DIFFERDBPASSWD='<example>'
 
+# errors go to the database with multi-row INSERTs of up to this many
+# rows. A collector.CollectorClient used as a sink also sends once this
+# many are waiting or the oldest has waited this long
+DIFFER_BATCH_SIZE = 500
+DIFFER_BATCH_SECONDS = 5
+
+# differ writes errors to an on-disk spool and a background thread
+# forwards them to the database, so scanning never waits on MySQL
+DIFFER_SPOOL_DIR = '/tmp/differ.spool'
+DIFFER_SPOOL_MAX_BYTES = 256 * 1024 * 1024 # oldest segments are dropped past this
+DIFFER_SPOOL_SEGMENT_BYTES = 16 * 1024 * 1024
+DIFFER_SPOOL_MAX_BACKOFF = 300 # longest wait between retries when the DB is down
+DIFFER_SPOOL_IDLE_TIME = 1 # how long to wait when there's nothing to forward
+
+# where the spool drainer sends errors: 'db' writes them to DIFFERDB itself,
+# 'collector' sends them to the collector.py on COLLECTOR_HOST, which writes
+# everyone's errors in large transactions
+DIFFER_SINK = 'db'
+COLLECTOR_HOST = 'differlog'
+COLLECTOR_PORT = 5140
+COLLECTOR_BIND = COLLECTOR_HOST # the interface the collector listens on, '' for all of them
+COLLECTOR_TIMEOUT = 60 # how long differ waits for the collector to commit a batch
+COLLECTOR_IDLE_TIMEOUT = 600 # the collector hangs up on differs quiet this long
+COLLECTOR_MAX_FRAME_BYTES = 64 * 1024 * 1024 # bigger batches are refused
+COLLECTOR_MAX_PAYLOAD_BYTES = 256 * 1024 * 1024 # and so are ones that inflate to more than this
+COLLECTOR_TXN_ROWS = 10000 # the collector commits once this many rows are waiting
+COLLECTOR_TXN_SECONDS = 1 # or the first of them has waited this long
+
+# the spool drainer folds repeats of the same error from a file into one
+# row with a count, sending a window's worth of rows at a time. The
+# spooled errors are only let go once their rows are in the database.
+# 0 sends each batch as it's read
+DIFFER_AGGREGATE_SECONDS = 60
+DIFFER_AGGREGATE_MAX_GROUPS = 10000 # send everything early if this many are held
+
+# besides the raw rows, the database keeps counts per fingerprint per
+# minute, hour and day in differ_rollups, and the summaries and error_count
+# read those instead. Buckets of each size are kept this many seconds, None
+# for good; minutes have to reach back as far as the longest summary (a week)
+DIFFER_ROLLUP_KEEP = {60: 8 * 86400, 3600: 90 * 86400, 86400: None}
+
+# token bucket limits, as (rows per second, burst), on how many of the
+# rows folded up by DIFFER_AGGREGATE_SECONDS a single signature (across all
+# files) and a single log file can send. Past that only one in
+# DIFFER_RATE_SAMPLE goes through, carrying the count of the rest.
+# DIFFER_RATE_LIMITS overrides the per-signature limit by product or by a
+# glob on the log path. None turns a limit off.
+DIFFER_RATE_LIMIT = (0.1, 10)
+DIFFER_FILE_RATE_LIMIT = (1, 100)
+DIFFER_RATE_LIMITS = {
+    # 'kitsap'            : (5, 300),
+    # '/var/log/mysql/*'  : (0.1, 10),
+}
+DIFFER_RATE_SAMPLE = 100
+
 ###########################################
 # email notifications
 ###########################################
@@ -94,6 +177,11 @@ LOLFLY_EMAIL_ERRORS = True
 ###########################################
 
 DIFFERLOGHOST = 'differlog'
+DIFFER_SYSLOG_PORT = 514
+# UDP by default. Over TCP, one connection is kept open and messages are
+# queued and sent in batches without ever blocking a scan
+DIFFER_SYSLOG_TCP = False
+DIFFER_SYSLOG_MAX_QUEUE = 10000 # oldest queued messages are dropped past this
 
 ###########################################
 # fogbugz
@@ -138,6 +226,10 @@ PROJECT_AREAS = {
 
 ERROR_RE = '(\sERROR[^?]|^\s*Traceback|^\s*Error|^  File |InnoDB: Error:|\s+WARNING\s+)'
 ERROR_END_RE = '(DeprecationWarning)'
+# one of these has to be in a line for ERROR_RE to match it, so text without
+# any of them is skipped unread. None works them out from ERROR_RE, set it
+# by hand if that can't be done, or to () to regex every line
+ERROR_LITERALS = None
 
 FILE_LINE = '^\s*File '
 LOL_FILE_LINE = '^\s*File .*/var/www/'
@@ -148,6 +240,24 @@ PASTE_DATE_FORMAT = "\d{2}:\d{2}:\d{2}"
 PYLONS_DATE_FORMAT = "\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}"
 PYLONS_STRP_TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
 
+# how the first line of an entry starts in the other logs we know about,
+# and what errors look like in them. See parsers.py
+SYSLOG_DATE_FORMAT = "\w{3} [ \d]\d \d{2}:\d{2}:\d{2}"
+MYSQL_DATE_FORMAT = "\d{6} [ \d]\d:\d{2}:\d{2}"
+MYSQL_ERROR_RE = '(InnoDB: Error|\[ERROR\])'
+MCELOG_ENTRY_FORMAT = "Hardware event|mcelog: "
+MCELOG_ERROR_RE = '(^Hardware event|^mcelog: .*[Ee]rror)'
+# structured logs, one JSON object per line. Only lines holding one of
+# JSON_ERROR_LITERALS are decoded at all, and an entry is an error if its
+# level field is one of JSON_ERROR_LEVELS, in any case. The literals are
+# matched as they are, so services that log lower case levels (structlog
+# does) need them in both. A line that won't decode is an error if it
+# matches JSON_ERROR_RE, which is case sensitive too
+JSON_ENTRY_FORMAT = '\s*\{'
+JSON_ERROR_LEVELS = ('ERROR', 'CRITICAL', 'WARNING')
+JSON_ERROR_LITERALS = ('"ERROR"', '"CRITICAL"', '"WARNING"')
+JSON_ERROR_RE = '"(?:level|levelname|severity)": ?"(?:ERROR|CRITICAL|WARNING)"'
+
 # our errors tend to look like: 
 # 13:21:05,115 ERROR [kitsap.controllers.api.persist] Client Error: at null 
 # and we want to extract 'kitsap' as the product
@@ -170,11 +280,23 @@ DATE_FMT= ('\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}.\d{3}',
            '\w{3} \d{1} \d{2}:\d{2}:\d{2}',
            '\d{2}:\d{2}:\d{2},\d{3}')
 
+# timestamps that are taken out of the message of an error without an
+# exception before it's compared with others, so repeats of it fold
+# together. Longer formats have to come first
+SIGNATURE_TIME_FORMATS = ('\d{4}-\d{2}-\d{2}[T ]\d{2}:\d{2}:\d{2}(?:[.,]\d+)?(?:Z|[+-]\d{2}:?\d{2})?',
+                          SYSLOG_DATE_FORMAT,
+                          MYSQL_DATE_FORMAT,
+                          '\d{2}:\d{2}:\d{2}(?:[.,]\d+)?')
+
 ###########################################
 # misc.
 ###########################################
 
 DIFFER_LOOP_TIME = 60 # how long to wait between processing for differ
+DIFFER_USE_INOTIFY = True # wait on inotify instead of polling, when available
+DIFFER_WATCH_COALESCE_TIME = 0.25 # gather a burst of inotify events into one scan
+DIFFER_WATCH_RESCAN_TIME = 3600 # full scan this often even when watching
+DIFFER_WORKERS = 0 # number of scanning processes, 0 scans everything in-process
 LOLFLY_LOOP_TIME = 300 # how long to wait between processing for lolfly
 MAX_BODY_LEN = 10000 # Max body for Fogbugz (not limited by Fogbugz, AFAIK)
 MAX_TITLE_LEN = 125  # Fogbugz truncates 128 characters + ...
@@ -188,3 +310,5 @@ MAX_MSG_LENGTH = 5000
 MAX_MSG_SUFFIX = '<snip>'
 MAX_LINES = 100 # max # of lines to pull for an error message
 MAX_MTIME = 86400 # don't look in files older than this
+DIGEST_SAMPLES = 10 # errors per file quoted in the differ report, the rest are counted
+DIGEST_MAX_BYTES = 1024 * 1024 # cap on the errors quoted in one differ report
@@ -0,0 +1,495 @@
+'''
+Copyright (c) 2012 Lolapps, Inc. All rights reserved.
+
+Redistribution and use in source and binary forms, with or without modification, are
+permitted provided that the following conditions are met:
+
+   1. Redistributions of source code must retain the above copyright notice, this list of
+      conditions and the following disclaimer.
+
+   2. Redistributions in binary form must reproduce the above copyright notice, this list
+      of conditions and the following disclaimer in the documentation and/or other materials
+      provided with the distribution.
+
+THIS SOFTWARE IS PROVIDED BY LOLAPPS, INC. ''AS IS'' AND ANY EXPRESS OR IMPLIED
+WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND
+FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL LOLAPPS, INC. OR
+CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON
+ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+The views and conclusions contained in the software and documentation are those of the
+authors and should not be interpreted as representing official policies, either expressed
+or implied, of Lolapps, Inc..
+
+--------------------------------------------------------------------------------------------
+
+spool.py
+
+An append-only on-disk journal that differ writes its errors to, and a
+drainer thread that forwards them to the database. Scanning never waits
+on MySQL this way: if the database is slow or down the spool just grows
+(up to DIFFER_SPOOL_MAX_BYTES) and is replayed when it comes back, even
+across restarts.
+
+The spool is a directory of numbered segment files. Each record is a
+4 byte length and 4 byte crc32 followed by a pickled dict of the
+add_differ_error arguments. The drainer keeps its position in a small
+offset file, and the database keeps the same position along with the
+rows it sent, so a record is forwarded once even if the drainer dies
+between the two. A torn write at the end of a segment is detected and
+skipped. A damaged record in the
+middle of a segment only costs that record, the drainer picks up again
+at the next intact one.
+
+'''
+
+import cPickle
+import os
+import struct
+import threading
+import time
+import uuid
+import zlib
+
+import sqlalchemy
+
+import collector
+import differdb
+import ratelimit
+import util
+
+from settings import *
+
+RECORD_HEADER = struct.Struct('>II')
+# how every record's payload starts, used to find our feet after a bad one
+PAYLOAD_MAGIC = cPickle.dumps(None, cPickle.HIGHEST_PROTOCOL)[:2]
+SEGMENT_SUFFIX = '.spool'
+OFFSET_FILE = 'drain.offset'
+SPOOL_ID_FILE = 'spool.id'
+
+
+def segment_name(number):
+    return '%012d%s' % (number, SEGMENT_SUFFIX)
+
+
+class DifferSpool(object):
+    """ The writing side of the spool. Has the same add_differ_error as
+    DifferDB, so differ can inject straight into it.
+    """
+
+    def __init__(self, directory=DIFFER_SPOOL_DIR, max_bytes=DIFFER_SPOOL_MAX_BYTES,
+                 segment_bytes=DIFFER_SPOOL_SEGMENT_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.segment_bytes = segment_bytes
+        self.lock = threading.Lock()
+        self.dropped = 0
+        self.dirty = False
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.spool_id = self.load_spool_id()
+
+        # never append to a segment left over from before a restart, its
+        # last record may be torn
+        segments = self.segments()
+        self.current = (segments[-1] + 1) if segments else 0
+        self.current_file = open(self.segment_path(self.current), 'ab')
+
+    def load_spool_id(self):
+        """ What the database knows this spool by. A new one is made up
+        with the directory, so a spool started over from nothing isn't
+        taken for one that's already been drained past its segments.
+        """
+        path = os.path.join(self.directory, SPOOL_ID_FILE)
+        try:
+            id_file = open(path, 'r')
+            spool_id = id_file.read().strip()
+            id_file.close()
+            if spool_id:
+                return spool_id
+        except IOError:
+            pass
+
+        spool_id = uuid.uuid4().hex
+        id_file = open(path + '.tmp', 'w')
+        id_file.write(spool_id + '\n')
+        id_file.flush()
+        os.fsync(id_file.fileno())
+        id_file.close()
+        os.rename(path + '.tmp', path)
+        return spool_id
+
+    def segment_path(self, number):
+        return os.path.join(self.directory, segment_name(number))
+
+    def segments(self):
+        """ Numbers of the segments on disk, oldest first.
+        """
+        numbers = []
+        for name in os.listdir(self.directory):
+            if name.endswith(SEGMENT_SUFFIX):
+                try:
+                    numbers.append(int(name[:-len(SEGMENT_SUFFIX)]))
+                except ValueError:
+                    pass
+        return sorted(numbers)
+
+    def size(self):
+        total = 0
+        for number in self.segments():
+            try:
+                total += os.path.getsize(self.segment_path(number))
+            except OSError:
+                pass
+        return total
+
+    def add_differ_error(self, logfile, product, code_location, code_method, error_message,
+                         exception, timestamp, host, occurrences=1, first_seen=None,
+                         last_seen=None):
+        record = {'logfile': logfile, 'product': product, 'code_location': code_location,
+                  'code_method': code_method, 'error_message': error_message,
+                  'exception': exception, 'timestamp': timestamp, 'host': host,
+                  'occurrences': occurrences, 'first_seen': first_seen,
+                  'last_seen': last_seen}
+        payload = cPickle.dumps(record, cPickle.HIGHEST_PROTOCOL)
+        header = RECORD_HEADER.pack(len(payload), zlib.crc32(payload) & 0xffffffff)
+
+        self.lock.acquire()
+        try:
+            self.current_file.write(header + payload)
+            self.current_file.flush()
+            self.dirty = True
+            if self.current_file.tell() >= self.segment_bytes:
+                self._roll()
+                self._enforce_size_cap()
+        finally:
+            self.lock.release()
+
+    def flush(self):
+        """ Make sure everything written so far is on disk. Call this
+        before recording scan offsets in the state file.
+        """
+        self.lock.acquire()
+        try:
+            if self.dirty:
+                self.current_file.flush()
+                os.fsync(self.current_file.fileno())
+                self.dirty = False
+        finally:
+            self.lock.release()
+
+    def _roll(self):
+        self.current_file.flush()
+        os.fsync(self.current_file.fileno())
+        self.dirty = False
+        self.current_file.close()
+        self.current += 1
+        self.current_file = open(self.segment_path(self.current), 'ab')
+
+    def _enforce_size_cap(self):
+        # throw away the oldest full segments rather than fill the disk
+        segments = self.segments()
+        total = self.size()
+        for number in segments[:-1]:
+            if total <= self.max_bytes:
+                break
+            path = self.segment_path(number)
+            try:
+                segment_size = os.path.getsize(path)
+                os.unlink(path)
+            except OSError:
+                continue
+            total -= segment_size
+            self.dropped += segment_size
+            util.write_log('spool over %s bytes, dropped %s (%s bytes)' %
+                           (self.max_bytes, path, segment_size))
+
+
+class RowList(object):
+    """ Where the drainer's ErrorAggregator and RateLimiter leave the rows
+    for its next insert_records.
+    """
+
+    def __init__(self):
+        self.rows = []
+
+    def add_differ_error(self, logfile, product, code_location, code_method, error_message,
+                         exception, timestamp, host, occurrences=1, first_seen=None,
+                         last_seen=None):
+        self.rows.append({'logfile': logfile, 'product': product,
+                          'code_location': code_location, 'code_method': code_method,
+                          'error_message': error_message, 'exception': exception,
+                          'timestamp': timestamp, 'host': host, 'occurrences': occurrences,
+                          'first_seen': first_seen, 'last_seen': last_seen})
+
+    def flush(self):
+        pass
+
+
+class SpoolDrainer(threading.Thread):
+    """ Forwards spooled records to the database, oldest first. Records
+    are read into a window of up to max_age seconds, repeats folded
+    together by an ErrorAggregator and runaway errors sampled by a
+    ratelimit.RateLimiter, and the window's rows go in as one
+    transaction. The saved offset only moves past records once their
+    rows are in, so a crash or restart reads the window again rather
+    than losing it. The database records where the window ends in the
+    same transaction, and a drainer starting up moves on to there if it's
+    past the saved offset, so a crash after the rows went in doesn't send
+    them again. When the database is unhappy it backs off, doubling the
+    wait up to DIFFER_SPOOL_MAX_BACKOFF.
+
+    differ_db can be anything with insert_records, such as a
+    collector.CollectorClient to go through a collector instead. One
+    without get_drain_position, like the collector, gets each record at
+    least once rather than exactly once.
+    """
+
+    def __init__(self, spool, differ_db=None, batch_size=DIFFER_BATCH_SIZE,
+                 max_age=DIFFER_AGGREGATE_SECONDS, max_groups=DIFFER_AGGREGATE_MAX_GROUPS):
+        threading.Thread.__init__(self, name='spool-drainer')
+        self.daemon = True
+        self.spool = spool
+        self.differ_db = differ_db
+        self.batch_size = batch_size
+        self.max_age = max_age
+        self.backoff = 0
+        self.rows_sent = 0
+        self.failures = 0
+        self.db_time = 0.0
+
+        # the window is kept here, so the aggregator sends everything on
+        # each flush
+        self.rows = RowList()
+        self.aggregator = differdb.ErrorAggregator(ratelimit.RateLimiter(self.rows),
+                                                   max_age=0, max_groups=max_groups)
+        self.window_start = None
+
+        # everything before segment and offset is in the database, and
+        # the records from there up to read_segment and read_offset are
+        # in the window
+        self.offset_path = os.path.join(spool.directory, OFFSET_FILE)
+        self.segment, self.offset = self.load_offset()
+        self.read_segment, self.read_offset = self.segment, self.offset
+        self.caught_up = False
+
+    def load_offset(self):
+        try:
+            offset_file = open(self.offset_path, 'r')
+            segment, offset = offset_file.read().split()
+            offset_file.close()
+            return int(segment), int(offset)
+        except (IOError, ValueError):
+            return 0, 0
+
+    def save_offset(self):
+        tmp_path = self.offset_path + '.tmp'
+        offset_file = open(tmp_path, 'w')
+        offset_file.write('%d %d\n' % (self.segment, self.offset))
+        offset_file.flush()
+        os.fsync(offset_file.fileno())
+        offset_file.close()
+        os.rename(tmp_path, self.offset_path)
+
+    def catch_up(self):
+        """ Move the saved offset up to the position the database has for
+        this spool, if that's further on. It only is if the drainer died
+        after its last window went in but before it saved the offset.
+        """
+        if self.differ_db is None:
+            self.differ_db = differdb.DifferDB()
+        if hasattr(self.differ_db, 'get_drain_position'):
+            position = self.differ_db.get_drain_position(self.spool.spool_id)
+            if position is not None and position > (self.segment, self.offset):
+                util.write_log('spool already drained up to %s:%s, skipping there' % position)
+                finished = range(self.segment, position[0])
+                self.segment, self.offset = position
+                self.read_segment, self.read_offset = position
+                self.save_offset()
+                self.delete_segments(finished)
+        self.caught_up = True
+
+    def delete_segments(self, numbers):
+        self.spool.lock.acquire()
+        try:
+            for number in numbers:
+                try:
+                    os.unlink(self.spool.segment_path(number))
+                except OSError:
+                    pass
+        finally:
+            self.spool.lock.release()
+
+    def read_batch(self):
+        """ Returns the next batch of records and moves the read position
+        past them, going on to the next segment when one is done.
+        """
+        while True:
+            segments = self.spool.segments()
+            if not segments:
+                return []
+            if self.read_segment not in segments:
+                # dropped by the size cap, or the first run
+                later = [number for number in segments if number > self.read_segment]
+                self.read_segment = later[0] if later else segments[0]
+                self.read_offset = 0
+
+            records, offset, torn = self.read_records(self.read_segment, self.read_offset)
+            if records or self.read_segment >= self.spool.current:
+                self.read_offset = offset
+                return records
+
+            if torn:
+                # only the end of the segment being written can be torn, so
+                # this is damage in the middle of an old one. Skip to the
+                # next intact record rather than lose the rest of it
+                resume = self.resync(self.read_segment, offset)
+                if resume is not None:
+                    util.write_log('skipping %s damaged bytes at %s:%s' %
+                                   (resume - offset, self.read_segment, offset))
+                    self.read_offset = resume
+                    continue
+                util.write_log('skipping torn record at %s:%s' % (self.read_segment, offset))
+
+            # an old segment with nothing left in it, it's deleted once
+            # what was read from it is in the database
+            self.read_segment += 1
+            self.read_offset = 0
+
+    def read_records(self, segment, offset):
+        records = []
+        try:
+            segment_file = open(self.spool.segment_path(segment), 'rb')
+        except IOError:
+            return records, offset, False
+
+        try:
+            segment_file.seek(offset)
+            while len(records) < self.batch_size:
+                header = segment_file.read(RECORD_HEADER.size)
+                if len(header) < RECORD_HEADER.size:
+                    return records, offset, bool(header)
+                length, crc = RECORD_HEADER.unpack(header)
+                payload = segment_file.read(length)
+                if len(payload) < length or zlib.crc32(payload) & 0xffffffff != crc:
+                    return records, offset, True
+                records.append(cPickle.loads(payload))
+                offset += RECORD_HEADER.size + length
+        finally:
+            segment_file.close()
+        return records, offset, False
+
+    def resync(self, segment, offset):
+        """ Where the first intact record after the damaged one at offset
+        starts, or None if there's nothing intact left in the segment. A
+        record is taken to start wherever a header is followed by a
+        payload that looks like a pickle and matches its crc.
+        """
+        try:
+            segment_file = open(self.spool.segment_path(segment), 'rb')
+        except IOError:
+            return None
+        try:
+            segment_file.seek(offset)
+            data = segment_file.read()
+        finally:
+            segment_file.close()
+
+        start = data.find(PAYLOAD_MAGIC, RECORD_HEADER.size + 1)
+        while start >= 0:
+            header = start - RECORD_HEADER.size
+            length, crc = RECORD_HEADER.unpack_from(data, header)
+            payload = data[start:start + length]
+            if len(payload) == length and zlib.crc32(payload) & 0xffffffff == crc:
+                return offset + header
+            start = data.find(PAYLOAD_MAGIC, start + 1)
+        return None
+
+    def commit(self):
+        """ Send the window to the database and move the saved offset up
+        to the read position, deleting the segments that leaves behind.
+        Returns False if the database wouldn't take it, in which case the
+        rows are kept to try again.
+        """
+        self.aggregator.flush(force=True)
+        rows = self.rows.rows
+        if rows:
+            start = time.time()
+            try:
+                if self.differ_db is None:
+                    self.differ_db = differdb.DifferDB()
+                if hasattr(self.differ_db, 'get_drain_position'):
+                    position = {'spool_id': self.spool.spool_id,
+                                'segment': self.read_segment,
+                                'segment_offset': self.read_offset}
+                    self.differ_db.insert_records(rows, position)
+                else:
+                    self.differ_db.insert_records(rows)
+            except (sqlalchemy.exceptions.SQLAlchemyError, collector.CollectorError), e:
+                util.write_log('spool drain failed: %s' % e)
+                self.failures += 1
+                return False
+            finally:
+                self.db_time += time.time() - start
+            self.rows_sent += len(rows)
+            self.rows.rows = []
+        self.window_start = None
+
+        if (self.segment, self.offset) == (self.read_segment, self.read_offset):
+            return True
+        finished = range(self.segment, self.read_segment)
+        self.segment, self.offset = self.read_segment, self.read_offset
+        self.save_offset()
+        self.delete_segments(finished)
+        return True
+
+    def drain_once(self, force=False):
+        """ Read the next batch into the window, and send the window on if
+        it's max_age old, the aggregator is full, or force is set.
+        Returns how many records were read, or None if the database
+        wouldn't take what was due.
+        """
+        if not self.caught_up:
+            try:
+                self.catch_up()
+            except (sqlalchemy.exceptions.SQLAlchemyError, collector.CollectorError), e:
+                util.write_log('spool drain failed: %s' % e)
+                self.failures += 1
+                return None
+
+        if self.rows.rows and not self.commit():
+            # still failing from last time, don't read any further
+            return None
+
+        records = self.read_batch()
+        for record in records:
+            self.aggregator.add_differ_error(**record)
+        if records and self.window_start is None:
+            self.window_start = time.time()
+
+        if force or self.window_start is None or self.rows.rows or \
+           time.time() - self.window_start >= self.max_age:
+            if not self.commit():
+                return None
+        return len(records)
+
+    def run(self):
+        while True:
+            try:
+                sent = self.drain_once()
+            except Exception, e:
+                util.write_log('spool drainer error: %s' % e)
+                sent = None
+
+            if sent is None:
+                self.backoff = min(max(self.backoff * 2, 1), DIFFER_SPOOL_MAX_BACKOFF)
+                time.sleep(self.backoff)
+            else:
+                self.backoff = 0
+                if not sent:
+                    time.sleep(DIFFER_SPOOL_IDLE_TIME)
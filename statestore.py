@@ -0,0 +1,275 @@
+'''
+Copyright (c) 2012 Lolapps, Inc. All rights reserved.
+
+Redistribution and use in source and binary forms, with or without modification, are
+permitted provided that the following conditions are met:
+
+   1. Redistributions of source code must retain the above copyright notice, this list of
+      conditions and the following disclaimer.
+
+   2. Redistributions in binary form must reproduce the above copyright notice, this list
+      of conditions and the following disclaimer in the documentation and/or other materials
+      provided with the distribution.
+
+THIS SOFTWARE IS PROVIDED BY LOLAPPS, INC. ''AS IS'' AND ANY EXPRESS OR IMPLIED
+WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND
+FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL LOLAPPS, INC. OR
+CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON
+ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+The views and conclusions contained in the software and documentation are those of the
+authors and should not be interpreted as representing official policies, either expressed
+or implied, of Lolapps, Inc..
+
+--------------------------------------------------------------------------------------------
+
+statestore.py
+
+Crash-safe storage for differ's per-file state (offsets and file
+identity), replacing the pickled STATEFILE.
+
+The state lives in two files:
+
+ STATEFILE          a snapshot of the whole dict, rewritten atomically
+                    (write a temp file, fsync, rename) on full scans
+ STATEFILE.journal  per-file updates appended and fsynced as each file
+                    is finished, so a crash mid-cycle only loses the
+                    file being scanned at the time
+
+Both start with a small versioned header and carry a generation number;
+a journal is only replayed onto the snapshot of the same generation.
+Entries are JSON, so the files mean the same thing to any version of
+Python. Strings go through latin-1 on the way in and out, which turns
+any path back into exactly the bytes it was. Old pickle state files are
+read and converted.
+
+'''
+
+import json
+import os
+import pickle
+import struct
+import zlib
+
+import util
+
+from settings import *
+
+STATE_VERSION = 3
+SNAPSHOT_MAGIC = 'DFST'
+JOURNAL_MAGIC = 'DFSJ'
+# magic, version, generation
+FILE_HEADER = struct.Struct('>4sHI')
+# length, crc32
+RECORD_HEADER = struct.Struct('>II')
+
+
+def encode(value):
+    return json.dumps(value, encoding='latin-1', separators=(',', ':'))
+
+def _to_bytes(value):
+    if isinstance(value, unicode):
+        return value.encode('latin-1')
+    if isinstance(value, list):
+        return [_to_bytes(item) for item in value]
+    return value
+
+def _bytes_object(pairs):
+    return dict((_to_bytes(key), _to_bytes(value)) for key, value in pairs)
+
+def decode(payload):
+    return _to_bytes(json.loads(payload, object_pairs_hook=_bytes_object))
+
+
+class StateStore(object):
+
+    def __init__(self, filename=STATEFILE):
+        self.filename = filename
+        self.journal_name = filename + '.journal'
+        self.state = None
+        self.generation = 0
+        self.written = {} # what the journal + snapshot say for each file
+        self.journal = None
+
+    def load(self):
+        """ Returns the state dict, reading it from disk the first time.
+        """
+        if self.state is not None:
+            return self.state
+
+        self.state = self._read_snapshot()
+        replayed = self._replay_journal()
+        if replayed:
+            util.write_log('replayed %s state update(s) from %s' % (replayed, self.journal_name))
+        self.written = dict((path, dict(entry)) for path, entry in self.state.items())
+        return self.state
+
+    def checkpoint(self, path, entry):
+        """ Durably record that path now looks like entry. Cheap to call
+        when nothing has changed.
+        """
+        if self.written.get(path) == entry:
+            return
+        if self.journal is None:
+            self._start_journal(append=True)
+
+        self._write_record(self.journal, encode((path, entry)))
+        self.journal.flush()
+        os.fsync(self.journal.fileno())
+        self.written[path] = dict(entry)
+
+    def journal_size(self):
+        """ How many bytes of updates save() would fold into the snapshot.
+        """
+        if self.journal is None:
+            return 0
+        return os.fstat(self.journal.fileno()).st_size
+
+    def save(self, state):
+        """ Write out a fresh snapshot of state and start an empty
+        journal on top of it.
+        """
+        self.state = state
+        self.generation += 1
+
+        payload = encode(state)
+        tmp_name = self.filename + '.tmp'
+        snapshot = open(tmp_name, 'wb')
+        snapshot.write(FILE_HEADER.pack(SNAPSHOT_MAGIC, STATE_VERSION, self.generation))
+        self._write_record(snapshot, payload)
+        snapshot.flush()
+        os.fsync(snapshot.fileno())
+        snapshot.close()
+        os.rename(tmp_name, self.filename)
+        self._fsync_directory()
+
+        # the old journal is for the old generation, so it's harmless if
+        # we die before replacing it
+        self._start_journal(append=False)
+        self.written = dict((path, dict(entry)) for path, entry in state.items())
+
+    def _write_record(self, output, payload):
+        output.write(RECORD_HEADER.pack(len(payload), zlib.crc32(payload) & 0xffffffff))
+        output.write(payload)
+
+    def _read_record(self, input):
+        header = input.read(RECORD_HEADER.size)
+        if len(header) < RECORD_HEADER.size:
+            return None
+        length, crc = RECORD_HEADER.unpack(header)
+        payload = input.read(length)
+        if len(payload) < length or zlib.crc32(payload) & 0xffffffff != crc:
+            return None
+        return payload
+
+    def _read_snapshot(self):
+        try:
+            snapshot = open(self.filename, 'rb')
+        except IOError:
+            # On a new host, a state file may not be around.
+            return {}
+
+        try:
+            header = snapshot.read(FILE_HEADER.size)
+            if len(header) == FILE_HEADER.size and header.startswith(SNAPSHOT_MAGIC):
+                magic, version, generation = FILE_HEADER.unpack(header)
+                payload = self._read_record(snapshot)
+                if version == STATE_VERSION and payload is not None:
+                    self.generation = generation
+                    return decode(payload)
+            else:
+                # a state file from before we had a format of our own
+                snapshot.seek(0)
+                state = pickle.load(snapshot)
+                util.write_log('converting pickled state file %s' % self.filename)
+                return state
+        except Exception, e:
+            util.write_log('unable to read state file %s: %s' % (self.filename, e))
+        finally:
+            snapshot.close()
+
+        # keep the bad file around to look at rather than silently
+        # starting over on top of it
+        util.write_log('state file %s is unreadable, moving it aside and rescanning' %
+                       self.filename)
+        os.rename(self.filename, self.filename + '.corrupt')
+        return {}
+
+    def _open_journal(self):
+        """ Opens the journal and reads past its header. Returns None if
+        there isn't one, or it doesn't go with the snapshot we loaded.
+        """
+        try:
+            journal = open(self.journal_name, 'rb')
+        except IOError:
+            return None
+
+        header = journal.read(FILE_HEADER.size)
+        if len(header) == FILE_HEADER.size:
+            magic, version, generation = FILE_HEADER.unpack(header)
+            if magic == JOURNAL_MAGIC and version == STATE_VERSION and \
+               generation == self.generation:
+                return journal
+        journal.close()
+        return None
+
+    def _replay_journal(self):
+        journal = self._open_journal()
+        if journal is None:
+            return 0
+
+        replayed = 0
+        try:
+            while True:
+                # a torn record at the end is the update we crashed in
+                # the middle of writing, so stop there
+                payload = self._read_record(journal)
+                if payload is None:
+                    break
+                path, entry = decode(payload)
+                self.state[path] = entry
+                replayed += 1
+        finally:
+            journal.close()
+        return replayed
+
+    def _start_journal(self, append):
+        if self.journal is not None:
+            self.journal.close()
+            self.journal = None
+
+        if append:
+            # carry on with the journal that goes with our snapshot,
+            # cutting off any torn record at the end first
+            journal = self._open_journal()
+            if journal is not None:
+                end = journal.tell()
+                while self._read_record(journal) is not None:
+                    end = journal.tell()
+                journal.close()
+
+                self.journal = open(self.journal_name, 'r+b')
+                self.journal.truncate(end)
+                self.journal.seek(end)
+                return
+
+        tmp_name = self.journal_name + '.tmp'
+        journal = open(tmp_name, 'wb')
+        journal.write(FILE_HEADER.pack(JOURNAL_MAGIC, STATE_VERSION, self.generation))
+        journal.flush()
+        os.fsync(journal.fileno())
+        journal.close()
+        os.rename(tmp_name, self.journal_name)
+        self._fsync_directory()
+        self.journal = open(self.journal_name, 'ab')
+
+    def _fsync_directory(self):
+        directory = os.open(os.path.dirname(os.path.abspath(self.filename)), os.O_RDONLY)
+        try:
+            os.fsync(directory)
+        finally:
+            os.close(directory)
@@ -54,6 +54,15 @@ def truncate_error_message(error_message, length=146, suffix='...'):
     return bug_title
 
 
+# the counts come from differ_rollups, which only knows fingerprints, so
+# say what they are
+COUNTS_NOTE = '''Counts are every time an error was seen since the start, to the minute,
+for errors that have been filed, including the times since they were filed.
+Errors without an exception are counted by product, code location and method,
+under the case filed for them last.
+
+'''
+
 def SummarizeFiledErrors(start, product='%%'):
     """
     Takes 1 argument, which is the start time in epoch of when to look for errors
@@ -69,6 +78,9 @@ def SummarizeFiledErrors(start, product='%%'):
     warnings = list(differ.get_grouped_warnings(start, product))
     fbz = fbz_filer.main()
 
+    if errors:
+        msg += COUNTS_NOTE
+
     for i in errors:
         fbz_case = i.fbz_case
         bug_count = i.count
@@ -84,7 +96,7 @@ def SummarizeFiledErrors(start, product='%%'):
             product_totals[product] = bug_count
         total += bug_count
 
-        msg += '%s case(s) filed : %s/?%s\n' % (bug_count, lolfly.FBZ_URL, fbz_case)
+        msg += '%s error(s) seen, filed as : %s/?%s\n' % (bug_count, lolfly.FBZ_URL, fbz_case)
 
         if exception != None:
             msg += '%s %s %s in %s\n' % (product, exception, code_location, code_method)
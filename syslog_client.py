@@ -50,6 +50,15 @@ Usage:
 >>> c = syslog_client (('other_host.com', 514))
 >>> c.log ('testing', facility='local0', priority='debug')
 
+For sending a lot of messages there's also a TCP client, which keeps
+one connection open, frames messages with RFC 6587 octet counting,
+and never blocks the caller: log() queues, and flush() sends whatever
+the socket will take right now.
+
+>>> c = syslog_stream_client (('other_host.com', 514))
+>>> c.log ('testing', facility='local0', priority='debug')
+>>> c.flush()
+
 """
 
 # TODO: support named-pipe syslog.
@@ -134,7 +143,12 @@ facility_names = {
 	"local7":	LOG_LOCAL7,
 	}
 
+import collections
+import errno
+import select
 import socket
+import threading
+import time
 
 class syslog_client:
 	def __init__ (self, address='/dev/log'):
@@ -171,7 +185,210 @@ class syslog_client:
 			priority = priority_names[priority]			
 		return (facility<<3) | priority
 
+	def flush (self):
+		# every message has already gone out, this is here so the
+		# stream client can be used in place of this one
+		pass
+
 	def close (self):
 		if self.unix:
 			self.socket.close()
 
+class syslog_stream_client (syslog_client):
+	"""Syslog over a persistent TCP connection.
+
+	Messages are framed as "<length> <message>" (RFC 6587 octet
+	counting) so they can hold newlines. log() only adds to a queue of
+	at most max_queue messages, dropping the oldest when it's full and
+	counting them in self.dropped. flush() writes batches of batch_size
+	messages to a non-blocking socket until it would block, and leaves
+	the rest for the next call. log() flushes by itself once a batch's
+	worth is waiting.
+
+	Connecting doesn't block either. flush() starts the connection and
+	later flushes finish it once the socket is writable, giving up after
+	connect_timeout seconds. When the connection can't be made or is
+	lost, the unsent messages stay queued and connecting is retried on
+	later flushes, backing off from 1 second up to max_backoff.
+
+	The address is looked up once, when the client is made. When that
+	fails or the connection does, it's looked up again in a thread of
+	its own, so a slow DNS server never holds up log() or flush().
+	"""
+
+	def __init__ (self, address, max_queue=10000, batch_size=100, max_backoff=60,
+				  connect_timeout=5):
+		self.address = address
+		self.max_queue = max_queue
+		self.batch_size = batch_size
+		self.max_backoff = max_backoff
+		self.connect_timeout = connect_timeout
+		self.socket = None
+		self.connecting = 0
+		self.connect_deadline = 0
+		self.queue = collections.deque()
+		self.batch = [] # the messages in self.buffer
+		self.buffer = ''
+		self.sent = 0 # how much of self.buffer has gone out
+		self.backoff = 0
+		self.next_attempt = 0
+		self.dropped = 0
+		self.resolver = None
+		self.resolved = self.resolve()
+
+	log_format_string = '<%d>%s'
+
+	def log (self, message, facility=LOG_USER, priority=LOG_INFO):
+		message = self.log_format_string % (
+			self.encode_priority (facility, priority),
+			message
+			)
+		self.queue.append ('%d %s' % (len(message), message))
+		if len(self.queue) > self.max_queue:
+			self.queue.popleft()
+			self.dropped = self.dropped + 1
+		if len(self.queue) >= self.batch_size:
+			self.flush()
+
+	def pending (self):
+		return len(self.queue) + len(self.batch)
+
+	def resolve (self):
+		"""(family, socktype, proto, address) to connect to, or None if
+		the address can't be looked up. Can block on DNS."""
+		try:
+			family, socktype, proto, _, address = socket.getaddrinfo (
+				self.address[0], self.address[1], 0, socket.SOCK_STREAM)[0]
+		except socket.error:
+			return None
+		return family, socktype, proto, address
+
+	def start_resolving (self):
+		"""Look the address up again in the background, for the next
+		connect() to use."""
+		if self.resolver is not None and self.resolver.isAlive():
+			return
+		def run ():
+			resolved = self.resolve()
+			if resolved is not None:
+				self.resolved = resolved
+		self.resolver = threading.Thread (target=run, name='syslog-resolver')
+		self.resolver.setDaemon (1)
+		self.resolver.start()
+
+	def connect (self):
+		"""Start connecting. Returns true if the connection is already up,
+		otherwise finish_connect() says when it is."""
+		now = time.time()
+		if now < self.next_attempt:
+			return 0
+		if self.resolved is None:
+			self.disconnect()
+			return 0
+		family, socktype, proto, address = self.resolved
+		try:
+			self.socket = socket.socket (family, socktype, proto)
+			self.socket.setblocking (0)
+			error = self.socket.connect_ex (address)
+		except socket.error:
+			self.disconnect()
+			return 0
+		if error not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EINTR):
+			self.disconnect()
+			return 0
+		self.connecting = 1
+		self.connect_deadline = now + self.connect_timeout
+		return self.finish_connect()
+
+	def finish_connect (self):
+		"""Returns true once the connection started by connect() is up."""
+		try:
+			_, writable, _ = select.select ([], [self.socket], [], 0)
+			if not writable:
+				if time.time() >= self.connect_deadline:
+					self.disconnect()
+				return 0
+			error = self.socket.getsockopt (socket.SOL_SOCKET, socket.SO_ERROR)
+		except socket.error:
+			error = 1
+		if error:
+			self.disconnect()
+			return 0
+		self.connecting = 0
+		return 1
+
+	def disconnect (self):
+		self.backoff = min (max (self.backoff * 2, 1), self.max_backoff)
+		# the address may have moved, have it ready for the next try
+		self.start_resolving()
+		if self.socket is not None:
+			self.socket.close()
+			self.socket = None
+		self.connecting = 0
+		# whatever was cut off mid batch goes out again, from the first
+		# message that didn't make it all the way
+		offset = 0
+		unsent = []
+		for message in self.batch:
+			offset = offset + len(message)
+			if offset > self.sent:
+				unsent.append (message)
+		self.queue.extendleft (reversed (unsent))
+		self.batch = []
+		self.buffer = ''
+		self.sent = 0
+		self.next_attempt = time.time() + self.backoff
+
+	def peer_closed (self):
+		# syslog servers never talk back, so anything to read means the
+		# other end has gone away. Catching that here keeps the next
+		# batch from being written into a dead connection
+		try:
+			readable, _, _ = select.select ([self.socket], [], [], 0)
+			return bool(readable) and not self.socket.recv (4096)
+		except socket.error:
+			return 1
+
+	def flush (self):
+		"""Send what the socket will take without blocking. Returns true
+		once nothing is left waiting."""
+		if self.connecting and not self.finish_connect():
+			return not (self.batch or self.queue)
+		if self.socket is not None and (self.batch or self.queue) and self.peer_closed():
+			self.disconnect()
+		while self.batch or self.queue:
+			if self.socket is None and not self.connect():
+				return 0
+			if not self.batch:
+				while self.queue and len(self.batch) < self.batch_size:
+					self.batch.append (self.queue.popleft())
+				self.buffer = ''.join (self.batch)
+				self.sent = 0
+			try:
+				self.sent = self.sent + self.socket.send (buffer (self.buffer, self.sent))
+			except socket.error, why:
+				if why[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+					return 0
+				self.disconnect()
+				continue
+			self.backoff = 0
+			if self.sent >= len(self.buffer):
+				self.batch = []
+				self.buffer = ''
+				self.sent = 0
+		return 1
+
+	def close (self, timeout=5):
+		"""Give the queue up to timeout seconds to drain, then hang up."""
+		deadline = time.time() + timeout
+		while not self.flush():
+			remaining = deadline - time.time()
+			if remaining <= 0:
+				break
+			if self.socket is None:
+				time.sleep (min (remaining, max (self.next_attempt - time.time(), 0.01)))
+			else:
+				select.select ([], [self.socket], [], remaining)
+		if self.socket is not None:
+			self.socket.close()
+			self.socket = None
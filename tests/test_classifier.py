@@ -0,0 +1,137 @@
+'''
+Copyright (c) 2012 Lolapps, Inc. All rights reserved.
+
+Redistribution and use in source and binary forms, with or without modification, are
+permitted provided that the following conditions are met:
+
+   1. Redistributions of source code must retain the above copyright notice, this list of
+      conditions and the following disclaimer.
+
+   2. Redistributions in binary form must reproduce the above copyright notice, this list
+      of conditions and the following disclaimer in the documentation and/or other materials
+      provided with the distribution.
+
+THIS SOFTWARE IS PROVIDED BY LOLAPPS, INC. ''AS IS'' AND ANY EXPRESS OR IMPLIED
+WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND
+FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL LOLAPPS, INC. OR
+CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON
+ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+The views and conclusions contained in the software and documentation are those of the
+authors and should not be interpreted as representing official policies, either expressed
+or implied, of Lolapps, Inc..
+
+--------------------------------------------------------------------------------------------
+
+test_classifier.py
+
+Checks that util.LineClassifier, which rewrites ERROR_RE before
+compiling it, says the same thing about a line as running each of the
+original patterns over it the way scan_file used to.
+
+'''
+
+import random
+import re
+import unittest
+
+import parsers
+import util
+
+from settings import *
+
+# (error_re, date formats, end_re) that aren't in settings, with | inside
+# groups and character classes and escapes split_alternation has to see past
+ODD_PATTERNS = [
+    (r'(\sERROR[|x]|^\s*(?:Traceback|Oops)|foo(a|b)bar|\s+WARN(?:ING)?\s+)',
+     (PASTE_DATE_FORMAT,), ERROR_END_RE),
+    (r'(?:\[(?:ERROR|FATAL)\]|x\|y|^[|]pipe|\s+(CRIT|ALERT)\s+)',
+     (PYLONS_DATE_FORMAT, SYSLOG_DATE_FORMAT), r'(done|over)'),
+    (r'\s+Error\s+|^\s\s+at |\\|[a|b]c',
+     (PASTE_DATE_FORMAT, PYLONS_DATE_FORMAT), ERROR_END_RE),
+]
+
+FRAGMENTS = ['', ' ', '  ', '\t', 'ERROR', 'ERROR?', 'ERROR ', 'WARNING', ' WARNING ',
+             'WARN', 'Traceback', 'Error', 'error', '  File ', 'File', 'InnoDB: Error:',
+             'InnoDB: Error', '[ERROR]', '[FATAL]', 'FATAL', 'CRIT', ' ALERT ', 'x|y', '|pipe',
+             'fooabar', 'foobbar', 'foo|bar', 'ac', 'bc', '|c', '\\', 'at ', 'Oops',
+             '12:34:56', '2012-01-02 12:34:56', 'Jan  2 12:34:56', '120102 12:34:56',
+             'DeprecationWarning', 'done', '[drm:edid_is_valid]', 'kitsap.api', ',115',
+             'Hardware event', 'mcelog: ', '"level": "ERROR"', '{', 'x', '|', '[', ']']
+
+
+def reference_kind(line, error_re, date_formats, end_re, ignore_errors):
+    """ What scan_file made of a line before LineClassifier: the error
+    regex searched as written, IGNORE_ERRORS one at a time, and the date
+    formats matched one at a time.
+    """
+    if re.search(error_re, line):
+        if not [exp for exp in ignore_errors if re.search(exp, line)]:
+            return util.START
+        kind = util.IGNORE
+    else:
+        kind = util.CONTINUE
+    if [fmt for fmt in date_formats if re.match(fmt, line)] or re.search(end_re, line):
+        return util.END
+    return kind
+
+
+def sample_lines(count, seed=0):
+    rand = random.Random(seed)
+    lines = []
+    for i in xrange(count):
+        parts = [rand.choice(FRAGMENTS) for j in xrange(rand.randint(1, 5))]
+        lines.append(rand.choice(['', ' ']).join(parts))
+    return lines
+
+
+class ClassifierTest(unittest.TestCase):
+
+    def assertClassifiesLike(self, error_re, date_formats, end_re,
+                             ignore_errors=IGNORE_ERRORS, literals=None):
+        classifier = util.LineClassifier(error_re, end_re, date_formats,
+                                         ignore_errors=ignore_errors, literals=literals)
+        find = classifier.start_finder()
+        for line in sample_lines(20000) + FRAGMENTS:
+            expected = reference_kind(line, error_re, date_formats, end_re, ignore_errors)
+            self.assertEqual(classifier.classify(line), expected,
+                             '%r on %r: %s != %s' % (error_re, line,
+                                                     classifier.classify(line), expected))
+            self.assertEqual(classifier.new_entry(line),
+                             bool([fmt for fmt in date_formats if re.match(fmt, line)]))
+            if expected == util.START:
+                # the literal prefilter must never skip a line that starts an error
+                self.assertNotEqual(find(line), -1, '%r skipped %r' % (error_re, line))
+
+    def test_settings_patterns(self):
+        self.assertClassifiesLike(ERROR_RE, (PASTE_DATE_FORMAT, PYLONS_DATE_FORMAT),
+                                  ERROR_END_RE, literals=ERROR_LITERALS)
+
+    def test_format_patterns(self):
+        for log_format in parsers.FORMATS + [parsers.GENERIC]:
+            literals = log_format.literals
+            if literals is None and log_format.error_re == ERROR_RE:
+                literals = ERROR_LITERALS
+            self.assertClassifiesLike(log_format.error_re, log_format.entry_re,
+                                      log_format.end_re, literals=literals)
+
+    def test_odd_patterns(self):
+        for error_re, date_formats, end_re in ODD_PATTERNS:
+            self.assertClassifiesLike(error_re, date_formats, end_re, ignore_errors=())
+            self.assertClassifiesLike(error_re, date_formats, end_re)
+
+    def test_split_alternation(self):
+        self.assertEqual(util.split_alternation(r'(a|b(c|d)|[|]|\|)'),
+                         ['a', 'b(c|d)', '[|]', r'\|'])
+        self.assertEqual(util.split_alternation(r'(a)|(b)'), ['(a)', '(b)'])
+        self.assertEqual(util.split_alternation(r'(?:a|b)'), ['a', 'b'])
+        self.assertEqual(util.split_alternation(r'(a|b'), None)
+        self.assertEqual(util.split_alternation(r'[a|b'), None)
+
+
+if __name__ == '__main__':
+    unittest.main()
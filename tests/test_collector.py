@@ -0,0 +1,93 @@
+'''
+Copyright (c) 2012 Lolapps, Inc. All rights reserved.
+
+Redistribution and use in source and binary forms, with or without modification, are
+permitted provided that the following conditions are met:
+
+   1. Redistributions of source code must retain the above copyright notice, this list of
+      conditions and the following disclaimer.
+
+   2. Redistributions in binary form must reproduce the above copyright notice, this list
+      of conditions and the following disclaimer in the documentation and/or other materials
+      provided with the distribution.
+
+THIS SOFTWARE IS PROVIDED BY LOLAPPS, INC. ''AS IS'' AND ANY EXPRESS OR IMPLIED
+WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND
+FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL LOLAPPS, INC. OR
+CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON
+ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+The views and conclusions contained in the software and documentation are those of the
+authors and should not be interpreted as representing official policies, either expressed
+or implied, of Lolapps, Inc..
+
+--------------------------------------------------------------------------------------------
+
+test_collector.py
+
+What the collector turns away before it gets near the database: frames
+that inflate too far, and records whose fields aren't what a differ
+sends.
+
+'''
+
+import socket
+import unittest
+import zlib
+
+import collector
+
+
+def record(**fields):
+    base = {'logfile': '/var/log/app.log', 'product': None, 'code_location': None,
+            'code_method': None, 'error_message': 'ERROR: boom', 'exception': None,
+            'timestamp': 1349000000, 'host': 'web1', 'occurrences': 1,
+            'first_seen': None, 'last_seen': None}
+    base.update(fields)
+    return base
+
+
+class ReadFrameTest(unittest.TestCase):
+
+    def read(self, frame, **limits):
+        ours, theirs = socket.socketpair()
+        try:
+            theirs.sendall(frame)
+            theirs.close()
+            return collector.read_frame(ours, **limits)
+        finally:
+            ours.close()
+
+    def test_round_trip(self):
+        self.assertEqual(self.read(collector.encode_frame([record()])), [record()])
+
+    def test_inflating_too_far_is_refused(self):
+        body = zlib.compress('[' + ' ' * 100000 + ']')
+        frame = collector.FRAME_HEADER.pack(len(body)) + body
+        self.assertEqual(self.read(frame, max_payload=100002), [])
+        self.assertRaises(collector.CollectorError, self.read, frame, max_payload=1000)
+
+
+class CheckRecordsTest(unittest.TestCase):
+
+    def test_good_records_pass(self):
+        checked = collector.check_records([record(), record(product=u'app', first_seen=1)])
+        self.assertEqual(len(checked), 2)
+
+    def test_bad_types_are_refused(self):
+        for fields in ({'error_message': ['not', 'a', 'string']},
+                       {'host': 12},
+                       {'logfile': None},
+                       {'timestamp': '1349000000'},
+                       {'timestamp': 1349000000.5},
+                       {'occurrences': True},
+                       {'last_seen': {}}):
+            self.assertRaises(collector.CollectorError, collector.check_records,
+                              [record(**fields)])
+
+if __name__ == '__main__':
+    unittest.main()
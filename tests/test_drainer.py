@@ -0,0 +1,339 @@
+'''
+Copyright (c) 2012 Lolapps, Inc. All rights reserved.
+
+Redistribution and use in source and binary forms, with or without modification, are
+permitted provided that the following conditions are met:
+
+   1. Redistributions of source code must retain the above copyright notice, this list of
+      conditions and the following disclaimer.
+
+   2. Redistributions in binary form must reproduce the above copyright notice, this list
+      of conditions and the following disclaimer in the documentation and/or other materials
+      provided with the distribution.
+
+THIS SOFTWARE IS PROVIDED BY LOLAPPS, INC. ''AS IS'' AND ANY EXPRESS OR IMPLIED
+WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND
+FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL LOLAPPS, INC. OR
+CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON
+ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+The views and conclusions contained in the software and documentation are those of the
+authors and should not be interpreted as representing official policies, either expressed
+or implied, of Lolapps, Inc..
+
+--------------------------------------------------------------------------------------------
+
+test_drainer.py
+
+The SpoolDrainer's end of differ: repeats folded together, runaway errors
+sampled, and spooled records only let go of once their rows are in, and
+only ever sent once. Damaged and torn records are skipped.
+
+'''
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import sqlalchemy
+
+import spool
+
+from settings import *
+
+
+class FakeDB(object):
+    """ Takes what a SpoolDrainer sends, failing the first few times if
+    asked to.
+    """
+
+    def __init__(self, failures=0):
+        self.rows = []
+        self.failures = failures
+
+    def insert_records(self, records):
+        if self.failures:
+            self.failures -= 1
+            raise sqlalchemy.exceptions.OperationalError('insert', {}, Exception('down'))
+        self.rows.extend(records)
+
+
+class PositionDB(FakeDB):
+    """ A FakeDB that keeps drain positions along with the rows, the way
+    DifferDB does.
+    """
+
+    def __init__(self, failures=0):
+        FakeDB.__init__(self, failures)
+        self.positions = {}
+
+    def insert_records(self, records, drain_position=None):
+        FakeDB.insert_records(self, records)
+        if drain_position is not None:
+            self.positions[drain_position['spool_id']] = (drain_position['segment'],
+                                                          drain_position['segment_offset'])
+
+    def get_drain_position(self, spool_id):
+        return self.positions.get(spool_id)
+
+
+class Crash(Exception):
+    pass
+
+
+def record(message, exception=None, timestamp=1000, logfile='/var/log/app.log'):
+    return {'logfile': logfile, 'product': 'kitsap',
+            'code_location': exception and '/var/www/kitsap/api.py',
+            'code_method': exception and 'persist', 'error_message': message,
+            'exception': exception, 'timestamp': timestamp, 'host': 'web1'}
+
+
+class DrainerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.spool = spool.DifferSpool(self.directory)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def drain(self, records, db=None, **kwargs):
+        for error in records:
+            self.spool.add_differ_error(**error)
+        self.spool.flush()
+        db = db or FakeDB()
+        drainer = spool.SpoolDrainer(self.spool, db, **kwargs)
+        while drainer.drain_once():
+            pass
+        drainer.drain_once(force=True)
+        return db.rows, drainer
+
+    def test_repeated_exception_is_one_row(self):
+        rows, drainer = self.drain([record('ERROR boom', 'TypeError', 1000 + i)
+                                    for i in range(5000)])
+        self.assertEqual(len(rows), 1)
+        self.assertEqual(rows[0]['occurrences'], 5000)
+        self.assertEqual((rows[0]['first_seen'], rows[0]['last_seen']), (1000, 5999))
+
+    def test_timestamps_dont_split_messages(self):
+        rows, drainer = self.drain([record('12:00:%02d,%03d ERROR [kitsap.api] lost the db\n' %
+                                           (i % 60, i)) for i in range(500)])
+        self.assertEqual(len(rows), 1)
+        self.assertEqual(rows[0]['occurrences'], 500)
+
+    def test_flood_of_distinct_errors_is_sampled(self):
+        flood = [record('ERROR job %d failed' % i) for i in range(2000)]
+        rows, drainer = self.drain(flood)
+        self.assertTrue(len(rows) <= DIFFER_FILE_RATE_LIMIT[1] + 2000 / DIFFER_RATE_SAMPLE + 1,
+                        len(rows))
+        self.assertEqual(sum(row['occurrences'] for row in rows), 2000)
+
+    def test_file_flood_is_counted_per_fingerprint(self):
+        flood = []
+        for i in range(2000):
+            error = record('ERROR job %d failed' % i)
+            error['code_method'] = 'job%d' % (i % 5)
+            flood.append(error)
+        rows, drainer = self.drain(flood)
+        self.assertTrue(len(rows) < 2000, len(rows))
+        counts = {}
+        for row in rows:
+            counts[row['code_method']] = counts.get(row['code_method'], 0) + row['occurrences']
+        self.assertEqual(counts, dict(('job%d' % i, 400) for i in range(5)))
+
+    def test_flood_without_limits_is_every_row(self):
+        flood = [record('ERROR job %d failed' % i) for i in range(2000)]
+        for error in flood:
+            self.spool.add_differ_error(**error)
+        db = FakeDB()
+        drainer = spool.SpoolDrainer(self.spool, db)
+        drainer.aggregator.sink.file_limit = None
+        drainer.drain_once(force=True)
+        while drainer.drain_once(force=True):
+            pass
+        self.assertEqual(len(db.rows), 2000)
+
+    def test_window_is_kept_until_sent(self):
+        for i in range(10):
+            self.spool.add_differ_error(**record('ERROR boom', 'TypeError', 1000 + i))
+        self.spool.flush()
+        db = FakeDB()
+        drainer = spool.SpoolDrainer(self.spool, db, max_age=3600)
+        self.assertEqual(drainer.drain_once(), 10)
+        self.assertEqual(db.rows, [])
+
+        # a drainer starting over now, as after a crash, still sees all of it
+        again = spool.SpoolDrainer(self.spool, FakeDB(), max_age=3600)
+        self.assertEqual(again.drain_once(), 10)
+
+        drainer.drain_once(force=True)
+        self.assertEqual(db.rows[0]['occurrences'], 10)
+        self.assertEqual(spool.SpoolDrainer(self.spool, FakeDB()).drain_once(), 0)
+
+    def test_failed_insert_is_retried_once(self):
+        db = FakeDB(failures=2)
+        errors = [record('ERROR boom', 'TypeError', 1000 + i) for i in range(10)]
+        for error in errors:
+            self.spool.add_differ_error(**error)
+        drainer = spool.SpoolDrainer(self.spool, db, max_age=0)
+        self.assertEqual(drainer.drain_once(), None)
+        self.assertEqual(drainer.drain_once(), None)
+        drainer.drain_once()
+        self.assertEqual([row['occurrences'] for row in db.rows], [10])
+        self.assertEqual(spool.SpoolDrainer(self.spool, FakeDB()).drain_once(), 0)
+
+
+class SpoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.spool = spool.DifferSpool(self.directory)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def add(self, messages):
+        for message in messages:
+            self.spool.add_differ_error(**record(message))
+        self.spool.flush()
+
+    def restart(self):
+        """ A new DifferSpool over the same directory, as after differ is
+        restarted. It writes to a new segment.
+        """
+        self.spool.current_file.close()
+        self.spool = spool.DifferSpool(self.directory)
+
+    def drain(self, db):
+        drainer = spool.SpoolDrainer(self.spool, db)
+        drainer.aggregator.sink.file_limit = None
+        while drainer.drain_once(force=True):
+            pass
+        return drainer
+
+    def record_offsets(self, number):
+        """ Where each record in segment number starts.
+        """
+        data = open(self.spool.segment_path(number), 'rb').read()
+        offsets = []
+        offset = 0
+        while offset < len(data):
+            offsets.append(offset)
+            length, crc = spool.RECORD_HEADER.unpack_from(data, offset)
+            offset += spool.RECORD_HEADER.size + length
+        return offsets
+
+    def damage(self, number, offset, data=None, truncate=False):
+        segment_file = open(self.spool.segment_path(number), 'r+b')
+        if truncate:
+            segment_file.truncate(offset)
+        else:
+            segment_file.seek(offset)
+            segment_file.write(data)
+        segment_file.close()
+
+    def messages(self, db):
+        return sorted(row['error_message'] for row in db.rows)
+
+    def test_damaged_record_is_skipped(self):
+        self.add(['ERROR job %d failed' % i for i in range(6)])
+        offsets = self.record_offsets(0)
+        # a byte well into the third record's payload
+        self.damage(0, offsets[2] + spool.RECORD_HEADER.size + 20, 'X')
+        self.restart()
+        self.add(['ERROR job 6 failed'])
+
+        db = FakeDB()
+        self.drain(db)
+        self.assertEqual(self.messages(db),
+                         ['ERROR job %d failed' % i for i in (0, 1, 3, 4, 5, 6)])
+
+    def test_bad_length_is_resynced(self):
+        self.add(['ERROR job %d failed' % i for i in range(4)])
+        offsets = self.record_offsets(0)
+        self.damage(0, offsets[1], spool.RECORD_HEADER.pack(1 << 30, 0))
+        self.restart()
+
+        db = FakeDB()
+        self.drain(db)
+        self.assertEqual(self.messages(db), ['ERROR job %d failed' % i for i in (0, 2, 3)])
+
+    def test_truncated_segment_is_skipped(self):
+        self.add(['ERROR job %d failed' % i for i in range(3)])
+        offsets = self.record_offsets(0)
+        self.damage(0, offsets[2] + 10, truncate=True)
+        self.restart()
+        self.add(['ERROR job 3 failed'])
+
+        db = FakeDB()
+        self.drain(db)
+        self.assertEqual(self.messages(db), ['ERROR job %d failed' % i for i in (0, 1, 3)])
+
+    def test_torn_end_of_current_segment_waits(self):
+        self.add(['ERROR job 0 failed'])
+        self.spool.current_file.write(spool.RECORD_HEADER.pack(100, 0) + 'torn')
+        self.spool.current_file.flush()
+
+        db = FakeDB()
+        drainer = self.drain(db)
+        self.assertEqual(self.messages(db), ['ERROR job 0 failed'])
+        torn = spool.RECORD_HEADER.size + len('torn')
+        self.assertEqual((drainer.segment, drainer.offset),
+                         (0, os.path.getsize(self.spool.segment_path(0)) - torn))
+
+    def test_restart_resumes_from_saved_offset(self):
+        self.add(['ERROR job %d failed' % i for i in range(3)])
+        first = FakeDB()
+        drainer = self.drain(first)
+        self.assertEqual(len(first.rows), 3)
+        saved = open(os.path.join(self.directory, spool.OFFSET_FILE)).read().split()
+        self.assertEqual([int(number) for number in saved], [drainer.segment, drainer.offset])
+
+        self.restart()
+        self.add(['ERROR job %d failed' % i for i in range(3, 5)])
+        again = FakeDB()
+        self.drain(again)
+        self.assertEqual(self.messages(again), ['ERROR job 3 failed', 'ERROR job 4 failed'])
+        # and segments drained past are gone
+        self.assertEqual(self.spool.segments(), [1])
+
+    def test_crash_after_insert_sends_nothing_twice(self):
+        self.add(['ERROR job %d failed' % i for i in range(3)])
+        db = PositionDB()
+        drainer = spool.SpoolDrainer(self.spool, db)
+
+        def crash():
+            raise Crash()
+        drainer.save_offset = crash
+        self.assertRaises(Crash, drainer.drain_once, True)
+        self.assertEqual(len(db.rows), 3)
+        self.assertFalse(os.path.exists(os.path.join(self.directory, spool.OFFSET_FILE)))
+
+        self.restart()
+        self.add(['ERROR job 3 failed'])
+        self.drain(db)
+        self.assertEqual(self.messages(db), ['ERROR job %d failed' % i for i in range(4)])
+        self.assertEqual(self.spool.segments(), [1])
+
+    def test_new_spool_is_not_skipped(self):
+        self.add(['ERROR job %d failed' % i for i in range(3)])
+        db = PositionDB()
+        self.drain(db)
+
+        # the directory wiped, so segment numbers start over
+        self.spool.current_file.close()
+        shutil.rmtree(self.directory)
+        self.spool = spool.DifferSpool(self.directory)
+        self.add(['ERROR job 3 failed'])
+        self.drain(db)
+        self.assertEqual(len(db.rows), 4)
+        self.assertEqual(len(db.positions), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,247 @@
+'''
+Copyright (c) 2012 Lolapps, Inc. All rights reserved.
+
+Redistribution and use in source and binary forms, with or without modification, are
+permitted provided that the following conditions are met:
+
+   1. Redistributions of source code must retain the above copyright notice, this list of
+      conditions and the following disclaimer.
+
+   2. Redistributions in binary form must reproduce the above copyright notice, this list
+      of conditions and the following disclaimer in the documentation and/or other materials
+      provided with the distribution.
+
+THIS SOFTWARE IS PROVIDED BY LOLAPPS, INC. ''AS IS'' AND ANY EXPRESS OR IMPLIED
+WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND
+FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL LOLAPPS, INC. OR
+CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON
+ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+The views and conclusions contained in the software and documentation are those of the
+authors and should not be interpreted as representing official policies, either expressed
+or implied, of Lolapps, Inc..
+
+--------------------------------------------------------------------------------------------
+
+test_logdict.py
+
+How differ tells whether a log is still the file it scanned last time:
+rotation, copytruncate, inode reuse and copies of itself, finishing off
+rotated logs, and how little it reads of files it isn't going to scan.
+
+'''
+
+import gzip
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import differ
+import metrics
+
+
+def error(exception, when='12:00:01,002'):
+    return ('%s ERROR [kitsap.controllers.api] boom\n'
+            'Traceback (most recent call last):\n'
+            '  File "/var/www/kitsap/controllers/api.py", line 50, in persist\n'
+            '    do_it()\n'
+            '%s: went wrong\n'
+            '12:00:02,003 INFO [kitsap.x] fine\n' % (when, exception))
+
+
+class FakeSink(object):
+
+    def __init__(self):
+        self.exceptions = []
+        self.flushes = 0
+
+    def add_differ_error(self, logfile, product, code_location, code_method, error_message,
+                         exception, timestamp, host, *args):
+        self.exceptions.append(exception)
+
+    def flush(self):
+        self.flushes += 1
+
+
+class FakeStore(object):
+
+    def __init__(self):
+        self.checkpoints = {}
+
+    def checkpoint(self, log, entry):
+        self.checkpoints[log] = dict(entry)
+
+
+class LogdictTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.log = os.path.join(self.directory, 'a.log')
+        self.fingerprints = 0
+        self.file_fingerprint = differ.file_fingerprint
+
+        def counting_fingerprint(path, length):
+            self.fingerprints += 1
+            return self.file_fingerprint(path, length)
+        differ.file_fingerprint = counting_fingerprint
+
+    def tearDown(self):
+        differ.file_fingerprint = self.file_fingerprint
+        shutil.rmtree(self.directory)
+
+    def write(self, path, text, mode='w'):
+        output = open(path, mode)
+        try:
+            output.write(text)
+        finally:
+            output.close()
+
+    def update(self, logdict):
+        """ One update_logdict, as run_scan would do it, with the whole
+        file taken as read.
+        """
+        return differ.update_logdict([self.log], logdict, {self.log: os.stat(self.log)})
+
+    def scanned(self, logdict):
+        logdict[self.log]['log_pos'] = os.path.getsize(self.log)
+        return logdict
+
+    def test_new_file_starts_at_the_top(self):
+        self.write(self.log, error('TypeError'))
+        entry = self.update({})[self.log]
+        self.assertEqual(entry['log_pos'], 0)
+        self.assertEqual(entry['size'], os.path.getsize(self.log))
+
+    def test_appended_file_carries_on(self):
+        self.write(self.log, error('TypeError'))
+        logdict = self.scanned(self.update({}))
+        read = logdict[self.log]['log_pos']
+        self.write(self.log, error('KeyError'), 'a')
+        entry = self.update(logdict)[self.log]
+        self.assertEqual(entry['log_pos'], read)
+        self.assertFalse('rotated' in entry)
+
+    def test_rotation_finishes_the_moved_file(self):
+        self.write(self.log, error('TypeError'))
+        logdict = self.scanned(self.update({}))
+        read = logdict[self.log]['log_pos']
+        self.write(self.log, error('KeyError'), 'a')
+        os.rename(self.log, self.log + '.1')
+        self.write(self.log, error('ValueError'))
+
+        entry = self.update(logdict)[self.log]
+        self.assertEqual(entry['log_pos'], 0)
+        self.assertEqual(entry['rotated']['path'], self.log + '.1')
+        self.assertEqual(entry['rotated']['log_pos'], read)
+
+    def test_copytruncate_finishes_the_copy(self):
+        self.write(self.log, error('TypeError') * 2)
+        logdict = self.scanned(self.update({}))
+        read = logdict[self.log]['log_pos']
+        self.write(self.log, error('KeyError'), 'a')
+        shutil.copy(self.log, self.log + '.1')
+        self.write(self.log, error('ValueError'))
+
+        entry = self.update(logdict)[self.log]
+        self.assertEqual(entry['inode'], logdict[self.log]['inode'])
+        self.assertEqual(entry['log_pos'], 0)
+        self.assertEqual(entry['rotated']['path'], self.log + '.1')
+        self.assertEqual(entry['rotated']['log_pos'], read)
+
+    def test_reused_inode_is_a_new_file(self):
+        # a new file that landed on the old one's inode looks like the old
+        # file grown, but for its head
+        self.write(self.log, error('TypeError'))
+        logdict = self.scanned(self.update({}))
+        self.write(self.log, error('KeyError', '13:00:00,000') * 3)
+
+        entry = self.update(logdict)[self.log]
+        self.assertEqual(entry['inode'], logdict[self.log]['inode'])
+        self.assertEqual(entry['log_pos'], 0)
+        self.assertFalse('rotated' in entry)
+
+    def test_copy_of_itself_carries_on(self):
+        self.write(self.log, error('TypeError'))
+        logdict = self.scanned(self.update({}))
+        read = logdict[self.log]['log_pos']
+        shutil.copy(self.log, self.log + '.tmp')
+        os.rename(self.log + '.tmp', self.log)
+
+        entry = self.update(logdict)[self.log]
+        self.assertNotEqual(entry['inode'], logdict[self.log]['inode'])
+        self.assertEqual(entry['log_pos'], read)
+
+    def test_stale_file_is_only_read_when_it_changes(self):
+        self.write(self.log, error('TypeError'))
+        old = time.time() - differ.MAX_MTIME - 3600
+        os.utime(self.log, (old, old))
+        logdict = self.update({})
+        self.assertEqual(logdict[self.log]['log_pos'], os.path.getsize(self.log))
+
+        self.fingerprints = 0
+        logdict = self.update(logdict)
+        os.utime(self.log, (old - 60, old - 60))
+        logdict = self.update(logdict)
+        self.assertEqual(self.fingerprints, 0)
+
+        self.write(self.log, error('KeyError'), 'a')
+        os.utime(self.log, (old, old))
+        logdict = self.update(logdict)
+        self.assertEqual(self.fingerprints, 1)
+        self.assertEqual(logdict[self.log]['log_pos'], os.path.getsize(self.log))
+        self.assertEqual(logdict[self.log]['size'], os.path.getsize(self.log))
+
+
+class CatchUpTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.log = os.path.join(self.directory, 'a.log')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def catch_up(self, rotated_path, log_pos):
+        logdict = {self.log: {'log_pos': 0, 'rotated': {'path': rotated_path,
+                                                        'log_pos': log_pos,
+                                                        'format': 'paste'}}}
+        sink = FakeSink()
+        store = FakeStore()
+        differ.catch_up_rotated_logs([self.log], logdict, sink, store,
+                                     differ.ErrorDigest(), metrics.CycleStats())
+        return logdict, sink, store
+
+    def test_rotated_log_is_read_from_where_we_got_to(self):
+        read = error('TypeError')
+        output = open(self.log + '.1', 'w')
+        output.write(read + error('KeyError'))
+        output.close()
+
+        logdict, sink, store = self.catch_up(self.log + '.1', len(read))
+        self.assertEqual(sink.exceptions, ['KeyError'])
+        self.assertEqual(sink.flushes, 1)
+        self.assertFalse('rotated' in logdict[self.log])
+        self.assertFalse('rotated' in store.checkpoints[self.log])
+
+    def test_rotated_log_compressed_since(self):
+        read = error('TypeError')
+        output = gzip.open(self.log + '.1.gz', 'wb')
+        output.write(read + error('KeyError'))
+        output.close()
+
+        logdict, sink, store = self.catch_up(self.log + '.1', len(read))
+        self.assertEqual(sink.exceptions, ['KeyError'])
+
+    def test_rotated_log_gone(self):
+        logdict, sink, store = self.catch_up(self.log + '.1', 10)
+        self.assertEqual(sink.exceptions, [])
+        self.assertFalse('rotated' in logdict[self.log])
+
+if __name__ == '__main__':
+    unittest.main()
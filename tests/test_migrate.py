@@ -0,0 +1,259 @@
+'''
+Copyright (c) 2012 Lolapps, Inc. All rights reserved.
+
+Redistribution and use in source and binary forms, with or without modification, are
+permitted provided that the following conditions are met:
+
+   1. Redistributions of source code must retain the above copyright notice, this list of
+      conditions and the following disclaimer.
+
+   2. Redistributions in binary form must reproduce the above copyright notice, this list
+      of conditions and the following disclaimer in the documentation and/or other materials
+      provided with the distribution.
+
+THIS SOFTWARE IS PROVIDED BY LOLAPPS, INC. ''AS IS'' AND ANY EXPRESS OR IMPLIED
+WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND
+FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL LOLAPPS, INC. OR
+CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON
+ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+The views and conclusions contained in the software and documentation are those of the
+authors and should not be interpreted as representing official policies, either expressed
+or implied, of Lolapps, Inc..
+
+--------------------------------------------------------------------------------------------
+
+test_migrate.py
+
+migrate.py run over the tables as they were before there were
+migrations, checked against create_db.sql. There's no MySQL here, so
+SchemaEngine keeps track of the tables' columns and indexes from the
+statements it's given, and refuses any that use one that isn't there
+yet, the way MySQL would.
+
+'''
+
+import os
+import re
+import unittest
+
+import migrate
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# create_db.sql before there were migrations, schema version 1
+BASELINE_SCHEMA = """
+CREATE TABLE `differ_errors` (
+  `id` int(10) unsigned NOT NULL auto_increment,
+  `timestamp` int(10) unsigned NOT NULL,
+  `host` varchar(100) NOT NULL,
+  `logfile` varchar(100) NOT NULL,
+  `product` varchar(20) default NULL,
+  `code_location` varchar(100) default NULL,
+  `code_method` varchar(100) default NULL,
+  `error_message` text NOT NULL,
+  `exception` text,
+  `lolflied` varchar(5) default 'no',
+  `fbz_case` int(10) default NULL,
+  PRIMARY KEY  (`id`)
+) ENGINE=InnoDB AUTO_INCREMENT=1 DEFAULT CHARSET=utf8;
+
+CREATE TABLE `differ_warnings` (
+  `id` int(10) unsigned NOT NULL auto_increment,
+  `timestamp` int(10) unsigned NOT NULL,
+  `host` varchar(100) NOT NULL,
+  `logfile` varchar(100) NOT NULL,
+  `product` varchar(20) default NULL,
+  `code_location` varchar(100) default NULL,
+  `code_method` varchar(100) default NULL,
+  `error_message` text NOT NULL,
+  `exception` text,
+  PRIMARY KEY  (`id`)
+) ENGINE=InnoDB AUTO_INCREMENT=1 DEFAULT CHARSET=utf8;
+"""
+
+IDENTIFIER = re.compile('`?(\w+)`?')
+WORD = re.compile('\w+')
+
+
+def split_top(text):
+    """ text split at the commas that aren't in parentheses.
+    """
+    parts = []
+    depth = 0
+    current = ''
+    for char in text:
+        if char == ',' and depth == 0:
+            parts.append(current.strip())
+            current = ''
+            continue
+        depth += {'(': 1, ')': -1}.get(char, 0)
+        current += char
+    if current.strip():
+        parts.append(current.strip())
+    return parts
+
+def index_columns(text):
+    return [IDENTIFIER.match(column.strip()).group(1)
+            for column in text[text.index('(') + 1:text.rindex(')')].split(',')]
+
+
+class Result(object):
+
+    def __init__(self, value):
+        self.value = value
+
+    def scalar(self):
+        return self.value
+
+
+class SchemaEngine(object):
+    """ Enough of a sqlalchemy engine for migrate.py, over a model of the
+    schema. final is the schema the columns have to come from, so that
+    a statement using one too early is caught.
+    """
+
+    def __init__(self, final=None):
+        self.tables = {}
+        self.versions = []
+        self.final = final
+        self.statements = 0
+
+    def run_script(self, path_or_text):
+        if os.path.exists(path_or_text):
+            path_or_text = open(path_or_text).read()
+        lines = [line for line in path_or_text.splitlines(True)
+                 if not line.lstrip().startswith(('--', '#'))]
+        for statement in re.split(';\s*(?:\n|$)', ''.join(lines)):
+            if statement.strip():
+                self.execute(statement)
+
+    def has_table(self, name):
+        return name in self.tables
+
+    def columns(self, table):
+        return self.tables[table]['columns']
+
+    def check(self, condition, statement, why):
+        if not condition:
+            raise AssertionError('%s in: %s' % (why, statement))
+
+    def execute(self, statement, params=None):
+        sql = ' '.join(str(statement).split())
+        upper = sql.upper()
+        self.statements += 1
+        if upper.startswith(('CREATE DATABASE', 'USE ')):
+            return Result(None)
+        if upper.startswith('CREATE TABLE'):
+            return self.create_table(sql)
+        if upper.startswith('ALTER TABLE'):
+            return self.alter_table(sql)
+        if upper.startswith('INSERT INTO') and 'SCHEMA_MIGRATIONS' in upper:
+            if params is None:
+                version = int(re.search('VALUES \((\d+)', sql).group(1))
+            else:
+                version = params['version']
+            self.versions.append(version)
+            return Result(None)
+        if upper.startswith('SELECT MAX(VERSION) FROM SCHEMA_MIGRATIONS'):
+            return Result(max(self.versions) if self.versions else None)
+        return self.data_statement(sql)
+
+    def create_table(self, sql):
+        name = IDENTIFIER.match(sql.split()[2]).group(1)
+        self.check(name not in self.tables, sql, '%s already exists' % name)
+        table = self.tables[name] = {'columns': [], 'indexes': {}}
+        for part in split_top(sql[sql.index('(') + 1:sql.rindex(')')]):
+            words = part.split()
+            if words[0].upper() == 'PRIMARY':
+                continue
+            if words[0].upper() in ('KEY', 'INDEX'):
+                table['indexes'][IDENTIFIER.match(words[1]).group(1)] = index_columns(part)
+                continue
+            table['columns'].append(IDENTIFIER.match(words[0]).group(1))
+        return Result(None)
+
+    def alter_table(self, sql):
+        name = IDENTIFIER.match(sql.split()[2]).group(1)
+        self.check(name in self.tables, sql, 'no table %s' % name)
+        table = self.tables[name]
+        clauses = sql.split(None, 3)[3]
+        for clause in split_top(clauses):
+            words = clause.split()
+            action = ' '.join(words[:2]).upper()
+            if action == 'ADD COLUMN':
+                column = IDENTIFIER.match(words[2]).group(1)
+                self.check(column not in table['columns'], sql, '%s already exists' % column)
+                position = len(table['columns'])
+                if 'AFTER' in [word.upper() for word in words]:
+                    after = IDENTIFIER.match(words[-1]).group(1)
+                    self.check(after in table['columns'], sql, 'no column %s' % after)
+                    position = table['columns'].index(after) + 1
+                table['columns'].insert(position, column)
+            elif words[0].upper() == 'MODIFY':
+                column = IDENTIFIER.match(words[1]).group(1)
+                self.check(column in table['columns'], sql, 'no column %s' % column)
+            elif action == 'ADD INDEX':
+                columns = index_columns(clause)
+                for column in columns:
+                    self.check(column in table['columns'], sql, 'no column %s' % column)
+                table['indexes'][IDENTIFIER.match(words[2]).group(1)] = columns
+            elif action == 'DROP INDEX':
+                index = IDENTIFIER.match(words[2]).group(1)
+                self.check(index in table['indexes'], sql, 'no index %s' % index)
+                del table['indexes'][index]
+            else:
+                raise AssertionError('SchemaEngine does not know: %s' % clause)
+        return Result(None)
+
+    def data_statement(self, sql):
+        """ UPDATEs and INSERT ... SELECTs: every column of the tables
+        read from that the final schema has has to be there already.
+        """
+        sources = re.findall('(?:FROM|UPDATE) `?(\w+)`?', sql, re.I)
+        words = set(WORD.findall(sql))
+        for source in sources:
+            self.check(source in self.tables, sql, 'no table %s' % source)
+            if self.final is None:
+                continue
+            for column in self.final.columns(source):
+                if column in words:
+                    self.check(column in self.columns(source), sql,
+                               'no column %s.%s' % (source, column))
+        return Result(None)
+
+
+class MigrateTest(unittest.TestCase):
+
+    def setUp(self):
+        self.create_db = SchemaEngine()
+        self.create_db.run_script(os.path.join(ROOT, 'create_db.sql'))
+
+    def test_create_db_is_at_the_newest_migration(self):
+        newest = migrate.find_migrations()[-1][0]
+        self.assertEqual(self.create_db.versions, [newest])
+        statements = self.create_db.statements
+        self.assertEqual(migrate.migrate(self.create_db), newest)
+        self.assertEqual(self.create_db.statements - statements, 1) # just the version
+
+    def test_baseline_migrates_to_create_db(self):
+        engine = SchemaEngine(final=self.create_db)
+        engine.run_script(BASELINE_SCHEMA)
+        version = migrate.migrate(engine)
+
+        self.assertEqual(version, migrate.find_migrations()[-1][0])
+        self.assertEqual(engine.versions,
+                         [migrate.BASELINE_VERSION] +
+                         [number for number, name, path in migrate.find_migrations()])
+        self.assertEqual(sorted(engine.tables), sorted(self.create_db.tables))
+        for name, table in self.create_db.tables.items():
+            if name == 'schema_migrations':
+                continue
+            self.assertEqual(engine.tables[name], table, name)
+
+if __name__ == '__main__':
+    unittest.main()
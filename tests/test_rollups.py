@@ -0,0 +1,74 @@
+'''
+Copyright (c) 2012 Lolapps, Inc. All rights reserved.
+
+Redistribution and use in source and binary forms, with or without modification, are
+permitted provided that the following conditions are met:
+
+   1. Redistributions of source code must retain the above copyright notice, this list of
+      conditions and the following disclaimer.
+
+   2. Redistributions in binary form must reproduce the above copyright notice, this list
+      of conditions and the following disclaimer in the documentation and/or other materials
+      provided with the distribution.
+
+THIS SOFTWARE IS PROVIDED BY LOLAPPS, INC. ''AS IS'' AND ANY EXPRESS OR IMPLIED
+WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND
+FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL LOLAPPS, INC. OR
+CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON
+ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+The views and conclusions contained in the software and documentation are those of the
+authors and should not be interpreted as representing official policies, either expressed
+or implied, of Lolapps, Inc..
+
+--------------------------------------------------------------------------------------------
+
+test_rollups.py
+
+How differdb covers a window with differ_rollups buckets.
+
+'''
+
+import unittest
+
+import differdb
+
+
+TIERS = [60, 3600, 86400]
+
+
+class BucketRangesTest(unittest.TestCase):
+
+    def covered(self, ranges):
+        seconds = []
+        for tier, first, last in ranges:
+            self.assertEqual(first % tier, 0)
+            self.assertEqual(last % tier, 0)
+            seconds.append((first, last))
+        return sorted(seconds)
+
+    def test_empty_window_has_no_buckets(self):
+        self.assertEqual(differdb.bucket_ranges(120, 120, TIERS), [])
+        self.assertEqual(differdb.bucket_ranges(130, 125, TIERS), [])
+        self.assertEqual(differdb.bucket_clause([]), ('1 = 0', {}))
+
+    def test_edges_are_rounded_out_to_the_minute(self):
+        self.assertEqual(differdb.bucket_ranges(130, 131, TIERS), [(60, 120, 180)])
+
+    def test_biggest_buckets_in_the_middle(self):
+        start, end = 86400 - 90, 2 * 86400 + 3600 + 30
+        ranges = differdb.bucket_ranges(start, end, TIERS)
+        self.assertEqual([tier for tier, first, last in ranges], [60, 86400, 3600, 60])
+        # the pieces meet end to end and cover the rounded out window
+        seconds = self.covered(ranges)
+        self.assertEqual(seconds[0][0], 86400 - 120)
+        self.assertEqual(seconds[-1][1], 2 * 86400 + 3600 + 60)
+        for (first, last), (next_first, next_last) in zip(seconds, seconds[1:]):
+            self.assertEqual(last, next_first)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,143 @@
+'''
+Copyright (c) 2012 Lolapps, Inc. All rights reserved.
+
+Redistribution and use in source and binary forms, with or without modification, are
+permitted provided that the following conditions are met:
+
+   1. Redistributions of source code must retain the above copyright notice, this list of
+      conditions and the following disclaimer.
+
+   2. Redistributions in binary form must reproduce the above copyright notice, this list
+      of conditions and the following disclaimer in the documentation and/or other materials
+      provided with the distribution.
+
+THIS SOFTWARE IS PROVIDED BY LOLAPPS, INC. ''AS IS'' AND ANY EXPRESS OR IMPLIED
+WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND
+FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL LOLAPPS, INC. OR
+CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON
+ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+The views and conclusions contained in the software and documentation are those of the
+authors and should not be interpreted as representing official policies, either expressed
+or implied, of Lolapps, Inc..
+
+--------------------------------------------------------------------------------------------
+
+test_scanner.py
+
+Where the RecordAssembler starts and ends records, and which lines of a
+log format that decodes it takes for errors.
+
+'''
+
+import unittest
+
+import parsers
+import scanner
+
+
+class ShortFormat(parsers.LogFormat):
+    name = 'short'
+    max_lines = 3
+
+
+def records(text, log_format):
+    lines = []
+    offset = 0
+    for line in text.splitlines(True):
+        offset += len(line)
+        lines.append((line, offset))
+    assembler = scanner.RecordAssembler('test.log', 0, log_format)
+    found = list(assembler.records(lines))
+    last = assembler.finish()
+    if last is not None:
+        found.append(last)
+    return [(record.text, record.start, record.end) for record in found]
+
+
+class LineRecordsTest(unittest.TestCase):
+
+    def test_end_line_closes_a_record(self):
+        text = ('Traceback (most recent call last):\n'
+                '  File "x.py", line 1\n'
+                '12:00:00 DeprecationWarning\n'
+                'ok\n')
+        self.assertEqual(records(text, ShortFormat()),
+                         [(text[:-3], 0, len(text) - 3)])
+
+    def test_start_as_the_last_record_runs_out(self):
+        first = ('Traceback (most recent call last):\n'
+                 '  foo\n'
+                 '  bar\n')
+        second = ('Traceback (most recent call last):\n'
+                  '  baz\n'
+                  '  qux\n')
+        text = first + second + '  quux\n'
+        # the second traceback comes right as the first has taken its
+        # three lines. It used to be tacked onto the first record, which
+        # then went past max_lines and dropped every line after it up to
+        # the next END line
+        self.assertEqual(records(text, ShortFormat()),
+                         [(first, 0, len(first)),
+                          (second, len(first), len(first + second))])
+
+    def test_deep_traceback_stays_one_record(self):
+        text = ('Traceback (most recent call last):\n'
+                '  File "a.py", line 1, in a\n'
+                '    b()\n'
+                '  File "b.py", line 2, in b\n'
+                '    c()\n'
+                '  File "c.py", line 3, in c\n'
+                '    raise ValueError\n'
+                'ValueError\n'
+                '12:00:01 DeprecationWarning\n')
+        # the File lines are START lines, and the second comes as the
+        # record runs out of lines. It's still the same traceback, so the
+        # record goes on taking START lines until the END line, as it
+        # always has, rather than becoming one record per chunk
+        self.assertEqual(records(text, ShortFormat()),
+                         [('Traceback (most recent call last):\n'
+                           '  File "a.py", line 1, in a\n'
+                           '    b()\n'
+                           '  File "b.py", line 2, in b\n'
+                           '  File "c.py", line 3, in c\n'
+                           '12:00:01 DeprecationWarning\n', 0, len(text))])
+
+
+class DecodedRecordsTest(unittest.TestCase):
+
+    def test_level_field_decides(self):
+        error = '{"level": "error", "message": "lost the db"}\n'
+        info = '{"level": "INFO", "message": "\\"ERROR\\" is in here"}\n'
+        critical = '{"severity": "CRITICAL", "message": "down"}\n'
+        text = error + info + critical
+        # the level goes by what it decodes to, whatever its case, and
+        # an error level in the message doesn't count
+        self.assertEqual(records(text, parsers.JsonFormat()),
+                         [(error, 0, len(error)),
+                          (critical, len(error + info), len(text))])
+
+    def test_undecodable_line_is_classified(self):
+        cut = '{"level": "ERROR", "message": "cut sho\n'
+        text = cut + 'plain text "ERROR"\n'
+        self.assertEqual(records(text, parsers.JsonFormat()), [(cut, 0, len(cut))])
+
+    def test_decoded_entry_is_parsed_once(self):
+        line = ('{"level": "ERROR", "product": "kitsap", "message": "failed", '
+                '"exc_type": "KeyError", "frames": [{"file": "/var/www/kitsap/api.py", '
+                '"line": 12, "function": "persist"}]}\n')
+        assembler = scanner.RecordAssembler('test.log', 0, parsers.JsonFormat())
+        record, = assembler.records([(line, len(line))])
+        self.assertEqual(record.entry['exc_type'], 'KeyError')
+        record.text = None # parse has to go by the entry
+        scanner.parse_record(record, parsers.JsonFormat())
+        self.assertEqual((record.product, record.location, record.line_number,
+                          record.method, record.exception),
+                         ('kitsap', '/var/www/kitsap/api.py', '12', 'persist', 'KeyError'))
+
+if __name__ == '__main__':
+    unittest.main()
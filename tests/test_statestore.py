@@ -0,0 +1,182 @@
+'''
+Copyright (c) 2012 Lolapps, Inc. All rights reserved.
+
+Redistribution and use in source and binary forms, with or without modification, are
+permitted provided that the following conditions are met:
+
+   1. Redistributions of source code must retain the above copyright notice, this list of
+      conditions and the following disclaimer.
+
+   2. Redistributions in binary form must reproduce the above copyright notice, this list
+      of conditions and the following disclaimer in the documentation and/or other materials
+      provided with the distribution.
+
+THIS SOFTWARE IS PROVIDED BY LOLAPPS, INC. ''AS IS'' AND ANY EXPRESS OR IMPLIED
+WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND
+FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL LOLAPPS, INC. OR
+CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON
+ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+The views and conclusions contained in the software and documentation are those of the
+authors and should not be interpreted as representing official policies, either expressed
+or implied, of Lolapps, Inc..
+
+--------------------------------------------------------------------------------------------
+
+test_statestore.py
+
+The snapshot and journal StateStore keeps differ's offsets in, and what
+it does with what a crash leaves behind.
+
+'''
+
+import os
+import pickle
+import shutil
+import tempfile
+import unittest
+
+import statestore
+
+
+class StateStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, 'state')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def reopen(self):
+        """ The state as a differ starting over now would see it.
+        """
+        return statestore.StateStore(self.filename).load()
+
+    def test_checkpoints_are_replayed(self):
+        store = statestore.StateStore(self.filename)
+        store.save({'/var/log/a.log': {'log_pos': 10, 'inode': 1}})
+        store.checkpoint('/var/log/a.log', {'log_pos': 20, 'inode': 1})
+        store.checkpoint('/var/log/b.log', {'log_pos': 5, 'inode': 2})
+        self.assertEqual(self.reopen(), {'/var/log/a.log': {'log_pos': 20, 'inode': 1},
+                                         '/var/log/b.log': {'log_pos': 5, 'inode': 2}})
+
+    def test_paths_keep_their_bytes(self):
+        path = '/var/log/\xe9t\xe9.log'
+        store = statestore.StateStore(self.filename)
+        store.save({path: {'log_pos': 1, 'fingerprint': None}})
+        store.checkpoint(path, {'log_pos': 2, 'fingerprint': None})
+        state = self.reopen()
+        self.assertEqual(state, {path: {'log_pos': 2, 'fingerprint': None}})
+        self.assertTrue(isinstance(state.keys()[0], str))
+
+    def test_torn_last_record_is_dropped(self):
+        store = statestore.StateStore(self.filename)
+        store.save({})
+        store.checkpoint('/a', {'log_pos': 1})
+        store.checkpoint('/a', {'log_pos': 2})
+        store.journal.close()
+        store.journal = None
+
+        # the crash came part way through writing the last update
+        journal_name = self.filename + '.journal'
+        size = os.path.getsize(journal_name)
+        journal = open(journal_name, 'r+b')
+        journal.truncate(size - 3)
+        journal.close()
+        self.assertEqual(self.reopen(), {'/a': {'log_pos': 1}})
+
+        # and the next run cuts it off before appending
+        store = statestore.StateStore(self.filename)
+        store.load()
+        store.checkpoint('/b', {'log_pos': 3})
+        self.assertEqual(self.reopen(), {'/a': {'log_pos': 1}, '/b': {'log_pos': 3}})
+
+    def test_corrupt_last_record_is_dropped(self):
+        store = statestore.StateStore(self.filename)
+        store.save({})
+        store.checkpoint('/a', {'log_pos': 1})
+        store.checkpoint('/a', {'log_pos': 2})
+        store.journal.close()
+        store.journal = None
+
+        journal = open(self.filename + '.journal', 'r+b')
+        journal.seek(-2, os.SEEK_END)
+        journal.write('xx')
+        journal.close()
+        self.assertEqual(self.reopen(), {'/a': {'log_pos': 1}})
+
+    def test_snapshot_is_replaced_whole(self):
+        store = statestore.StateStore(self.filename)
+        store.save({'/a': {'log_pos': 1}})
+
+        # a save that died writing its temp file changes nothing
+        tmp = open(self.filename + '.tmp', 'wb')
+        tmp.write(statestore.FILE_HEADER.pack(statestore.SNAPSHOT_MAGIC, 3, 99) + 'garbage')
+        tmp.close()
+        self.assertEqual(self.reopen(), {'/a': {'log_pos': 1}})
+
+    def test_old_journal_isnt_replayed_onto_a_new_snapshot(self):
+        store = statestore.StateStore(self.filename)
+        store.save({'/a': {'log_pos': 1}})
+        store.checkpoint('/a', {'log_pos': 2})
+
+        # a save that got its snapshot in place, then died before it
+        # started the new journal
+        def crash(append):
+            raise IOError('crash')
+        store._start_journal = crash
+        self.assertRaises(IOError, store.save, {'/a': {'log_pos': 3}})
+        self.assertEqual(self.reopen(), {'/a': {'log_pos': 3}})
+
+    def test_save_compacts_the_journal(self):
+        store = statestore.StateStore(self.filename)
+        state = {}
+        store.save(state)
+        empty = store.journal_size()
+        # as differ does it, the state dict is its own and the store is
+        # told about each change
+        for offset in range(100):
+            state['/a'] = {'log_pos': offset}
+            store.checkpoint('/a', state['/a'])
+        self.assertTrue(store.journal_size() > empty)
+        # nothing new, nothing written
+        size = store.journal_size()
+        store.checkpoint('/a', {'log_pos': 99})
+        self.assertEqual(store.journal_size(), size)
+
+        store.save(state)
+        self.assertEqual(store.journal_size(), empty)
+        self.assertEqual(self.reopen(), {'/a': {'log_pos': 99}})
+
+    def test_pickled_state_file_is_converted(self):
+        # what differ wrote before there was a StateStore
+        old = {'/var/log/a.log': {'log_pos': 1234, 'inode': 56789}}
+        output = open(self.filename, 'w')
+        pickle.dump(old, output)
+        output.close()
+
+        store = statestore.StateStore(self.filename)
+        state = store.load()
+        self.assertEqual(state, old)
+        state['/var/log/a.log'] = {'log_pos': 2000, 'inode': 56789}
+        store.checkpoint('/var/log/a.log', state['/var/log/a.log'])
+        self.assertEqual(self.reopen(), {'/var/log/a.log': {'log_pos': 2000, 'inode': 56789}})
+
+        store.save(state)
+        self.assertTrue(open(self.filename, 'rb').read().startswith(statestore.SNAPSHOT_MAGIC))
+        self.assertEqual(self.reopen(), {'/var/log/a.log': {'log_pos': 2000, 'inode': 56789}})
+
+    def test_unreadable_snapshot_is_moved_aside(self):
+        output = open(self.filename, 'wb')
+        output.write('not a state file')
+        output.close()
+        self.assertEqual(self.reopen(), {})
+        self.assertTrue(os.path.exists(self.filename + '.corrupt'))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -29,6 +29,7 @@ or implied, of Lolapps, Inc..
 
 import cStringIO
 import re
+import resource
 import socket
 import smtplib
 import sys
@@ -56,6 +57,12 @@ def get_differ_hostname():
     return socket.gethostname().split(".")[0]
 
 
+def get_peak_rss():
+    """ Peak resident set size of this process so far, in KB.
+    """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
 def write_log(msg):
     """ write_log is a common function we can use for logging. It
     helps to ensure that everything is spit out with the same format
@@ -134,57 +141,76 @@ def mail_it(rcptto, mailfrom, subject, message, replyto=None):
     except Exception, e:
         write_log('unable to send mail: "%s"' % e)
 
-# regular experessions used by parse_error_string
-file_line = re.compile(FILE_LINE)
+def single_line_pattern(pattern):
+    """ pattern with \\s narrowed so it can't match a newline. For a
+    pattern meant to be matched against a single line this makes no
+    difference, but it can then be run over a whole message with re.M
+    without a match spilling onto the next line.
+    """
+    return re.sub(r'(?<!\\)((?:\\\\)*)\\s', r'\1[^\\S\\n]', pattern)
+
+# regular experessions used by parse_error_string. file_line and
+# traceback_lines are run over the whole message rather than line by line
+file_line = re.compile(single_line_pattern(FILE_LINE), re.M)
 lol_file_line = re.compile(LOL_FILE_LINE)
 shared_file_line = re.compile(SHARED_FILE_LINE)
-indented_line = re.compile(INDENTED_LINE)
+
+# a run of File lines and indented lines, which is what a traceback is
+traceback_lines = re.compile(r'(?:(?:%s|%s).*(?:\n|\Z))*' %
+                             (single_line_pattern(FILE_LINE), single_line_pattern(INDENTED_LINE)),
+                             re.M)
 
 def parse_error_string(message):
     """
     Extracts the actual exception and relevant code that triggered it from the message from differ.
     """
-    # split message into array of lines for processing
-    lines = message.split('\n')
-
     # the message will have some crap, then a traceback, then the exception then more crap.
     # we want to parse out the most relevant file/method in the traceback and the exception.
     # the traceback is over when you see a non-indented line that doesn't start with File, 
     # so grab that at the exception. the most relevant line of the traceback is the lowest
     # one that is in /var/www or just the lowest one if there are none that match that.
+    #
+    # this runs for every error differ finds, so rather than split the message up and
+    # look at every line, we let the regex engine find the first File line and the end
+    # of the traceback, and then work back from there for the location.
 
     # stays none until we've seen the first line after the traceback section
     exception = None
 
-    # stays none until we've seen the first line of the traceback section, preferences:
-    # 1) product_location /var/www (except example)
-    # 2) shared_location  /var/www/example
-    # 3) other_location   anything else, usually /usr*
-    product_location = None
-    shared_location = None
-    other_location = None
-
-    for line in lines:
-        if file_line.match(line):
-            if lol_file_line.match(line):
-                if shared_file_line.match(line):
-                    shared_location = line
+    # stays none unless there's a traceback section, preferences:
+    # 1) product location /var/www (except example)
+    # 2) shared location  /var/www/example
+    # 3) other location   anything else, usually /usr*
+    location = None
+
+    first = file_line.search(message)
+    if first:
+        end = traceback_lines.match(message, first.start()).end()
+        if end < len(message) or message.endswith('\n'):
+            newline = message.find('\n', end)
+            exception = message[end:newline] if newline >= 0 else message[end:]
+
+        # walk back up the traceback for the lowest File line of the kind we
+        # like best, usually the first one we look at
+        shared_location = None
+        other_location = None
+        line_end = end - 1 if message.endswith('\n', 0, end) else end
+        while True:
+            line_start = message.rfind('\n', first.start(), line_end) + 1 or first.start()
+            if file_line.match(message, line_start, line_end):
+                line = message[line_start:line_end]
+                if lol_file_line.match(line):
+                    if not shared_file_line.match(line):
+                        location = line
+                        break
+                    shared_location = shared_location or line
                 else:
-                    product_location = line
-            else:
-                other_location = line
-        elif (product_location or shared_location or other_location) \
-             and not indented_line.match(line):
-            exception = line
-            # got the exception, we're done here
-            break
-
-    if product_location:
-        location = product_location
-    elif shared_location:
-        location = shared_location
-    else:
-        location = other_location
+                    other_location = other_location or line
+            if line_start == first.start():
+                break
+            line_end = line_start - 1
+
+        location = location or shared_location or other_location
 
     # parse the location line. it looks like:
     # File '/var/www/example/fileserver/client.py', line 50 in _connect
@@ -208,6 +234,275 @@ def parse_error_string(message):
     return filename, line_number, method, exception
 
 
+# what a line means to record assembly, see LineClassifier.classify
+START, END, CONTINUE, IGNORE = range(4)
+
+def split_alternation(pattern):
+    """ Split a regular expression into its top level alternatives,
+    looking through one set of parens wrapping the whole thing. Returns
+    None if the pattern doesn't look like something we can safely split.
+    """
+    branches = []
+    current = ''
+    depth = 0
+    in_class = False
+    escaped = False
+    wrapped = pattern.startswith('(') and not pattern.startswith('(?') \
+              or pattern.startswith('(?:')
+
+    for i, char in enumerate(pattern):
+        if escaped:
+            escaped = False
+        elif char == '\\':
+            escaped = True
+        elif in_class:
+            in_class = char != ']'
+        elif char == '[':
+            in_class = True
+        elif char == '(':
+            depth += 1
+        elif char == ')':
+            depth -= 1
+            if depth == 0 and i != len(pattern) - 1:
+                wrapped = False
+        elif char == '|' and depth == (1 if wrapped else 0):
+            branches.append(current)
+            current = ''
+            continue
+        current += char
+
+    if depth != 0 or in_class:
+        return None
+    branches.append(current)
+
+    if wrapped:
+        # drop the wrapping parens from the first and last branch
+        opener = '(?:' if pattern.startswith('(?:') else '('
+        branches[0] = branches[0][len(opener):]
+        branches[-1] = branches[-1][:-1]
+    return branches
+
+
+def factor_whitespace_branches(branches):
+    """ Rewrite unanchored alternatives for faster searching. We only
+    ever ask whether they match, never what they matched, so a leading or
+    trailing \\s+ can be narrowed to a single \\s. Branches that then
+    start with \\s are grouped behind one \\s so the regex engine only
+    tries them at whitespace instead of at every position in the line.
+    """
+    spaced = []
+    others = []
+    for branch in branches:
+        if branch.startswith('\\s+'):
+            branch = '\\s' + branch[3:]
+        if branch.endswith('\\s+') and not branch.endswith('\\\\s+'):
+            branch = branch[:-1]
+        if branch.startswith('\\s') and branch[2:3] not in ('*', '+', '?', '{'):
+            spaced.append(branch[2:])
+        else:
+            others.append(branch)
+
+    if spaced:
+        others.insert(0, '\\s(?:%s)' % '|'.join(spaced))
+    return others
+
+
+def required_literal(branch):
+    """ The longest run of plain text that any match of a regex branch
+    has to contain, or None if we can't tell. Only text outside of groups
+    and character classes counts, and a character followed by a
+    quantifier that allows zero of it is dropped.
+    """
+    runs = ['']
+    depth = 0
+    in_class = False
+    i = 0
+    while i < len(branch):
+        char = branch[i]
+        i += 1
+        if in_class:
+            if char == '\\':
+                i += 1
+            elif char == ']':
+                in_class = False
+        elif char == '\\':
+            escaped = branch[i:i + 1]
+            i += 1
+            if depth:
+                continue
+            if escaped.isalnum() or not escaped:
+                # \s, \d, \b and friends aren't literal text
+                runs.append('')
+            else:
+                runs[-1] += escaped
+        elif char == '[':
+            in_class = True
+            runs.append('')
+        elif char == '(':
+            if branch[i:i + 1] == '?' and branch[i + 1:i + 2] in 'iLmsux':
+                return None # inline flags change what the text means
+            depth += 1
+            runs.append('')
+        elif char == ')':
+            depth -= 1
+        elif depth:
+            continue
+        elif char in '*?{':
+            if char == '{':
+                i = branch.find('}', i) + 1 or len(branch)
+            runs[-1] = runs[-1][:-1]
+            runs.append('')
+        elif char in '+.^$|':
+            if char == '|':
+                return None
+            runs.append('')
+        else:
+            runs[-1] += char
+
+    return max(runs, key=len) or None
+
+
+def required_literals(pattern):
+    """ A list of strings, one of which must appear in any text that
+    pattern can match, or None if pattern has a branch without any
+    required text.
+    """
+    literals = []
+    for branch in split_alternation(pattern) or [pattern]:
+        literal = required_literal(branch)
+        if literal is None:
+            return None
+        literals.append(literal)
+
+    # text holding "InnoDB: Error:" also holds "Error", so only the
+    # shorter one needs looking for
+    return [literal for literal in set(literals)
+            if not [other for other in literals if other != literal and other in literal]]
+
+
+class LineClassifier(object):
+    """ Precompiled classifier for the scan_file hot loop. One regex
+    match per line tells us whether it starts an error and whether it
+    starts with a date, replacing the separate ERROR_RE search,
+    IGNORE_ERRORS loop and date format matches.
+
+    ERROR_RE alternatives anchored with ^ are tried once at the start of
+    the line instead of at every position, and the rest are grouped by
+    factor_whitespace_branches, which is where a plain search() spends
+    most of its time.
+
+    Outside of an error only START lines matter, and start_finder() lets
+    the caller skip straight past text holding none of the literals
+    ERROR_RE needs, without running it.
+    """
+
+    def __init__(self, error_re=ERROR_RE, end_re=ERROR_END_RE,
+                 date_formats=(PASTE_DATE_FORMAT, PYLONS_DATE_FORMAT),
+                 ignore_errors=IGNORE_ERRORS, literals=ERROR_LITERALS):
+        anchored = []
+        floating = []
+        for branch in split_alternation(error_re) or [error_re]:
+            if branch.startswith('^'):
+                anchored.append(branch[1:])
+            else:
+                floating.append(branch)
+
+        dates = '|'.join('(?:%s)' % fmt for fmt in date_formats)
+        floating = factor_whitespace_branches(floating)
+
+        # the date is looked for in a lookahead so it can't swallow the
+        # start of an error match, and (?!) never matches, it stands in
+        # for an empty set of branches
+        pattern = '(?:(?P<anchored>%s)|(?:(?=(?P<date>%s)))?(?:.*?(?P<start>%s))?)' % \
+                  ('|'.join(anchored or ['(?!)']), dates, '|'.join(floating or ['(?!)']))
+        self._match = re.compile(pattern).match
+        self._date = re.compile(dates).match
+        self._end = re.compile(end_re).search
+
+        ignore_errors = [getattr(exp, 'pattern', exp) for exp in ignore_errors]
+        if ignore_errors:
+            self._ignore = re.compile('|'.join('(?:%s)' % exp for exp in ignore_errors)).search
+        else:
+            self._ignore = None
+
+        # text that can't start an error doesn't need the regex at all
+        if literals is None:
+            literals = required_literals(error_re)
+        self.literals = literals and tuple(literals)
+
+        # error lines IGNORE_ERRORS has thrown out so far
+        self.ignored = 0
+
+    def start_finder(self):
+        """ Returns find(text, start), giving where in text, from start
+        on, the first thing that might be part of an ERROR_RE match is,
+        going by the literals one of which every match contains. It's -1
+        if nothing there could match, and start if we have no literals to
+        go by. find remembers where each literal turned up in the last
+        text it was given, so asking again further along the same buffer
+        doesn't search it all over again.
+        """
+        literals = self.literals
+        cache = {'text': None, 'hits': {}}
+
+        def find(text, start=0):
+            if not literals:
+                return start
+            if text is not cache['text']:
+                cache['text'] = text
+                cache['hits'] = {}
+            hits = cache['hits']
+
+            found = -1
+            for literal in literals:
+                searched_from, index = hits.get(literal, (None, None))
+                if searched_from is None or searched_from > start or 0 <= index < start:
+                    index = text.find(literal, start)
+                    hits[literal] = (start, index)
+                if index >= 0 and (found < 0 or index < found):
+                    found = index
+            return found
+
+        return find
+
+    def new_entry(self, line):
+        """ Whether line starts with one of date_formats, beginning a new
+        log entry.
+        """
+        return self._date(line) is not None
+
+    def ignore(self, line):
+        """ Whether IGNORE_ERRORS throws out the error line line, counted
+        in ignored if so. classify does this itself.
+        """
+        if self._ignore is not None and self._ignore(line):
+            self.ignored += 1
+            return True
+        return False
+
+    def classify(self, line):
+        """ Returns one of:
+        START - an error line we care about
+        END - a line that closes off an error in progress (a new dated
+              log line or ERROR_END_RE)
+        IGNORE - an error line that matches IGNORE_ERRORS
+        CONTINUE - anything else
+        """
+        anchored, date, start = self._match(line).group('anchored', 'date', 'start')
+        if anchored is not None or start is not None:
+            if self._ignore is None or not self._ignore(line):
+                return START
+            self.ignored += 1
+            kind = IGNORE
+        else:
+            kind = CONTINUE
+
+        if date is not None or (anchored is not None and self._date(line)) or \
+           self._end(line):
+            return END
+        return kind
+
+
 def check_valid_error(error_string):
     """ function that takes a string, and attempts to match
     it against the items in the IGNORE_ERRORS list.
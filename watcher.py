@@ -0,0 +1,207 @@
+'''
+Copyright (c) 2012 Lolapps, Inc. All rights reserved.
+
+Redistribution and use in source and binary forms, with or without modification, are
+permitted provided that the following conditions are met:
+
+   1. Redistributions of source code must retain the above copyright notice, this list of
+      conditions and the following disclaimer.
+
+   2. Redistributions in binary form must reproduce the above copyright notice, this list
+      of conditions and the following disclaimer in the documentation and/or other materials
+      provided with the distribution.
+
+THIS SOFTWARE IS PROVIDED BY LOLAPPS, INC. ''AS IS'' AND ANY EXPRESS OR IMPLIED
+WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND
+FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL LOLAPPS, INC. OR
+CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON
+ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+The views and conclusions contained in the software and documentation are those of the
+authors and should not be interpreted as representing official policies, either expressed
+or implied, of Lolapps, Inc..
+
+--------------------------------------------------------------------------------------------
+
+watcher.py
+
+Thin ctypes wrapper around Linux inotify so that differ can wake up
+as soon as one of its TARGETS changes instead of polling every
+DIFFER_LOOP_TIME seconds. Only the stdlib is used; if inotify isn't
+available (non-Linux, old kernel, out of watches) InotifyUnavailable
+is raised and the caller is expected to fall back to polling.
+
+'''
+
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import struct
+import time
+
+import util
+
+# from <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0x00080000
+IN_NONBLOCK = 0x00000800
+
+WATCH_MASK = (IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO |
+              IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR)
+
+# struct inotify_event { int wd; uint32_t mask; uint32_t cookie; uint32_t len; char name[]; }
+EVENT_HEADER = struct.Struct('iIII')
+
+READ_SIZE = 64 * 1024
+
+
+class InotifyUnavailable(Exception):
+    pass
+
+
+class LogWatcher(object):
+    """ Watches the directories holding our targets and reports which
+    files changed. Files are watched through their parent directory so
+    that we keep seeing them across rotation (rename + create).
+    """
+
+    def __init__(self, targets):
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                               use_errno=True)
+            self._add_watch = libc.inotify_add_watch
+            self._add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+            inotify_init1 = libc.inotify_init1
+        except (OSError, AttributeError), e:
+            raise InotifyUnavailable(e)
+
+        self.fd = inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise InotifyUnavailable(os.strerror(ctypes.get_errno()))
+
+        self.targets = set(targets)
+        self.watches = {} # wd -> watched directory
+        self.rescan = False # set when we may have missed events
+        self.refresh()
+
+        if not self.watches:
+            self.close()
+            raise InotifyUnavailable('no watchable targets')
+
+    def refresh(self):
+        """ (Re)add watches for every target. Safe to call repeatedly,
+        inotify hands back the existing wd for a directory it already
+        watches. Targets that don't exist yet are picked up on a later
+        refresh.
+        """
+        self.watches.clear()
+        for target in self.targets:
+            if os.path.isdir(target):
+                directory = target
+            else:
+                directory = os.path.dirname(target)
+            if not os.path.isdir(directory):
+                continue
+
+            wd = self._add_watch(self.fd, directory, WATCH_MASK)
+            if wd < 0:
+                err = ctypes.get_errno()
+                if err == errno.ENOSPC:
+                    raise InotifyUnavailable('out of inotify watches')
+                util.write_log('unable to watch %s: %s' % (directory, os.strerror(err)))
+                continue
+            self.watches[wd] = directory
+        self.rescan = False
+
+    def set_targets(self, targets):
+        """ Swap in a new set of targets, say from a discovery.Discovery
+        that found more directories, and watch them.
+        """
+        self.targets = set(targets)
+        self.refresh()
+
+    def is_target(self, path):
+        return path in self.targets or os.path.dirname(path) in self.targets
+
+    def wait(self, timeout, coalesce=0):
+        """ Block for up to timeout seconds waiting for changes. Once the
+        first event arrives, keep reading until coalesce seconds after it
+        so a burst of writes turns into a single scan; a log that never
+        goes quiet still gets scanned every coalesce seconds. Returns the
+        set of changed target files.
+        """
+        changed = set()
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return changed
+
+        self._read_events(changed)
+        deadline = time.time() + coalesce
+        while True:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            readable, _, _ = select.select([self.fd], [], [], remaining)
+            if not readable:
+                break
+            self._read_events(changed)
+
+        return changed
+
+    def _read_events(self, changed):
+        try:
+            buf = os.read(self.fd, READ_SIZE)
+        except OSError, e:
+            if e.errno in (errno.EAGAIN, errno.EINTR):
+                return
+            raise
+
+        offset = 0
+        while offset + EVENT_HEADER.size <= len(buf):
+            wd, mask, cookie, length = EVENT_HEADER.unpack_from(buf, offset)
+            offset += EVENT_HEADER.size
+            name = buf[offset:offset + length].rstrip('\0')
+            offset += length
+
+            if mask & (IN_Q_OVERFLOW | IN_IGNORED | IN_DELETE_SELF | IN_MOVE_SELF):
+                # either the kernel dropped events or a watched directory
+                # went away; the caller needs to rescan everything
+                self.rescan = True
+                continue
+
+            directory = self.watches.get(wd)
+            if directory is None or not name:
+                continue
+
+            if mask & IN_ISDIR:
+                # a new directory may be under a recursive target, and
+                # only a full scan will find and watch it
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    self.rescan = True
+                continue
+
+            path = os.path.join(directory, name)
+            if self.is_target(path):
+                changed.add(path)
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1